@@ -0,0 +1,92 @@
+"""
+Measure how fast pre-annotations can be loaded: one POST /api/detection/boxes per box against POST
+/api/detection/boxes/batch.
+
+    uv run python benchmarks/bench_box_batches.py
+    uv run python benchmarks/bench_box_batches.py --boxes 100000 --batch-size 20000
+"""
+
+import argparse
+import random
+import tempfile
+import time
+
+from fastapi import Request
+from fastapi.testclient import TestClient
+from sqlmodel import Session, SQLModel
+
+from yapml.datamodel import FunctionType, Label, ObjectDetectionSample, YapFunction
+from yapml.db import create_sqlite_engine, get_session
+from yapml.server.webapp import web_app
+
+
+def populate(session: Session, samples: int) -> tuple[int, int]:
+    function = YapFunction(name="bench", description="", function_type=FunctionType.OBJECT_DETECTION)
+    session.add(function)
+    session.commit()
+    assert function.id is not None
+    label = Label(name="thing", color="#FF0000", function_id=function.id)
+    session.add(label)
+    session.add_all(
+        ObjectDetectionSample(function_id=function.id, url=f"/images/{i}", width=500, height=500)
+        for i in range(samples)
+    )
+    session.commit()
+    assert label.id is not None
+    return function.id, label.id
+
+
+def random_boxes(count: int, samples: int, function_id: int, label_id: int) -> list[dict]:
+    return [
+        {
+            "sample_id": random.randint(1, samples),
+            "function_id": function_id,
+            "label_id": label_id,
+            "center_x": random.uniform(0.2, 0.8),
+            "center_y": random.uniform(0.2, 0.8),
+            "width": 0.1,
+            "height": 0.1,
+            "annotator_name": "model",
+        }
+        for _ in range(count)
+    ]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--samples", type=int, default=1000)
+    parser.add_argument("--boxes", type=int, default=20000)
+    parser.add_argument("--single-boxes", type=int, default=1000, help="Boxes posted one by one, for comparison")
+    parser.add_argument("--batch-size", type=int, default=10000)
+    args = parser.parse_args()
+
+    engine = create_sqlite_engine(f"sqlite:///{tempfile.mkdtemp()}/bench.db")
+    SQLModel.metadata.create_all(engine)
+    with Session(engine) as session:
+        function_id, label_id = populate(session, args.samples)
+
+    def override_get_session(request: Request):
+        with Session(engine) as session:
+            request.state.session = session
+            yield session
+
+    web_app.dependency_overrides[get_session] = override_get_session
+    with TestClient(web_app) as client:
+        boxes = random_boxes(args.single_boxes, args.samples, function_id, label_id)
+        start = time.perf_counter()
+        for box in boxes:
+            client.post("/api/detection/boxes", json=box).raise_for_status()
+        single_rate = len(boxes) / (time.perf_counter() - start)
+        print(f"One request per box: {single_rate:8.0f} boxes/s")
+
+        boxes = random_boxes(args.boxes, args.samples, function_id, label_id)
+        start = time.perf_counter()
+        for i in range(0, len(boxes), args.batch_size):
+            results = client.post("/api/detection/boxes/batch", json=boxes[i : i + args.batch_size]).json()
+            assert all(result["status"] == "created" for result in results)
+        batch_rate = len(boxes) / (time.perf_counter() - start)
+        print(f"Batches of {args.batch_size}: {batch_rate:8.0f} boxes/s ({batch_rate / single_rate:.0f}x)")
+
+
+if __name__ == "__main__":
+    main()
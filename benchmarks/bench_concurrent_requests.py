@@ -0,0 +1,126 @@
+"""
+Measure read throughput of the API at increasing numbers of parallel requests.
+
+Fills a database file with samples and boxes, then for each concurrency level keeps that many GET requests for
+sample pages in flight for `--seconds` and reports requests per second. Route handlers run in a thread pool of
+`--threads` threads. `--threads 1` serializes the handlers, like running them on the event loop did.
+
+Running the handlers in threads keeps a slow request from holding up the others, it does not multiply throughput.
+Only the SQLite queries release the GIL. ORM hydration and pydantic serialization, where a sample page spends most of
+its time, hold it. Measured on 1 vCPU, throughput stays flat or drops slightly as requests are added.
+
+    uv run python benchmarks/bench_concurrent_requests.py
+    uv run python benchmarks/bench_concurrent_requests.py --threads 1
+"""
+
+import argparse
+import asyncio
+import random
+import tempfile
+import time
+
+import anyio.to_thread
+import httpx
+from fastapi import Request
+from sqlmodel import Session, SQLModel
+
+from yapml.datamodel import BoundingBox, FunctionType, Label, ObjectDetectionSample, YapFunction
+from yapml.db import READ_ONLY_METHODS, create_sqlite_engine, get_session
+from yapml.server.webapp import web_app
+
+
+def populate(session: Session, samples: int, boxes_per_sample: int) -> int:
+    function = YapFunction(name="bench", description="", function_type=FunctionType.OBJECT_DETECTION)
+    session.add(function)
+    session.commit()
+    assert function.id is not None
+    label = Label(name="thing", color="#FF0000", function_id=function.id)
+    session.add(label)
+    session.add_all(
+        ObjectDetectionSample(function_id=function.id, url=f"/images/{i}", width=500, height=500)
+        for i in range(samples)
+    )
+    session.commit()
+    assert label.id is not None
+    for sample_id in range(1, samples + 1):
+        for _ in range(boxes_per_sample):
+            session.add(
+                BoundingBox(
+                    sample_id=sample_id,
+                    function_id=function.id,
+                    label_id=label.id,
+                    center_x=random.uniform(0.2, 0.8),
+                    center_y=random.uniform(0.2, 0.8),
+                    width=0.1,
+                    height=0.1,
+                    annotator_name="bench",
+                    lineage_id=0,  # Skip the per-row lineage hook, box ids are not needed here.
+                )
+            )
+    session.commit()
+    return function.id
+
+
+async def measure(client: httpx.AsyncClient, urls: list[str], concurrency: int, seconds: float) -> float:
+    stop = time.perf_counter() + seconds
+    completed = 0
+
+    async def worker():
+        nonlocal completed
+        while time.perf_counter() < stop:
+            response = await client.get(random.choice(urls))
+            response.raise_for_status()
+            completed += 1
+
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return completed / seconds
+
+
+async def run(args) -> None:
+    url = f"sqlite:///{tempfile.mkdtemp()}/bench.db"
+    engine = create_sqlite_engine(url)
+    read_engine = create_sqlite_engine(url, read_only=True, pool_size=max(args.levels))
+    SQLModel.metadata.create_all(engine)
+    with Session(engine) as session:
+        function_id = populate(session, args.samples, args.boxes_per_sample)
+
+    def override_get_session(request: Request):
+        with Session(read_engine if request.method in READ_ONLY_METHODS else engine) as session:
+            request.state.session = session
+            yield session
+
+    web_app.dependency_overrides[get_session] = override_get_session
+    anyio.to_thread.current_default_thread_limiter().total_tokens = args.threads
+
+    urls = [
+        f"/api/detection/samples?function_id={function_id}&limit=24&cursor={cursor}"
+        for cursor in range(0, args.samples - 24, 24)
+    ]
+    transport = httpx.ASGITransport(app=web_app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+        await measure(client, urls, 1, 1)  # Warm up.
+        baseline = None
+        for concurrency in args.levels:
+            throughput = await measure(client, urls, concurrency, args.seconds)
+            baseline = baseline or throughput
+            print(f"{concurrency:>3} parallel requests: {throughput:7.1f} requests/s ({throughput / baseline:.1f}x)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--samples", type=int, default=5000)
+    parser.add_argument("--boxes-per-sample", type=int, default=5)
+    parser.add_argument("--levels", type=int, nargs="+", default=[1, 2, 4, 8])
+    parser.add_argument(
+        "--threads",
+        type=int,
+        default=40,
+        help="Size of the thread pool that runs route handlers, 40 like AnyIO's default",
+    )
+    parser.add_argument("--seconds", type=float, default=5)
+    args = parser.parse_args()
+    asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    main()
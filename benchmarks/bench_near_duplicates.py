@@ -0,0 +1,65 @@
+"""
+Measure near-duplicate search over many perceptual hashes.
+
+Builds an index of `--samples` random 64-bit hashes, with `--duplicates` of them planted as perturbed copies of
+others, then times single queries and a full clustering pass against a brute-force scan.
+
+    uv run python benchmarks/bench_near_duplicates.py
+    uv run python benchmarks/bench_near_duplicates.py --samples 100000 --radius 6
+"""
+
+import argparse
+import time
+
+import numpy as np
+
+from yapml.near_duplicates import NearDuplicateIndex
+
+
+def random_hashes(rng: np.random.Generator, samples: int, duplicates: int, radius: int) -> np.ndarray:
+    hashes = rng.integers(0, 2**64, samples, dtype=np.uint64)
+    sources = rng.integers(0, samples - duplicates, duplicates)
+    for target, source in zip(range(samples - duplicates, samples), sources):
+        flips = rng.choice(64, rng.integers(0, radius + 1), replace=False)
+        hashes[target] = hashes[source] ^ np.uint64(sum(1 << int(bit) for bit in flips))
+    return hashes
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--samples", type=int, default=1_000_000)
+    parser.add_argument("--duplicates", type=int, default=10_000)
+    parser.add_argument("--queries", type=int, default=1_000)
+    parser.add_argument("--radius", type=int, default=4)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    hashes = random_hashes(rng, args.samples, args.duplicates, args.radius)
+    hex_hashes = [f"{int(h):016x}" for h in hashes]
+
+    start = time.perf_counter()
+    index = NearDuplicateIndex()
+    index.add_many(list(range(args.samples)), hex_hashes)
+    index.query(hex_hashes[0], args.radius)  # Flushes the insert buffer.
+    print(f"Indexed {args.samples} hashes in {time.perf_counter() - start:.2f}s")
+
+    query_ids = rng.integers(0, args.samples, args.queries)
+    start = time.perf_counter()
+    for i in query_ids:
+        index.query(hex_hashes[i], args.radius)
+    indexed = (time.perf_counter() - start) / args.queries
+    print(f"Indexed query: {indexed * 1e3:.3f} ms")
+
+    start = time.perf_counter()
+    for i in query_ids[:20]:
+        np.flatnonzero(np.bitwise_count(hashes ^ hashes[i]) <= args.radius)
+    brute_force = (time.perf_counter() - start) / 20
+    print(f"Brute-force query: {brute_force * 1e3:.3f} ms ({brute_force / indexed:.0f}x slower)")
+
+    start = time.perf_counter()
+    clusters = index.clusters(args.radius)
+    print(f"Clustered into {len(clusters)} near-duplicate groups in {time.perf_counter() - start:.2f}s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,130 @@
+"""
+Measure how responsive the API stays while samples are ingested from slow URLs.
+
+Starts a local HTTP server that answers every image request after `--delay` seconds, posts `--ingests` samples that
+point at it, and meanwhile keeps requesting the label list. Pass `--blocking` to download images with the old
+blocking code path for comparison.
+
+    uv run python benchmarks/bench_slow_ingest.py
+    uv run python benchmarks/bench_slow_ingest.py --blocking
+"""
+
+import argparse
+import asyncio
+import statistics
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from io import BytesIO
+
+import httpx
+import numpy as np
+from fastapi import Request
+from PIL import Image
+from sqlmodel import Session, SQLModel, create_engine
+
+from yapml.datamodel import FunctionType, YapFunction
+from yapml.db import get_session
+from yapml.image_processing import ImageDecoder
+from yapml.server.webapp import web_app
+
+
+def slow_image_server(delay: float) -> ThreadingHTTPServer:
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            time.sleep(delay)
+            image = BytesIO()
+            pixels = np.random.randint(0, 255, (64, 64, 3), dtype=np.uint8)
+            Image.fromarray(pixels).save(image, format="PNG")
+            self.send_response(200)
+            self.send_header("Content-Type", "image/png")
+            self.send_header("Content-Length", str(len(image.getvalue())))
+            self.end_headers()
+            self.wfile.write(image.getvalue())
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+async def run(ingests: int, delay: float) -> None:
+    engine = create_engine(f"sqlite:///{tempfile.mkdtemp()}/bench.db", connect_args={"check_same_thread": False})
+    SQLModel.metadata.create_all(engine)
+    with Session(engine) as session:
+        function = YapFunction(name="bench", description="", function_type=FunctionType.OBJECT_DETECTION)
+        session.add(function)
+        session.commit()
+        function_id = function.id
+
+    def override_get_session(request: Request):
+        with Session(engine) as session:
+            request.state.session = session
+            yield session
+
+    web_app.dependency_overrides[get_session] = override_get_session
+    server = slow_image_server(delay)
+    image_base_url = f"http://127.0.0.1:{server.server_address[1]}"
+
+    transport = httpx.ASGITransport(app=web_app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://yapml", timeout=600) as client:
+        ingests_done = asyncio.Event()
+
+        async def ingest() -> None:
+            requests = [
+                client.post(
+                    "/api/detection/samples", json={"url": f"{image_base_url}/{i}.png", "function_id": function_id}
+                )
+                for i in range(ingests)
+            ]
+            responses = await asyncio.gather(*requests)
+            ingests_done.set()
+            print(f"ingests: {sum(r.status_code == 200 for r in responses)}/{ingests} created")
+
+        async def poll() -> list[float]:
+            latencies = []
+            while not ingests_done.is_set():
+                start = time.perf_counter()
+                await client.get("/api/detection/labels", params={"function_id": function_id})
+                latencies.append(time.perf_counter() - start)
+                await asyncio.sleep(0.01)
+            return latencies
+
+        start = time.perf_counter()
+        _, latencies = await asyncio.gather(ingest(), poll())
+        elapsed = time.perf_counter() - start
+
+    server.shutdown()
+    web_app.dependency_overrides.clear()
+    latencies_ms = sorted(latency * 1000 for latency in latencies)
+    print(f"wall time: {elapsed:.2f}s for {ingests} ingests with {delay}s origin latency")
+    print(
+        f"label list latency while ingesting: n={len(latencies_ms)} "
+        f"p50={statistics.median(latencies_ms):.1f}ms "
+        f"p95={latencies_ms[int(0.95 * (len(latencies_ms) - 1))]:.1f}ms "
+        f"max={latencies_ms[-1]:.1f}ms"
+    )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--ingests", type=int, default=10)
+    parser.add_argument("--delay", type=float, default=1.0, help="Seconds the image server waits before answering")
+    parser.add_argument("--blocking", action="store_true", help="Download images with blocking requests.get")
+    args = parser.parse_args()
+
+    if args.blocking:
+
+        async def blocking_to_stream(self, sample_data: str) -> BytesIO:
+            return self.to_stream(sample_data)
+
+        ImageDecoder.to_stream_async = blocking_to_stream  # type: ignore
+
+    asyncio.run(run(args.ingests, args.delay))
+
+
+if __name__ == "__main__":
+    main()
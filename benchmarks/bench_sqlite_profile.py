@@ -0,0 +1,162 @@
+"""
+Measure mixed read/write throughput of the SQLite engine profile.
+
+Fills a database file with samples and boxes, then for `--seconds` runs `--readers` threads that load pages of the
+samples grid and `--writers` threads that move boxes, like annotators do. Compares the engine profile in db.py
+(WAL, pragmas, separate read-only and writer pools) against the previous default engine (rollback
+journal, one shared pool).
+
+    uv run python benchmarks/bench_sqlite_profile.py
+    uv run python benchmarks/bench_sqlite_profile.py --readers 16 --writers 4
+"""
+
+import argparse
+import random
+import statistics
+import tempfile
+import threading
+import time
+from datetime import datetime
+
+from sqlalchemy import Engine
+from sqlmodel import Session, SQLModel, create_engine, select
+
+from yapml.config import sqlite_reader_pool_size, sqlite_writer_pool_size
+from yapml.datamodel import BoundingBox, FunctionType, Label, ObjectDetectionSample, YapFunction
+from yapml.db import create_sqlite_engine
+from yapml.server.api import fetch_sample_page
+
+
+def populate(engine: Engine, samples: int, boxes_per_sample: int) -> int:
+    with Session(engine) as session:
+        function = YapFunction(name="bench", description="", function_type=FunctionType.OBJECT_DETECTION)
+        session.add(function)
+        session.commit()
+        assert function.id is not None
+        label = Label(name="thing", color="#FF0000", function_id=function.id)
+        session.add(label)
+        session.add_all(
+            ObjectDetectionSample(function_id=function.id, url=f"/images/{i}", width=500, height=500)
+            for i in range(samples)
+        )
+        session.commit()
+        sample_ids = session.exec(select(ObjectDetectionSample.id)).all()
+        for sample_id in sample_ids:
+            for _ in range(boxes_per_sample):
+                box = BoundingBox(
+                    sample_id=sample_id,
+                    function_id=function.id,
+                    label_id=label.id,
+                    center_x=random.uniform(0.2, 0.8),
+                    center_y=random.uniform(0.2, 0.8),
+                    width=0.1,
+                    height=0.1,
+                    annotator_name="bench",
+                    lineage_id=0,  # Skip the per-row lineage hook, box ids are not needed here.
+                )
+                session.add(box)
+        session.commit()
+        return function.id
+
+
+def move_box(session: Session, function_id: int) -> None:
+    """The writes of update_box: replace the current version of a random box with a moved copy."""
+    box = session.exec(
+        select(BoundingBox)
+        .where(BoundingBox.function_id == function_id, BoundingBox.is_head)
+        .order_by(BoundingBox.id.desc())  # type: ignore
+        .limit(1)
+        .offset(random.randrange(100))
+    ).first()
+    assert box is not None
+    moved = BoundingBox(
+        **box.model_dump(exclude={"id", "created_at", "previous_box_id", "version", "center_x"}),
+        center_x=random.uniform(0.2, 0.8),
+        previous_box_id=box.id,
+        version=box.version + 1,
+        created_at=datetime.now(),
+    )
+    box.is_head = False
+    session.add_all([box, moved])
+    session.commit()
+
+
+def run(read_engine: Engine, write_engine: Engine, function_id: int, args) -> None:
+    stop = time.perf_counter() + args.seconds
+    read_latencies: list[float] = []
+    write_latencies: list[float] = []
+    errors: list[Exception] = []
+
+    def reader():
+        while time.perf_counter() < stop:
+            start = time.perf_counter()
+            with Session(read_engine) as session:
+                cursor = random.randrange(args.samples - args.page_size)
+                fetch_sample_page(session, function_id=function_id, cursor=cursor, limit=args.page_size)
+            read_latencies.append(time.perf_counter() - start)
+
+    def writer():
+        while time.perf_counter() < stop:
+            start = time.perf_counter()
+            try:
+                with Session(write_engine) as session:
+                    move_box(session, function_id)
+            except Exception as e:  # e.g. "database is locked"
+                errors.append(e)
+                continue
+            write_latencies.append(time.perf_counter() - start)
+
+    threads = [threading.Thread(target=reader) for _ in range(args.readers)]
+    threads += [threading.Thread(target=writer) for _ in range(args.writers)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    for name, latencies in (("Reads", read_latencies), ("Writes", write_latencies)):
+        if not latencies:
+            print(f"  {name}: none completed")
+            continue
+        p95 = statistics.quantiles(latencies, n=20)[-1] if len(latencies) > 1 else latencies[0]
+        print(
+            f"  {name}: {len(latencies) / args.seconds:.0f}/s, "
+            f"median {statistics.median(latencies) * 1e3:.1f} ms, p95 {p95 * 1e3:.1f} ms"
+        )
+    if errors:
+        print(f"  Failed writes: {len(errors)} ({errors[0]})")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--samples", type=int, default=5000)
+    parser.add_argument("--boxes-per-sample", type=int, default=5)
+    parser.add_argument("--page-size", type=int, default=24)
+    parser.add_argument("--readers", type=int, default=8)
+    parser.add_argument("--writers", type=int, default=2)
+    parser.add_argument("--writer-pool-size", type=int, default=sqlite_writer_pool_size)
+    parser.add_argument("--seconds", type=float, default=10)
+    args = parser.parse_args()
+
+    for profile in ("default", "profile"):
+        url = f"sqlite:///{tempfile.mkdtemp()}/bench.db"
+        if profile == "default":
+            # The engine db.py used to create, shared by readers and writers.
+            read_engine = write_engine = create_engine(
+                url,
+                connect_args={"check_same_thread": False, "timeout": 30},
+                pool_pre_ping=True,
+                pool_size=args.readers + args.writers,
+            )
+        else:
+            write_engine = create_sqlite_engine(url, pool_size=args.writer_pool_size)
+            read_engine = create_sqlite_engine(
+                url, read_only=True, pool_size=max(args.readers, sqlite_reader_pool_size)
+            )
+        SQLModel.metadata.create_all(write_engine)
+        function_id = populate(write_engine, args.samples, args.boxes_per_sample)
+        print(f"{profile} engine ({args.readers} readers, {args.writers} writers):")
+        run(read_engine, write_engine, function_id, args)
+
+
+if __name__ == "__main__":
+    main()
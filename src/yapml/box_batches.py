@@ -0,0 +1,273 @@
+"""
+Create, update and delete bounding boxes in bulk, e.g. to load model pre-annotations.
+
+Each batch is processed in chunks of `box_batch_chunk_size` boxes, one transaction per chunk. Within a chunk the box
+geometry is validated as arrays, the referenced samples, labels and boxes are looked up with one query each, and the
+rows are written with executemany statements. Boxes that fail validation are reported and skipped, the rest of the
+batch is still written.
+"""
+
+from datetime import datetime
+from typing import Optional, Sequence
+
+import numpy as np
+from pydantic import BaseModel
+from sqlalchemy import insert, update
+from sqlmodel import Session, select
+
+from yapml.config import box_batch_chunk_size
+from yapml.datamodel import BoundingBox, Label, ObjectDetectionSample, bump_generations
+from yapml.deletion import label_deletion_pending
+
+GEOMETRY_FIELDS = ("center_x", "center_y", "width", "height")
+
+
+class BoxCreate(BaseModel):
+    sample_id: int
+    label_id: int
+    center_x: float
+    center_y: float
+    width: float
+    height: float
+    annotator_name: str
+
+
+class BoxBatchUpdate(BaseModel):
+    box_id: int
+    center_x: Optional[float] = None
+    center_y: Optional[float] = None
+    width: Optional[float] = None
+    height: Optional[float] = None
+    annotator_name: Optional[str] = None
+
+
+class BoxBatchResult(BaseModel):
+    index: int
+    status: str  # One of "created", "updated", "deleted" or "error".
+    box_id: Optional[int] = None
+    detail: Optional[str] = None
+
+
+def validate_box_geometry(boxes: Sequence[dict]) -> list[Optional[str]]:
+    """
+    Check the centers and sizes of many boxes at once, with the same rules as the BoundingBox validators.
+
+    Returns an error message per box, or None for valid boxes.
+    """
+    errors: list[Optional[str]] = [None] * len(boxes)
+    for name in GEOMETRY_FIELDS:
+        values = np.fromiter((box[name] for box in boxes), dtype=np.float64, count=len(boxes))
+        # Written so that NaN fails the check.
+        if name.startswith("center"):
+            invalid = ~((values >= 0) & (values <= 1))
+            message = "Center must be between 0 and 1.0"
+        else:
+            invalid = ~((values > 0) & (values <= 1))
+            message = "Dimension must be greater than 0 and less than or equal to 1.0"
+        for i in np.flatnonzero(invalid):
+            errors[i] = errors[i] or f"{name}: {message}"
+    return errors
+
+
+def insert_boxes(session: Session, rows: list[dict]) -> list[int]:
+    """Insert box rows with a single executemany statement and return their ids, in order."""
+    if not rows:
+        return []
+    bump_generations(session, {row["function_id"] for row in rows})
+    return list(
+        session.execute(insert(BoundingBox).returning(BoundingBox.id, sort_by_parameter_order=True), rows).scalars()
+    )
+
+
+def insert_new_boxes(session: Session, rows: list[dict]) -> list[int]:
+    """
+    Insert the first versions of new boxes and return their ids, in order.
+
+    Bulk inserts skip the ORM events, so the lineage the after_insert hook would set is set here.
+    """
+    ids = insert_boxes(session, rows)
+    if ids:
+        session.execute(
+            update(BoundingBox)
+            .where(BoundingBox.id.in_(ids))  # type: ignore
+            .values(lineage_id=BoundingBox.id)
+            .execution_options(synchronize_session=False)
+        )
+    return ids
+
+
+def create_boxes(
+    session: Session, boxes: Sequence[BoxCreate], chunk_size: int = box_batch_chunk_size
+) -> list[BoxBatchResult]:
+    """Create new boxes. The function of each box is the function of its sample, which its label must belong to."""
+    results = []
+    for start in range(0, len(boxes), chunk_size):
+        results += create_box_chunk(session, boxes[start : start + chunk_size], start)
+        session.commit()
+    return results
+
+
+def create_box_chunk(session: Session, boxes: Sequence[BoxCreate], offset: int) -> list[BoxBatchResult]:
+    items = [box.model_dump() for box in boxes]
+    errors = validate_box_geometry(items)
+    sample_functions = dict(
+        session.exec(
+            select(ObjectDetectionSample.id, ObjectDetectionSample.function_id).where(
+                ObjectDetectionSample.id.in_({item["sample_id"] for item in items})  # type: ignore
+            )
+        ).all()
+    )
+    labels = {
+        label_id: (function_id, deleting)
+        for label_id, function_id, deleting in session.exec(
+            select(Label.id, Label.function_id, label_deletion_pending(Label.id)).where(  # type: ignore
+                Label.id.in_({item["label_id"] for item in items}),  # type: ignore
+                Label.deleted_at.is_(None),  # type: ignore
+            )
+        ).all()
+    }
+
+    now = datetime.now()
+    rows = []
+    for i, item in enumerate(items):
+        function_id = sample_functions.get(item["sample_id"])
+        if errors[i]:
+            continue
+        elif function_id is None:
+            errors[i] = "Sample not found"
+        elif item["label_id"] not in labels:
+            errors[i] = "Label not found"
+        elif labels[item["label_id"]][0] != function_id:
+            errors[i] = "Label belongs to a different function than the sample"
+        elif labels[item["label_id"]][1]:
+            errors[i] = "Label is being deleted"
+        else:
+            rows.append(item | {"function_id": function_id, "created_at": now, "version": 1, "is_head": True})
+
+    ids = iter(insert_new_boxes(session, rows))
+    return [
+        BoxBatchResult(index=offset + i, status="error", detail=error)
+        if error
+        else BoxBatchResult(index=offset + i, status="created", box_id=next(ids))
+        for i, error in enumerate(errors)
+    ]
+
+
+def fetch_head_boxes(session: Session, box_ids: set[int]) -> tuple[dict[int, dict], set[int]]:
+    """Look up boxes by id. Returns the current versions by id, and the ids of the boxes that exist at all."""
+    rows = session.exec(select(BoundingBox).where(BoundingBox.id.in_(box_ids))).all()  # type: ignore
+    heads = {box.id: box.model_dump() for box in rows if box.is_head}
+    return heads, {box.id for box in rows}
+
+
+def box_error(box_id: int, existing: set[int], seen: set[int]) -> str:
+    if box_id in seen:
+        return "Box appears more than once in this batch"
+    if box_id in existing:
+        return "Box is deleted or was replaced by a newer version"
+    return "Box not found"
+
+
+def update_boxes(
+    session: Session, updates: Sequence[BoxBatchUpdate], chunk_size: int = box_batch_chunk_size
+) -> list[BoxBatchResult]:
+    """Replace the current version of boxes with new versions, like update_box. Unset fields keep their value."""
+    results = []
+    for start in range(0, len(updates), chunk_size):
+        results += update_box_chunk(session, updates[start : start + chunk_size], start)
+        session.commit()
+    return results
+
+
+def update_box_chunk(session: Session, updates: Sequence[BoxBatchUpdate], offset: int) -> list[BoxBatchResult]:
+    heads, existing = fetch_head_boxes(session, {update_data.box_id for update_data in updates})
+
+    errors: list[Optional[str]] = []
+    items: list[dict] = []
+    seen: set[int] = set()
+    for update_data in updates:
+        box = heads.get(update_data.box_id)
+        if box is None or update_data.box_id in seen:
+            errors.append(box_error(update_data.box_id, existing, seen))
+            items.append(dict.fromkeys(GEOMETRY_FIELDS, 0.5))  # Placeholder, never written.
+            continue
+        seen.add(update_data.box_id)
+        errors.append(None)
+        items.append(box | update_data.model_dump(exclude={"box_id"}, exclude_none=True))
+    errors = [error or geometry_error for error, geometry_error in zip(errors, validate_box_geometry(items))]
+
+    now = datetime.now()
+    rows, replaced_ids = [], []
+    for item, error in zip(items, errors):
+        if error is None:
+            replaced_ids.append(item["id"])
+            rows.append(
+                {name: item[name] for name in ("sample_id", "function_id", "label_id", "annotator_name")}
+                | {name: item[name] for name in GEOMETRY_FIELDS}
+                | {
+                    "previous_box_id": item["id"],
+                    "lineage_id": item["lineage_id"] or item["id"],
+                    "version": item["version"] + 1,
+                    "is_head": True,
+                    "created_at": now,
+                }
+            )
+
+    if replaced_ids:
+        session.execute(
+            update(BoundingBox)
+            .where(BoundingBox.id.in_(replaced_ids))  # type: ignore
+            .values(is_head=False)
+            .execution_options(synchronize_session=False)
+        )
+    ids = iter(insert_boxes(session, rows))
+    return [
+        BoxBatchResult(index=offset + i, status="error", detail=error)
+        if error
+        else BoxBatchResult(index=offset + i, status="updated", box_id=next(ids))
+        for i, error in enumerate(errors)
+    ]
+
+
+def delete_boxes(
+    session: Session, box_ids: Sequence[int], chunk_size: int = box_batch_chunk_size
+) -> list[BoxBatchResult]:
+    """Soft-delete the current version of boxes, like delete_box."""
+    results = []
+    for start in range(0, len(box_ids), chunk_size):
+        results += delete_box_chunk(session, box_ids[start : start + chunk_size], start)
+        session.commit()
+    return results
+
+
+def delete_box_chunk(session: Session, box_ids: Sequence[int], offset: int) -> list[BoxBatchResult]:
+    rows = session.exec(
+        select(BoundingBox.id, BoundingBox.is_head, BoundingBox.function_id).where(
+            BoundingBox.id.in_(set(box_ids))  # type: ignore
+        )
+    ).all()
+    heads = {box_id: function_id for box_id, is_head, function_id in rows if is_head}
+    existing = {box_id for box_id, _, _ in rows}
+
+    results = []
+    seen: set[int] = set()
+    for i, box_id in enumerate(box_ids):
+        if box_id in heads and box_id not in seen:
+            results.append(BoxBatchResult(index=offset + i, status="deleted", box_id=box_id))
+        else:
+            results.append(
+                BoxBatchResult(
+                    index=offset + i, status="error", box_id=box_id, detail=box_error(box_id, existing, seen)
+                )
+            )
+        seen.add(box_id)
+
+    if deleted := seen & heads.keys():
+        session.execute(
+            update(BoundingBox)
+            .where(BoundingBox.id.in_(deleted))  # type: ignore
+            .values(deleted_at=datetime.now(), is_head=False)
+            .execution_options(synchronize_session=False)
+        )
+        bump_generations(session, {heads[box_id] for box_id in deleted})
+    return results
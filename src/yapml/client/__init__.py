@@ -1,13 +1,25 @@
 from .admin_page import render_admin_page
 from .functions_page import render_function_list_page
 from .labels_page import render_label_list_page
-from .samples_page import render_sample_details_page, render_sample_history, render_sample_list_page
+from .samples_page import (
+    render_box,
+    render_history_items,
+    render_image_card,
+    render_sample_cells,
+    render_sample_details_page,
+    render_sample_history,
+    render_sample_list_page,
+)
 
 __all__ = [
+    "render_box",
+    "render_image_card",
     "render_sample_details_page",
     "render_sample_history",
+    "render_history_items",
     "render_label_list_page",
     "render_admin_page",
     "render_sample_list_page",
+    "render_sample_cells",
     "render_function_list_page",
 ]
@@ -1,11 +1,14 @@
 import fasthtml.common as fh
 from fasthtml.common import FT
 
+from yapml.client.assets import static_asset
 from yapml.client.page_templates import function_template
 from yapml.client.styles import yapml_gray_color
 
 # JavaScript for handling database reset
-RESET_DB_SCRIPT = """
+RESET_DB_SCRIPT = static_asset(
+    "admin.js",
+    """
 document.addEventListener('DOMContentLoaded', function() {
     function resetDatabase() {
         if (!confirm('Are you sure you want to reset the database? This action cannot be undone.')) {
@@ -36,7 +39,8 @@ document.addEventListener('DOMContentLoaded', function() {
     // Add event listener to reset button
     document.getElementById('reset-db-btn').addEventListener('click', resetDatabase);
 });
-"""
+""",
+)
 
 
 def render_admin_page(function_id: int) -> FT:
@@ -0,0 +1,48 @@
+"""
+Scripts and styles of the UI, served as static files instead of being inlined into every page.
+
+Each asset is served under a file name that contains a hash of its content, so browsers cache it for good and a
+changed asset gets a new URL. A gzipped copy is made once, when the asset is defined. Page specific values, like the
+function id, are passed to scripts through data attributes of the page.
+"""
+
+import gzip
+import hashlib
+import os
+from dataclasses import dataclass
+
+from yapml.config import asset_url_prefix
+
+MEDIA_TYPES = {".js": "text/javascript; charset=utf-8", ".css": "text/css; charset=utf-8"}
+
+
+@dataclass(frozen=True)
+class Asset:
+    file_name: str  # Includes the fingerprint, e.g. "drag.0123456789ab.js".
+    media_type: str
+    content: bytes
+    gzipped: bytes
+    fingerprint: str
+
+    @property
+    def url(self) -> str:
+        return f"{asset_url_prefix}/{self.file_name}"
+
+
+ASSETS: dict[str, Asset] = {}  # By file name.
+
+
+def static_asset(name: str, source: str) -> Asset:
+    """Define an asset named like "drag.js" with the given JavaScript or CSS source."""
+    stem, extension = os.path.splitext(name)
+    content = source.encode()
+    fingerprint = hashlib.blake2b(content, digest_size=6).hexdigest()
+    asset = Asset(
+        file_name=f"{stem}.{fingerprint}{extension}",
+        media_type=MEDIA_TYPES[extension],
+        content=content,
+        gzipped=gzip.compress(content, compresslevel=9, mtime=0),
+        fingerprint=fingerprint,
+    )
+    ASSETS[asset.file_name] = asset
+    return asset
@@ -1,12 +1,15 @@
 import fasthtml.common as fh
 from fasthtml.common import FT
 
+from yapml.client.assets import static_asset
 from yapml.client.page_templates import console_template
 from yapml.client.styles import yapml_gray_color
 from yapml.datamodel import YapFunction
 
 # JavaScript for handling function name edits and deletion
-FUNCTION_SCRIPT = """
+FUNCTION_SCRIPT = static_asset(
+    "functions.js",
+    """
 document.addEventListener('DOMContentLoaded', function() {
     // Function to update function
     function updateFunction(functionId, updateData) {
@@ -96,7 +99,8 @@ document.addEventListener('DOMContentLoaded', function() {
             method: 'DELETE',
         })
         .then(response => {
-            if (response.status === 204) {
+            // Large deletions continue in the background and are answered with 202.
+            if (response.status === 204 || response.status === 202) {
                 return null;
             } else {
                 throw new Error('Network response was not ok');
@@ -122,7 +126,8 @@ document.addEventListener('DOMContentLoaded', function() {
         });
     });
 });
-"""
+""",
+)
 
 
 def render_function_list_page(functions: list[YapFunction]) -> FT:
@@ -1,12 +1,15 @@
 import fasthtml.common as fh
 from fasthtml.common import FT
 
+from yapml.client.assets import static_asset
 from yapml.client.page_templates import function_template
 from yapml.client.styles import yapml_gray_color
-from yapml.datamodel import Label, suppress_stale_boxes
+from yapml.datamodel import LabelSummary
 
 # JavaScript for handling color changes and name edits
-COLOR_CHANGE_SCRIPT = """
+COLOR_CHANGE_SCRIPT = static_asset(
+    "labels.js",
+    """
 document.addEventListener('DOMContentLoaded', function() {
     // Function to update label
     function updateLabel(labelId, updateData) {
@@ -108,7 +111,8 @@ document.addEventListener('DOMContentLoaded', function() {
             method: 'DELETE',
         })
         .then(response => {
-            if (response.status === 204) {
+            // Large deletions continue in the background and are answered with 202.
+            if (response.status === 204 || response.status === 202) {
                 return null;
             } else {
                 throw new Error('Network response was not ok');
@@ -150,15 +154,16 @@ document.addEventListener('DOMContentLoaded', function() {
         });
     });
 });
-"""
+""",
+)
 
 
-def render_label_list_page(function_id: int, labels: list[Label]) -> FT:
+def render_label_list_page(function_id: int, labels: list[LabelSummary]) -> FT:
     """
     Render a page that displays all labels with their colors.
 
     Args:
-        labels: List of Label objects to display
+        labels: List of labels to display, with their box counts
 
     Returns:
         An HTML page showing all labels
@@ -194,7 +199,8 @@ def render_label_list_page(function_id: int, labels: list[Label]) -> FT:
                             data_label_id=f"{label.id}",
                         ),
                         fh.Small(
-                            f"{len(suppress_stale_boxes(label.boxes))} annotations",
+                            f"{label.box_count} annotations on {label.sample_count} samples",
+                            title=", ".join(f"{name}: {count}" for name, count in label.annotator_box_counts.items()),
                             style=f"margin-left: auto; color: {yapml_gray_color};",
                         ),
                     ),
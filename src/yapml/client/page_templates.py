@@ -3,6 +3,7 @@ from typing import Optional
 import fasthtml.common as fh
 from fasthtml.common import FT
 
+from yapml.client.assets import Asset
 from yapml.client.navbar import render_navbar
 
 
@@ -10,8 +11,8 @@ def function_template(
     main: FT,
     function_id: int,
     title: str,
-    scripts: Optional[list[str]] = None,
-    styles: Optional[list[str]] = None,
+    scripts: Optional[list[Asset]] = None,
+    styles: Optional[list[Asset]] = None,
 ) -> FT:
     scripts = [] if not scripts else scripts
     styles = [] if not styles else styles
@@ -26,17 +27,18 @@ def function_template(
             fh.Title(title),
             fh.Link(rel="stylesheet", href="https://cdn.jsdelivr.net/npm/@picocss/pico@1/css/pico.min.css"),
             fh.Script(src="https://unpkg.com/htmx.org@1.9.6"),
-            *[fh.Script(script) for script in scripts],
-            *[fh.Style(style) for style in styles],
+            *[fh.Script(src=script.url) for script in scripts],
+            *[fh.Link(rel="stylesheet", href=style.url) for style in styles],
         ),
-        fh.Body(body),
+        # Scripts read the function of the page from here.
+        fh.Body(body, data_function_id=str(function_id)),
         data_theme="dark",
     )
     return page
 
 
 def console_template(
-    main: FT, title: str, scripts: Optional[list[str]] = None, styles: Optional[list[str]] = None
+    main: FT, title: str, scripts: Optional[list[Asset]] = None, styles: Optional[list[Asset]] = None
 ) -> FT:
     scripts = [] if not scripts else scripts
     styles = [] if not styles else styles
@@ -45,8 +47,8 @@ def console_template(
             fh.Title(title),
             fh.Link(rel="stylesheet", href="https://cdn.jsdelivr.net/npm/@picocss/pico@1/css/pico.min.css"),
             fh.Script(src="https://unpkg.com/htmx.org@1.9.6"),
-            *[fh.Script(script) for script in scripts],
-            *[fh.Style(style) for style in styles],
+            *[fh.Script(src=script.url) for script in scripts],
+            *[fh.Link(rel="stylesheet", href=style.url) for style in styles],
         ),
         fh.Body(main),
         data_theme="dark",
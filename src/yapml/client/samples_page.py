@@ -1,17 +1,23 @@
+from typing import Optional
+from urllib.parse import urlencode
+
 import fasthtml.common as fh  # type: ignore
 from fasthtml.common import FT
 
+from yapml.client.assets import static_asset
 from yapml.client.page_templates import function_template
 from yapml.client.styles import yapml_gray_color
-from yapml.datamodel import BoundingBox, BoxChange, ObjectDetectionSample, suppress_stale_boxes
-from yapml.utils import boxes_to_changes
-
+from yapml.datamodel import BoundingBox, BoxHistoryPage, ObjectDetectionSample
+from yapml.thumbnails import thumbnail_url
 
-# Add JavaScript for drag and resize functionality
-def render_drag_script(function_id: int) -> str:
-    drag_script = (
-        """
+# JavaScript for drag and resize functionality. The function of the page is read from the body's data-function-id.
+DRAG_SCRIPT = static_asset(
+    "drag.js",
+    """
         console.log('Script loaded');
+        function pageFunctionId() {
+            return parseInt(document.body.dataset.functionId);
+        }
         let isDragging = false;
         let isResizing = false;
         let currentBox = null;
@@ -28,13 +34,17 @@ def render_drag_script(function_id: int) -> str:
         let selectedLabelId = null;
         let currentImageContainer = null;
 
-        function initializeDraggable() {
-            console.log('Initializing draggable');
-            const images = document.querySelectorAll('img');
-            images.forEach(image => {
-                const boxes = image.parentElement.querySelectorAll('.draggable-box');
+        function initializeDraggable(root) {
+            // The root is a page, a card, or a single box that was added to a card.
+            const boxes = Array.from(root.querySelectorAll('.draggable-box'));
+            if (root.classList && root.classList.contains('draggable-box')) {
+                boxes.push(root);
+            }
             console.log('Found boxes:', boxes.length);
             boxes.forEach(box => {
+                // Cards can be loaded more than once (infinite scroll), only wire them up once.
+                if (box.dataset.initialized) return;
+                box.dataset.initialized = 'true';
                 box.style.cursor = 'move';
                 box.addEventListener('mousedown', startDragging);
                 
@@ -42,11 +52,18 @@ def render_drag_script(function_id: int) -> str:
                 const handles = box.querySelectorAll('.resize-handle');
                 handles.forEach(handle => {
                     handle.addEventListener('mousedown', startResizing);
-                    });
                 });
             });
         }
 
+        // Replace a card with a fresh copy from the server, e.g. to undo a change the server rejected.
+        function refreshCard(sampleId) {
+            return htmx.ajax('GET', `/samples/${sampleId}/card`, {
+                target: `[data-sample-id="${sampleId}"]`,
+                swap: 'outerHTML',
+            });
+        }
+
         function startDragging(e) {
             // Ignore if clicked on a resize handle
             if (e.target.classList.contains('resize-handle')) return;
@@ -163,6 +180,7 @@ def render_drag_script(function_id: int) -> str:
 
         async function updateBoxPosition() {
             const boxId = currentBox.dataset.boxId;
+            const sampleId = currentBox.parentElement.dataset.sampleId;
             const imageWidth = parseFloat(currentBox.dataset.imageWidth);
             const imageHeight = parseFloat(currentBox.dataset.imageHeight);
             
@@ -189,6 +207,7 @@ def render_drag_script(function_id: int) -> str:
                 
                 if (!response.ok) {
                     console.error('Failed to update box position');
+                    await refreshCard(sampleId);
                 } else {
                     // Get the updated box ID from the response and update the element
                     const result = await response.json();
@@ -204,17 +223,21 @@ def render_drag_script(function_id: int) -> str:
             }
         }
 
-        function initializeDrawing() {
-            const images = document.querySelectorAll('img');
+        function initializeDrawing(root) {
+            const images = root.querySelectorAll('img');
             images.forEach(image => {
                 const imageContainer = image.parentElement;
+                if (imageContainer.dataset.drawingInitialized) return;
+                imageContainer.dataset.drawingInitialized = 'true';
                 
                 // Add drawing functionality to each image
                 imageContainer.addEventListener('mousedown', startDrawing);
                 imageContainer.addEventListener('mousemove', draw);
                 imageContainer.addEventListener('mouseup', stopDrawing);
             });
-            
+        }
+
+        function initializeLabelSelector() {
             // Create hidden label selector (shared between all images)
             const labelSelector = document.createElement('select');
             labelSelector.id = 'label-selector';
@@ -226,12 +249,29 @@ def render_drag_script(function_id: int) -> str:
             updateLabelSelector();
         }
 
+        // The labels of the page's function, fetched once per page.
+        let labelsPromise = null;
+
+        function loadLabels() {
+            if (!labelsPromise) {
+                labelsPromise = fetch(`/api/detection/labels?function_id=${pageFunctionId()}`)
+                    .then(response => {
+                        if (!response.ok) {
+                            throw new Error('Failed to load labels');
+                        }
+                        return response.json();
+                    })
+                    .catch(error => {
+                        labelsPromise = null;  // Try again next time.
+                        throw error;
+                    });
+            }
+            return labelsPromise;
+        }
+
         function updateLabelSelector() {
             const labelSelector = document.getElementById('label-selector');
-            fetch('"""
-        + f"/api/v1/labels?function_id={function_id}"
-        + """')
-                .then(response => response.json())
+            loadLabels()
                 .then(labels => {
                     // Add a prompt option
                     labelSelector.innerHTML = `
@@ -240,7 +280,8 @@ def render_drag_script(function_id: int) -> str:
                             `<option value="${label.id}" data-color="${label.color}">${label.name}</option>`
                         ).join('')}
                     `;
-                });
+                })
+                .catch(error => console.error('Error loading labels:', error));
         }
 
         function startDrawing(e) {
@@ -420,9 +461,8 @@ def render_drag_script(function_id: int) -> str:
                     const normalizedHeight = boxDimensions.height / imageHeight;
                     
                     const payload = {
-                        sample_id: parseInt(sampleId),"""
-        + f"function_id: {function_id},"
-        + """
+                        sample_id: parseInt(sampleId),
+                        function_id: pageFunctionId(),
                         label_id: parseInt(labelId),
                         center_x: centerX,
                         center_y: centerY,
@@ -435,7 +475,7 @@ def render_drag_script(function_id: int) -> str:
                     
                     // Create the box
                     try {
-                        const response = await fetch('/api/v1/boxes', {
+                        const response = await fetch('/api/detection/boxes', {
                             method: 'POST',
                             headers: {
                                 'Content-Type': 'application/json',
@@ -448,14 +488,22 @@ def render_drag_script(function_id: int) -> str:
                             throw new Error(`Failed to create box: ${JSON.stringify(errorData)}`);
                         }
                         
-                        // Refresh the page to show new box
-                        window.location.reload();
+                        // Add just the new box to the card, instead of reloading the page.
+                        const box = await response.json();
+                        await htmx.ajax(
+                            'GET',
+                            `/boxes/${box.id}/element?max_width=${imageWidth}&max_height=${imageHeight}`,
+                            { target: finalImageContainer, swap: 'beforeend' }
+                        );
+                        document.body.dispatchEvent(new CustomEvent('boxUpdated'));
                     } catch (error) {
                         console.error('Error creating box:', error);
                         alert('Failed to create box. Please check console for details.');
                     } finally {
-                        // Hide selector and remove drawing box
+                        // Hide and reset the selector, so that the same label can be picked for the next box,
+                        // and remove the drawing box.
                         labelSelector.style.display = 'none';
+                        labelSelector.value = '';
                         if (finalDrawBox && finalDrawBox.parentNode) {
                             finalDrawBox.remove();
                         }
@@ -469,15 +517,21 @@ def render_drag_script(function_id: int) -> str:
         }
 
         document.addEventListener('DOMContentLoaded', function() {
-            initializeDraggable();
-            initializeDrawing();
+            initializeLabelSelector();
         });
-        """
-    )
-    return drag_script
+
+        // Runs for the initial page and for every fragment htmx swaps in later.
+        htmx.onLoad(function(content) {
+            initializeDraggable(content);
+            initializeDrawing(content);
+        });
+        """,
+)
 
 
-DRAG_STYLE = """
+DRAG_STYLE = static_asset(
+    "drag.css",
+    """
 .draggable-box:hover { 
     border-color: orange !important;
 }
@@ -505,7 +559,68 @@ DRAG_STYLE = """
 #label-selector option:hover {
     background-color: var(--primary);
 }
-"""
+""",
+)
+
+
+# Unloads cards that scroll far out of view and restores them when they come back, so the DOM (and the decoded
+# images) stays bounded however far the user scrolls.
+VIRTUAL_SCROLL_SCRIPT = static_asset(
+    "virtual_scroll.js",
+    """
+document.addEventListener('DOMContentLoaded', function() {
+    const stash = new Map();
+
+    const observer = new IntersectionObserver(entries => {
+        entries.forEach(entry => {
+            const cell = entry.target;
+            if (entry.isIntersecting && stash.has(cell)) {
+                const fragment = stash.get(cell);
+                fragment.querySelectorAll('img[data-src]').forEach(img => {
+                    img.src = img.dataset.src;
+                    img.removeAttribute('data-src');
+                });
+                cell.appendChild(fragment);
+                stash.delete(cell);
+                cell.style.height = '';
+            } else if (!entry.isIntersecting && !stash.has(cell)) {
+                cell.style.height = `${cell.offsetHeight}px`;
+                const fragment = document.createDocumentFragment();
+                while (cell.firstChild) {
+                    fragment.appendChild(cell.firstChild);
+                }
+                fragment.querySelectorAll('img').forEach(img => {
+                    img.dataset.src = img.src;
+                    img.removeAttribute('src');
+                });
+                stash.set(cell, fragment);
+            }
+        });
+    }, { rootMargin: '3000px 0px' });
+
+    htmx.onLoad(function(content) {
+        if (content.classList && content.classList.contains('sample-cell')) {
+            observer.observe(content);
+        }
+        content.querySelectorAll('.sample-cell').forEach(cell => observer.observe(cell));
+    });
+});
+""",
+)
+
+SAMPLE_GRID_STYLE = static_asset(
+    "sample_grid.css",
+    """
+.sample-grid {
+    display: grid;
+    grid-template-columns: repeat(auto-fill, minmax(500px, 1fr));
+    gap: 1rem;
+}
+.sample-grid-sentinel {
+    grid-column: 1 / -1;
+}
+""",
+)
 
 
 def render_box(box: BoundingBox, max_width: int, max_height: int) -> FT:
@@ -588,26 +703,48 @@ def render_image_card(sample: ObjectDetectionSample, max_width: int = 500, max_h
     """
     return fh.Div(
         {"data-sample-id": str(sample.id)},
-        fh.Img(src=f"{sample.url}", style=f"width:{max_width}px; height:{max_height}px;"),
-        *[render_box(box, max_width, max_height) for box in suppress_stale_boxes(sample.boxes)],
+        fh.Img(
+            src=thumbnail_url(sample, max(max_width, max_height)), style=f"width:{max_width}px; height:{max_height}px;"
+        ),
+        *[render_box(box, max_width, max_height) for box in sample.boxes],
         style=f"position:relative; width:{max_width}px; height:{max_height}px;",
     )
 
 
-def render_sample_history(boxes: list[BoundingBox], sample_id: int) -> FT:
-    changes: list[BoxChange] = boxes_to_changes(boxes)
+def render_history_items(sample_id: int, history: BoxHistoryPage) -> list[FT]:
+    """
+    Render one page of the box history of a sample.
+
+    If there is more history, the page ends with a button that replaces itself with the next page.
+    """
+    items = [
+        fh.Li(
+            fh.Strong(f"{change.label_name} "),
+            f"{change.event} by {change.annotator_name} ",
+            fh.Small(change.time_delta, style=f"color: {yapml_gray_color};"),
+            style="padding: 3px 0; font-size: 0.9em;",
+        )
+        for change in history.changes
+    ]
+    if history.next_cursor is not None:
+        items.append(
+            fh.Li(
+                fh.Button(
+                    "Load more",
+                    cls="outline secondary",
+                    hx_get=f"/samples/{sample_id}/history-items?{urlencode({'cursor': history.next_cursor})}",
+                    hx_target="closest li",
+                    hx_swap="outerHTML",
+                ),
+                style="list-style: none;",
+            )
+        )
+    return items
+
+
+def render_sample_history(sample_id: int, history: BoxHistoryPage) -> FT:
     return fh.Div(
-        fh.Ul(
-            *[
-                fh.Li(
-                    fh.Strong(f"{change.label_name} "),
-                    f"{change.event} by {change.annotator_name} ",
-                    fh.Small(change.time_delta, style=f"color: {yapml_gray_color};"),
-                    style="padding: 3px 0; font-size: 0.9em;",
-                )
-                for change in changes
-            ],
-        ),
+        fh.Ul(*render_history_items(sample_id, history)),
         id="history-section",
         hx_get=f"/samples/{sample_id}/history",
         hx_trigger="boxUpdated from:body",
@@ -615,21 +752,44 @@ def render_sample_history(boxes: list[BoundingBox], sample_id: int) -> FT:
     )
 
 
-def render_sample_list_page(function_id: int, samples: list[ObjectDetectionSample]):
+def render_sample_cells(function_id: int, samples: list[ObjectDetectionSample], next_cursor: Optional[int]) -> list[FT]:
+    """
+    Render one page of the samples grid.
+
+    If there are more samples, the page ends with a sentinel that fetches the next page when it scrolls into view
+    and replaces itself with it.
+    """
+    cells = [
+        fh.Div(
+            render_image_card(sample),
+            fh.A(
+                "Details →",
+                href=f"/functions/{function_id}/samples/{sample.id}",
+                style="display:block; text-align:left; margin-top:5px;",
+            ),
+            cls="sample-cell",
+        )
+        for sample in samples
+    ]
+    if next_cursor is not None:
+        cells.append(
+            fh.Div(
+                fh.Small("Loading more samples...", style=f"color: {yapml_gray_color};"),
+                cls="sample-grid-sentinel",
+                hx_get=f"/functions/{function_id}/sample-cards?cursor={next_cursor}",
+                hx_trigger="revealed",
+                hx_swap="outerHTML",
+            )
+        )
+    return cells
+
+
+def render_sample_list_page(function_id: int, samples: list[ObjectDetectionSample], next_cursor: Optional[int] = None):
     main = fh.Main(
         fh.H1("Samples"),
-        fh.Grid(
-            *[
-                fh.Div(
-                    render_image_card(sample),
-                    fh.A(
-                        "Details →",
-                        href=f"/functions/{function_id}/samples/{sample.id}",
-                        style="display:block; text-align:left; margin-top:5px;",
-                    ),
-                )
-                for sample in samples
-            ],
+        fh.Div(
+            *render_sample_cells(function_id, samples, next_cursor),
+            cls="sample-grid",
         ),
         style="padding: 2rem;",
     )
@@ -637,14 +797,14 @@ def render_sample_list_page(function_id: int, samples: list[ObjectDetectionSampl
         main,
         function_id,
         "Samples - Yet Another ML Platform",
-        scripts=[render_drag_script(function_id)],
-        styles=[DRAG_STYLE],
+        scripts=[DRAG_SCRIPT, VIRTUAL_SCROLL_SCRIPT],
+        styles=[DRAG_STYLE, SAMPLE_GRID_STYLE],
     )
 
 
-def render_sample_details_page(function_id: int, sample: ObjectDetectionSample, boxes: list[BoundingBox]) -> FT:
+def render_sample_details_page(function_id: int, sample: ObjectDetectionSample, history_page: BoxHistoryPage) -> FT:
     assert sample.id is not None
-    history = render_sample_history(boxes, sample.id)
+    history = render_sample_history(sample.id, history_page)
     card = render_image_card(sample)
     main = fh.Main(
         fh.H1("Sample image page"),
@@ -659,6 +819,6 @@ def render_sample_details_page(function_id: int, sample: ObjectDetectionSample,
         main,
         function_id,
         "Sample details",
-        scripts=[render_drag_script(function_id)],
+        scripts=[DRAG_SCRIPT],
         styles=[DRAG_STYLE],
     )
@@ -1,8 +1,108 @@
 sqlite_file_name = "/data/database.db"
 sqlite_url = f"sqlite:///{sqlite_file_name}"
 
+# Engine profile, see db.py. The pragmas are set on every new connection, in this order.
+sqlite_pragmas = {
+    # Must come before the journal mode, to apply to a new database. Older ones are converted by the maintenance job.
+    "auto_vacuum": "INCREMENTAL",
+    "journal_mode": "WAL",  # Readers don't block the writer and vice versa.
+    "synchronous": "NORMAL",  # Safe with WAL; a power loss can only lose the latest commits.
+    "mmap_size": 256 * 1024**2,
+    "cache_size": -64 * 1024,  # Negative means KiB, so 64 MiB per connection.
+}
+sqlite_busy_timeout = 30  # Seconds a connection waits for a lock before failing.
+sqlite_reader_pool_size = 8  # Read-only connections.
+# Connections that may write. A single one serializes the read-modify-write of requests, like replacing the current
+# version of a box, which concurrent writers would race on. So sessions that write give their connection back before
+# long work that does not need it.
+sqlite_writer_pool_size = 1
+
 favicon_path = "/static/favicon.ico"
 
+# Scripts and styles of the UI, see client/assets.py.
+asset_url_prefix = "/assets"
+
+# Responses of these types are gzipped if they are at least compression_minimum_size bytes and the client accepts it.
+# Images and archives are compressed already, and streamed NDJSON results should reach the client as they are written.
+compressed_media_types = ("text/html", "text/css", "text/javascript", "application/json")
+compression_minimum_size = 1024
+
 image_dir = "/data/images"
 
 image_url_prefix = "/images"
+
+# Keyset pagination for sample listings.
+sample_page_size = 100
+max_sample_page_size = 1000
+
+# Number of sample cards per page in the samples grid. Further pages are loaded while scrolling.
+samples_grid_page_size = 24
+
+# Keyset pagination for the box history of a sample.
+box_history_page_size = 50
+max_box_history_page_size = 500
+
+# Resized derivatives of the images in image_dir, served under thumbnail_url_prefix.
+thumbnail_dir = "/data/thumbnails"
+thumbnail_url_prefix = "/thumbnails"
+thumbnail_sizes = (256, 512, 1024)
+thumbnail_format = "WEBP"
+thumbnail_cache_max_bytes = 2 * 1024**3
+
+# Batch sample ingestion.
+ingest_concurrency = 16  # Images fetched and decoded at the same time.
+ingest_chunk_size = 100  # Samples inserted per transaction.
+max_ingest_batch_size = 10000
+
+# Dataset export. Samples and boxes are fetched from the database this many rows at a time.
+export_chunk_size = 1000
+export_buffer_size = 64 * 1024  # Bytes of output collected before they are sent.
+
+# Dataset imports. Uploaded archives are extracted to import_dir, and removed once their import completes.
+import_dir = "/data/imports"
+import_batch_size = 1000  # Images of an import loaded from the database, and ingested, at a time.
+import_annotator_name = "import"
+max_import_upload_bytes = 16 * 1024**3
+
+# Bulk box creation, updates and deletion.
+box_batch_chunk_size = 1000  # Boxes written per transaction.
+max_box_batch_size = 100000
+
+# Edits of a box by the annotator that made its current version, within this many seconds of it, amend that version
+# instead of adding one, so that a drag in small steps leaves a single version. 0 keeps every edit as a version.
+box_edit_coalesce_window = 0.0
+
+# Deleting labels and functions. Rows are changed this many at a time, one transaction per chunk, and deletions of
+# more rows than max_inline_delete_rows run as background jobs.
+delete_chunk_size = 1000
+max_inline_delete_rows = 10000
+
+# Background jobs, see jobs.py. Workers are threads of the server process, which look for due jobs every
+# job_poll_interval seconds, and right away when a job is queued. Failed jobs are retried up to job_max_attempts times,
+# after job_retry_delay seconds times the number of attempts so far.
+job_worker_count = 2
+job_poll_interval = 5.0
+job_max_attempts = 3
+job_retry_delay = 10.0
+
+# Database maintenance, see maintenance.py. Runs as a job every maintenance_interval seconds, or when asked for through
+# POST /api/detection/maintenance. Replaced box versions older than box_history_retention_days are compacted.
+maintenance_interval = 24 * 3600.0
+box_history_retention_days = 30
+sqlite_analysis_limit = 1000  # Rows per index that ANALYZE looks at. Approximate statistics are enough for the planner.
+
+# Remote image fetching.
+image_fetch_timeout = 10  # Seconds.
+image_fetch_max_connections = 64
+image_fetch_per_host_limit = 8  # Concurrent downloads from a single host.
+max_image_bytes = 64 * 1024**2
+
+# How ObjectDetectionSample.image_hash is computed, and thereby which images count as duplicates:
+#  "blake2b": a streaming hash of the encoded file bytes. Cheap, no decoding needed.
+#  "pixel-md5": md5 of the decoded pixels. Also catches re-encodings of identical pixels, but needs a full decode.
+# After changing this, re-key existing samples with POST /api/detection/rehash-images.
+image_hash_strategy = "blake2b"
+
+# Near-duplicate detection. Two images are near-duplicates if their 64-bit perceptual hashes differ in at most this
+# many bits.
+near_duplicate_radius = 4
@@ -1,9 +1,14 @@
 import re
 from datetime import datetime
 from enum import Enum, IntEnum
-from typing import Optional
+from itertools import chain
+from typing import Iterable, Optional, Union
 
 from pydantic import AfterValidator, BaseModel
+from sqlalchemy import Connection, Index, event, select, text, update
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.orm import Session
+from sqlalchemy.orm.attributes import set_committed_value
 from sqlmodel import Field, Relationship, SQLModel
 from typing_extensions import Annotated
 
@@ -27,6 +32,9 @@ class YapFunction(SQLModel, table=True):
     boxes: list["BoundingBox"] = Relationship(
         back_populates="function", sa_relationship_kwargs={"cascade": "all, delete-orphan"}
     )
+    imports: list["ImportRun"] = Relationship(
+        back_populates="function", sa_relationship_kwargs={"cascade": "all, delete-orphan"}
+    )
 
 
 def is_valid_hex_color(v: str) -> str:
@@ -42,6 +50,8 @@ def is_valid_label_name(v: str) -> str:
 
 
 class Label(SQLModel, table=True):
+    __table_args__ = (Index("ix_label_function_id_deleted_at", "function_id", "deleted_at"),)
+
     id: Optional[int] = Field(default=None, primary_key=True)
     function_id: int = Field(foreign_key="yapfunction.id")
     name: Annotated[str, AfterValidator(is_valid_label_name)] = Field(unique=True)
@@ -49,7 +59,7 @@ class Label(SQLModel, table=True):
     boxes: list["BoundingBox"] = Relationship(
         back_populates="label",
         sa_relationship_kwargs={
-            "primaryjoin": "and_(Label.id == BoundingBox.label_id, BoundingBox.deleted_at.is_(None))",
+            "primaryjoin": "and_(Label.id == BoundingBox.label_id, BoundingBox.is_head)",
         },
     )
     function: "YapFunction" = Relationship(back_populates="labels")
@@ -69,6 +79,22 @@ def is_valid_box_size_range(v: float) -> float:
 
 
 class BoundingBox(SQLModel, table=True):
+    # Indexes for the hot read paths: current boxes per sample, label and function, and the box history. The label
+    # index covers the label statistics, so counting boxes per label and annotator does not read the table.
+    __table_args__ = (
+        Index("ix_boundingbox_sample_id_is_head", "sample_id", "is_head"),
+        Index(
+            "ix_boundingbox_label_id_is_head_annotator_name_sample_id",
+            "label_id",
+            "is_head",
+            "annotator_name",
+            "sample_id",
+        ),
+        Index("ix_boundingbox_function_id_is_head", "function_id", "is_head"),
+        Index("ix_boundingbox_sample_id_deleted_at", "sample_id", "deleted_at"),
+        Index("ix_boundingbox_function_id_deleted_at", "function_id", "deleted_at"),
+    )
+
     id: Optional[int] = Field(default=None, primary_key=True)
     sample_id: int = Field(foreign_key="objectdetectionsample.id")
     function_id: int = Field(foreign_key="yapfunction.id")
@@ -81,11 +107,52 @@ class BoundingBox(SQLModel, table=True):
     created_at: datetime = Field(default_factory=datetime.now)
     deleted_at: Optional[datetime] = Field(default=None)
     previous_box_id: Optional[int] = Field(default=None, foreign_key="boundingbox.id", unique=True)
+    # All versions of a box share the id of the first version as lineage_id, and count up from version 1.
+    lineage_id: Optional[int] = Field(default=None, index=True)
+    version: int = Field(default=1)
+    # True for the current version of a box, until it is deleted. Kept up to date by the writes.
+    is_head: bool = Field(default=True)
     sample: "ObjectDetectionSample" = Relationship(back_populates="boxes")
     label: Label = Relationship(back_populates="boxes")
     function: "YapFunction" = Relationship(back_populates="boxes")
 
 
+@event.listens_for(BoundingBox, "after_insert")
+def materialize_box_lineage(mapper, connection, box: BoundingBox) -> None:
+    """
+    Fill in lineage_id and version of boxes inserted without them, from the previous version of the box, and take
+    the previous version off head. update_box sets all of these itself.
+    """
+    table = BoundingBox.__table__  # type: ignore
+    values = {}
+    if box.lineage_id is None:
+        values["lineage_id"], values["version"] = box.id, 1
+        if box.previous_box_id is not None:
+            previous = connection.execute(
+                select(table.c.id, table.c.lineage_id, table.c.version).where(table.c.id == box.previous_box_id)
+            ).one()
+            values["lineage_id"], values["version"] = previous.lineage_id or previous.id, previous.version + 1
+            connection.execute(update(table).where(table.c.id == box.previous_box_id).values(is_head=False))
+    if box.deleted_at is not None and box.is_head:
+        values["is_head"] = False
+    if values:
+        connection.execute(update(table).where(table.c.id == box.id).values(**values))
+        for key, value in values.items():
+            set_committed_value(box, key, value)
+
+
+class LabelSummary(BaseModel):
+    """A label with counts of its current boxes, of the samples they are on, and of the boxes of each annotator."""
+
+    id: int
+    function_id: int
+    name: str
+    color: str
+    box_count: int = 0
+    sample_count: int = 0
+    annotator_box_counts: dict[str, int] = {}
+
+
 class BoxChange(BaseModel):
     label_name: str
     annotator_name: str
@@ -93,9 +160,9 @@ class BoxChange(BaseModel):
     time_delta: str
 
 
-def suppress_stale_boxes(boxes: list[BoundingBox]) -> list[BoundingBox]:
-    stale_box_ides = set([box.previous_box_id for box in boxes if box.previous_box_id is not None])
-    return [box for box in boxes if box.id not in stale_box_ides]
+class BoxHistoryPage(BaseModel):
+    changes: list[BoxChange]
+    next_cursor: Optional[str] = None
 
 
 def is_valid_height_width(v: int) -> int:
@@ -105,11 +172,16 @@ def is_valid_height_width(v: int) -> int:
 
 
 class ObjectDetectionSample(SQLModel, table=True):
+    # Samples are listed per function in id order.
+    __table_args__ = (Index("ix_objectdetectionsample_function_id_id", "function_id", "id"),)
+
     id: Optional[int] = Field(default=None, primary_key=True)
     function_id: int = Field(foreign_key="yapfunction.id")
     url: str
     key: Optional[str] = Field(default=None)  # Optional key for the sample
     image_hash: Optional[str] = Field(default=None, index=True, unique=True)  # Optional hash for the sample
+    perceptual_hash: Optional[str] = Field(default=None)  # 64-bit dHash as hex, for near-duplicate detection
+    mime_type: Optional[str] = Field(default=None)  # Sniffed from the image when it was stored, e.g. "image/png"
     width: Optional[Annotated[int, AfterValidator(is_valid_height_width)]] = Field(default=None)
     height: Optional[Annotated[int, AfterValidator(is_valid_height_width)]] = Field(default=None)
     created_at: datetime = Field(default_factory=datetime.now)
@@ -117,7 +189,159 @@ class ObjectDetectionSample(SQLModel, table=True):
     boxes: list[BoundingBox] = Relationship(
         back_populates="sample",
         sa_relationship_kwargs={
-            "primaryjoin": "and_(BoundingBox.sample_id == ObjectDetectionSample.id, BoundingBox.deleted_at.is_(None))",
+            "primaryjoin": "and_(BoundingBox.sample_id == ObjectDetectionSample.id, BoundingBox.is_head)",
         },
     )
     function: "YapFunction" = Relationship(back_populates="samples")
+
+
+class ImportRun(SQLModel, table=True):
+    """
+    An import of a COCO or YOLO dataset into a function. The images to import are listed as ImportItems first, so
+    that an interrupted import can be resumed where it stopped.
+    """
+
+    __table_args__ = (Index("ix_importrun_function_id_id", "function_id", "id"),)
+
+    id: Optional[int] = Field(default=None, primary_key=True)
+    function_id: int = Field(foreign_key="yapfunction.id")
+    source_format: str  # "coco" or "yolo"
+    source_path: str  # The COCO annotation file or the YOLO directory, on the server.
+    images_dir: Optional[str] = Field(default=None)  # Where COCO file names are relative to, if not next to the file.
+    upload_dir: Optional[str] = Field(default=None)  # The extracted upload, if the dataset was uploaded.
+    # One of "pending", "running", "completed" or "failed". A "running" import whose process died stays "running".
+    status: str = Field(default="pending")
+    planned: bool = Field(default=False)  # True once all images are listed as items.
+    total_images: int = Field(default=0)
+    processed_images: int = Field(default=0)
+    created_samples: int = Field(default=0)
+    duplicate_images: int = Field(default=0)
+    failed_images: int = Field(default=0)
+    created_boxes: int = Field(default=0)
+    error: Optional[str] = Field(default=None)
+    created_at: datetime = Field(default_factory=datetime.now)
+    # Start of the latest attempt, and how many images had been processed before it, to measure throughput.
+    started_at: Optional[datetime] = Field(default=None)
+    processed_before_start: int = Field(default=0)
+    boxes_before_start: int = Field(default=0)
+    finished_at: Optional[datetime] = Field(default=None)
+    function: YapFunction = Relationship(back_populates="imports")
+    items: list["ImportItem"] = Relationship(
+        back_populates="run", sa_relationship_kwargs={"cascade": "all, delete-orphan"}
+    )
+
+
+class ImportItem(SQLModel, table=True):
+    """One image of an import, with its boxes, and what became of it."""
+
+    # Pending items are processed in id order.
+    __table_args__ = (Index("ix_importitem_import_run_id_status_id", "import_run_id", "status", "id"),)
+
+    id: Optional[int] = Field(default=None, primary_key=True)
+    import_run_id: int = Field(foreign_key="importrun.id")
+    source: str  # Path or url of the image.
+    key: str  # The file name of the image in the dataset, which becomes the key of its sample.
+    width: Optional[int] = Field(default=None)
+    height: Optional[int] = Field(default=None)
+    # JSON list of [label_id, center_x, center_y, width, height], relative to the image size.
+    boxes: str = Field(default="[]")
+    status: str = Field(default="pending")  # One of "pending", "created", "duplicate" or "error".
+    sample_id: Optional[int] = Field(default=None)
+    detail: Optional[str] = Field(default=None)
+    run: ImportRun = Relationship(back_populates="items")
+
+
+# Statuses of the jobs that are still to be done.
+ACTIVE_JOB_STATUSES = ("queued", "running")
+
+
+class Job(SQLModel, table=True):
+    """
+    A long-running operation, queued for the job runner in jobs.py. Jobs of the same kind with the same key, e.g. the
+    deletions of one function, are not queued twice.
+    """
+
+    # Queued jobs are claimed in id order once they are due, and active jobs are looked up by key. A kind and key have
+    # at most one active job, even if two processes queue it at the same time.
+    __table_args__ = (
+        Index("ix_job_status_run_after_id", "status", "run_after", "id"),
+        Index("ix_job_kind_key_status", "kind", "key", "status"),
+        Index(
+            "ix_job_kind_key_active",
+            "kind",
+            "key",
+            unique=True,
+            sqlite_where=text("status IN ({})".format(", ".join(f"'{status}'" for status in ACTIVE_JOB_STATUSES))),
+        ),
+    )
+
+    id: Optional[int] = Field(default=None, primary_key=True)
+    kind: str  # One of the handlers in jobs.JOB_HANDLERS.
+    key: Optional[str] = Field(default=None)
+    params: str = Field(default="{}")  # JSON object of arguments for the handler.
+    # One of "queued", "running", "completed", "failed" or "cancelled".
+    status: str = Field(default="queued")
+    progress: int = Field(default=0)
+    total: Optional[int] = Field(default=None)
+    attempts: int = Field(default=0)
+    max_attempts: int = Field(default=1)
+    cancel_requested: bool = Field(default=False)
+    error: Optional[str] = Field(default=None)
+    result: Optional[str] = Field(default=None)  # JSON object returned by the handler, e.g. a report.
+    created_at: datetime = Field(default_factory=datetime.now)
+    run_after: datetime = Field(default_factory=datetime.now)  # Retries wait a while before they are claimed again.
+    started_at: Optional[datetime] = Field(default=None)
+    finished_at: Optional[datetime] = Field(default=None)
+
+
+class FunctionGeneration(SQLModel, table=True):
+    """
+    A counter of the writes to a function, its samples, boxes and labels, that read endpoints derive ETags from. The
+    row of function id 0 counts the writes to all functions. Rows are never deleted, so a generation never repeats.
+    """
+
+    function_id: int = Field(primary_key=True, sa_column_kwargs={"autoincrement": False})
+    generation: int = Field(default=0)
+
+
+ALL_FUNCTIONS = 0
+
+
+def bump_generations(connection: Union[Connection, Session], function_ids: Iterable[Optional[int]]) -> None:
+    """Increment the generations of the functions, and of all functions, in the transaction of `connection`."""
+    ids = {function_id for function_id in function_ids if function_id is not None}
+    if not ids:
+        return
+    table = FunctionGeneration.__table__  # type: ignore
+    statement = sqlite_insert(table).on_conflict_do_update(
+        index_elements=[table.c.function_id], set_={"generation": table.c.generation + 1}
+    )
+    connection.execute(statement, [{"function_id": function_id, "generation": 1} for function_id in {0, *ids}])
+
+
+def bump_all_generations(connection: Union[Connection, Session]) -> None:
+    """Increment every generation, e.g. after the database was reset."""
+    table = FunctionGeneration.__table__  # type: ignore
+    connection.execute(update(table).values(generation=table.c.generation + 1))
+    connection.execute(sqlite_insert(table).values(function_id=ALL_FUNCTIONS, generation=1).on_conflict_do_nothing())
+
+
+def function_generation(session: Session, function_id: Optional[int]) -> int:
+    """The generation of a function, or of all functions for None."""
+    table = FunctionGeneration.__table__  # type: ignore
+    generation = session.execute(
+        select(table.c.generation).where(table.c.function_id == (function_id or ALL_FUNCTIONS))
+    ).scalar()
+    return generation or 0
+
+
+@event.listens_for(Session, "after_flush")
+def bump_flushed_generations(session: Session, flush_context) -> None:
+    """Count the writes made through the ORM. Code that writes with Core statements calls bump_generations itself."""
+    function_ids = set()
+    for instance in chain(session.new, session.dirty, session.deleted):
+        if isinstance(instance, YapFunction):
+            function_ids.add(instance.id)
+        elif isinstance(instance, (Label, ObjectDetectionSample, BoundingBox)):
+            function_ids.add(instance.function_id)
+    bump_generations(session.connection(), function_ids)
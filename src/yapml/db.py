@@ -1,22 +1,85 @@
+from contextlib import contextmanager
+from typing import Iterator
+
 from fastapi import Request
+from sqlalchemy import Engine, event
 from sqlmodel import Session, create_engine
 
-from yapml.config import sqlite_url
-
-engine = create_engine(
+from yapml.config import (
+    sqlite_busy_timeout,
+    sqlite_pragmas,
+    sqlite_reader_pool_size,
     sqlite_url,
-    echo=False,  # Set to False in production to avoid logging all SQL statements
-    connect_args={
-        "check_same_thread": False,  # Allows multiple threads to access the database
-        "timeout": 30,  # Adds timeout for busy connections
-    },
-    pool_pre_ping=True,  # Validates connections before using them
-    pool_recycle=3600,  # Recycle connections after 1 hour
+    sqlite_writer_pool_size,
 )
 
 
-def get_session(request: Request):
+def create_sqlite_engine(
+    url: str,
+    read_only: bool = False,
+    pool_size: int = sqlite_writer_pool_size,
+    pragmas: dict[str, object] = sqlite_pragmas,
+) -> Engine:
+    """
+    Create an engine for a SQLite file that sets `pragmas` on every new connection.
+
+    A read-only engine's connections refuse to write. The journal mode is a property of the database file, so it is
+    only set by writers.
+    """
+    engine = create_engine(
+        url,
+        echo=False,  # Set to False in production to avoid logging all SQL statements
+        connect_args={
+            "check_same_thread": False,  # Allows multiple threads to access the database
+            "timeout": sqlite_busy_timeout,  # Wait for locks instead of failing right away
+        },
+        pool_size=pool_size,
+        max_overflow=0,
+    )
+
+    @event.listens_for(engine, "connect")
+    def set_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for name, value in pragmas.items():
+            if read_only and name == "journal_mode":
+                continue
+            cursor.execute(f"PRAGMA {name} = {value}")
+        if read_only:
+            cursor.execute("PRAGMA query_only = ON")
+        cursor.close()
+
+    return engine
+
 
-    with Session(engine) as session:
+# Write requests and jobs share the writer pool, whose single connection makes them take turns: a session has it from
+# its first query until it commits or closes. SQLite allows one writer at a time anyway, and this way a request that
+# reads a row and then writes based on it can not interleave with another. Readers use their own pool and, in WAL mode,
+# never wait for the writer.
+engine = create_sqlite_engine(sqlite_url)
+read_engine = create_sqlite_engine(sqlite_url, read_only=True, pool_size=sqlite_reader_pool_size)
+
+READ_ONLY_METHODS = {"GET", "HEAD", "OPTIONS"}
+
+
+def get_session(request: Request):
+    session_engine = read_engine if request.method in READ_ONLY_METHODS else engine
+    with Session(session_engine) as session:
         request.state.session = session
         yield session
+
+
+@contextmanager
+def read_snapshot(session: Session) -> Iterator[Session]:
+    """
+    Make the queries of `session` in the block read one snapshot of the database. pysqlite only begins a transaction
+    before a write, so without one every SELECT sees the latest commit. Ends the transaction with a rollback.
+    """
+    connection = session.connection()
+    if connection.connection.dbapi_connection.in_transaction:  # type: ignore
+        yield session  # A transaction is open already, and with it a snapshot.
+        return
+    connection.exec_driver_sql("BEGIN")
+    try:
+        yield session
+    finally:
+        session.rollback()
@@ -0,0 +1,156 @@
+"""
+Delete labels and functions with set-based statements, a chunk of rows at a time.
+
+Each chunk is a single UPDATE or DELETE of at most `delete_chunk_size` rows that are found through an index, and is
+committed on its own, so the write lock is released between chunks and other writes are not held up for the whole
+deletion. A deletion that stops halfway can simply be started again, it continues with the rows that are left.
+
+Deletions of more than `max_inline_delete_rows` rows run as background jobs, see jobs.py. A label that such a job
+is deleting takes no new boxes.
+"""
+
+from datetime import datetime
+from typing import Callable, Literal, Optional
+
+from sqlalchemy import ColumnElement, Table, delete, exists, func, update
+from sqlmodel import Session, select
+
+from yapml.config import delete_chunk_size
+from yapml.datamodel import (
+    ACTIVE_JOB_STATUSES,
+    BoundingBox,
+    ImportItem,
+    ImportRun,
+    Job,
+    Label,
+    ObjectDetectionSample,
+    YapFunction,
+    bump_generations,
+)
+from yapml.near_duplicates import near_duplicate_registry
+
+DeletionTarget = Literal["label", "function"]
+
+ChunkCallback = Callable[[int], None]
+
+
+def deletion_key(target: DeletionTarget, target_id: int) -> str:
+    """The key of the job that deletes a target, so that a target is deleted by one job at a time."""
+    return f"{target}:{target_id}"
+
+
+def label_deletion_pending(label_id: ColumnElement[int]) -> ColumnElement[bool]:
+    """Whether a queued or running job is deleting the label. Boxes added meanwhile could outlive the label."""
+    return exists().where(
+        Job.kind == "delete",
+        Job.key == func.printf("label:%d", label_id),  # deletion_key, in SQL
+        Job.status.in_(ACTIVE_JOB_STATUSES),  # type: ignore
+    )
+
+
+def label_box_condition(label_id: int) -> ColumnElement[bool]:
+    return (BoundingBox.label_id == label_id) & BoundingBox.is_head  # type: ignore
+
+
+def function_rows(function_id: int) -> list[tuple[Table, ColumnElement[bool]]]:
+    """The tables with rows of a function and the condition that selects them, rows that refer to others first."""
+    import_runs = select(ImportRun.id).where(ImportRun.function_id == function_id)
+    return [
+        (BoundingBox.__table__, BoundingBox.function_id == function_id),  # type: ignore
+        (ImportItem.__table__, ImportItem.import_run_id.in_(import_runs)),  # type: ignore
+        (ImportRun.__table__, ImportRun.function_id == function_id),  # type: ignore
+        (ObjectDetectionSample.__table__, ObjectDetectionSample.function_id == function_id),  # type: ignore
+        (Label.__table__, Label.function_id == function_id),  # type: ignore
+        (YapFunction.__table__, YapFunction.id == function_id),  # type: ignore
+    ]
+
+
+def count_rows(session: Session, table: Table, condition: ColumnElement[bool]) -> int:
+    return session.exec(select(func.count()).select_from(table).where(condition)).one()
+
+
+def count_label_rows(session: Session, label_id: int) -> int:
+    """The number of rows that deleting a label changes: its current boxes, and the label itself."""
+    return count_rows(session, BoundingBox.__table__, label_box_condition(label_id)) + 1  # type: ignore
+
+
+def count_function_rows(session: Session, function_id: int) -> int:
+    return sum(count_rows(session, table, condition) for table, condition in function_rows(function_id))
+
+
+def change_in_chunks(
+    session: Session,
+    table: Table,
+    condition: ColumnElement[bool],
+    function_id: int,
+    values: Optional[dict] = None,
+    chunk_size: int = delete_chunk_size,
+    on_chunk: Optional[ChunkCallback] = None,
+) -> int:
+    """
+    Delete the rows of `table` that match `condition`, or update them with `values`, chunk by chunk, and bump the
+    generation of the function they belong to with every chunk. The update must make the rows stop matching, or this
+    never ends. Returns the number of rows changed.
+    """
+    changed = 0
+    while True:
+        chunk = select(table.c.id).where(condition).limit(chunk_size).scalar_subquery()
+        statement = update(table).values(**values) if values is not None else delete(table)
+        count = session.execute(statement.where(table.c.id.in_(chunk))).rowcount  # type: ignore
+        if count:
+            bump_generations(session, [function_id])
+        session.commit()
+        if count == 0:
+            return changed
+        changed += count
+        if on_chunk:
+            on_chunk(count)
+
+
+def delete_label_rows(
+    session: Session, label_id: int, chunk_size: int = delete_chunk_size, on_chunk: Optional[ChunkCallback] = None
+) -> int:
+    """
+    Delete the current boxes of a label, then mark the label deleted. The boxes keep their history like boxes deleted
+    one at a time. The label goes last, so that a deletion that stops halfway leaves a label with fewer boxes, never
+    boxes of a deleted label, and can be started again.
+    """
+    now = datetime.now()
+    function_id = session.exec(select(Label.function_id).where(Label.id == label_id)).one()
+    boxes = change_in_chunks(
+        session,
+        BoundingBox.__table__,  # type: ignore
+        label_box_condition(label_id),
+        function_id,
+        values={"deleted_at": now, "is_head": False},
+        chunk_size=chunk_size,
+        on_chunk=on_chunk,
+    )
+    table: Table = Label.__table__  # type: ignore
+    session.execute(update(table).where(table.c.id == label_id).values(deleted_at=now))
+    bump_generations(session, [function_id])
+    session.commit()
+    if on_chunk:
+        on_chunk(1)
+    return boxes + 1
+
+
+def delete_function_rows(
+    session: Session, function_id: int, chunk_size: int = delete_chunk_size, on_chunk: Optional[ChunkCallback] = None
+) -> int:
+    """
+    Delete a function with its boxes, imports, samples and labels. The function row goes last, so that the function
+    can be deleted again if this stops halfway.
+    """
+    deleted = 0
+    for table, condition in function_rows(function_id):
+        deleted += change_in_chunks(session, table, condition, function_id, chunk_size=chunk_size, on_chunk=on_chunk)
+    near_duplicate_registry.invalidate(function_id)
+    return deleted
+
+
+DELETERS: dict[DeletionTarget, Callable[..., int]] = {"label": delete_label_rows, "function": delete_function_rows}
+ROW_COUNTERS: dict[DeletionTarget, Callable[[Session, int], int]] = {
+    "label": count_label_rows,
+    "function": count_function_rows,
+}
@@ -0,0 +1,322 @@
+"""
+Export the current boxes of a function as a COCO, YOLO or Pascal VOC dataset.
+
+Exports are generators of bytes, to be streamed as a response. Samples and their boxes are read with a server-side
+cursor in sample id order, one sample at a time, so memory use does not grow with the size of the function and the
+first bytes are produced right away. Archives are written by zipfile to a non-seekable stream, which puts the sizes of
+each member after its data. The one thing that does grow is the archive's central directory, which zipfile keeps in
+memory until the end, at a few hundred bytes per file.
+"""
+
+import json
+import os
+import time
+import zipfile
+from dataclasses import dataclass, field
+from functools import cached_property
+from itertools import groupby
+from typing import Iterable, Iterator, Literal, Optional, Union
+from xml.etree import ElementTree
+
+from PIL import Image as PILImage
+from sqlalchemy import and_
+from sqlmodel import Session, select
+
+from yapml.config import export_buffer_size, export_chunk_size, image_dir
+from yapml.datamodel import BoundingBox, Label, ObjectDetectionSample, YapFunction
+
+ExportFormat = Literal["coco", "yolo", "voc"]
+
+# Where each format puts the images in an archive.
+IMAGE_FOLDERS = {"coco": "images", "yolo": "images", "voc": "JPEGImages"}
+
+# Leading bytes of the image formats we expect, and the file extension to give them.
+IMAGE_SIGNATURES = {
+    b"\xff\xd8\xff": ".jpg",
+    b"\x89PNG": ".png",
+    b"GIF8": ".gif",
+    b"BM": ".bmp",
+    b"II*\x00": ".tif",
+    b"MM\x00*": ".tif",
+}
+
+
+@dataclass
+class ExportBox:
+    id: int
+    label_id: int
+    center_x: float
+    center_y: float
+    width: float
+    height: float
+
+
+@dataclass
+class ExportSample:
+    id: int
+    width: int
+    height: int
+    image_path: Optional[str]  # None if the image is not stored in image_dir.
+    source_name: str  # The key or url of the sample.
+    boxes: list[ExportBox] = field(default_factory=list)
+
+    @cached_property
+    def file_name(self) -> str:
+        """The sample id, with the extension of the image format. Stored images have no extension themselves."""
+        if self.image_path is not None:
+            return f"{self.id}{image_extension(self.image_path)}"
+        return f"{self.id}{os.path.splitext(self.source_name)[1]}"
+
+    def box_corners(self, box: ExportBox) -> tuple[float, float, float, float]:
+        """The box as (x_min, y_min, x_max, y_max) in pixels."""
+        return (
+            (box.center_x - box.width / 2) * self.width,
+            (box.center_y - box.height / 2) * self.height,
+            (box.center_x + box.width / 2) * self.width,
+            (box.center_y + box.height / 2) * self.height,
+        )
+
+
+def image_extension(path: str) -> str:
+    with open(path, "rb") as file:
+        header = file.read(12)
+    if header[:4] == b"RIFF" and header[8:12] == b"WEBP":
+        return ".webp"
+    for signature, extension in IMAGE_SIGNATURES.items():
+        if header.startswith(signature):
+            return extension
+    try:
+        with PILImage.open(path) as image:
+            return f".{image.format.lower()}" if image.format else ""
+    except OSError:
+        return ""
+
+
+def export_sample(row) -> ExportSample:
+    image_path = f"{image_dir}/{row.image_hash}" if row.image_hash else None
+    if image_path is not None and not os.path.exists(image_path):
+        image_path = None
+    # Boxes are stored relative to the image size. Without known dimensions the coordinates stay relative.
+    return ExportSample(
+        id=row.id,
+        width=row.width or 1,
+        height=row.height or 1,
+        image_path=image_path,
+        source_name=row.key or row.url,
+    )
+
+
+def iterate_samples(session: Session, function_id: int) -> Iterator[ExportSample]:
+    """
+    Yield the samples of a function with their current boxes, in sample id order. Boxes of deleted labels are left
+    out, as those labels are not exported. A label deletion that stopped halfway can leave some behind.
+    """
+    labels = select(Label.id).where(Label.function_id == function_id, Label.deleted_at.is_(None))  # type: ignore
+    query = (
+        select(
+            ObjectDetectionSample.id,
+            ObjectDetectionSample.width,
+            ObjectDetectionSample.height,
+            ObjectDetectionSample.image_hash,
+            ObjectDetectionSample.url,
+            ObjectDetectionSample.key,
+            BoundingBox.id.label("box_id"),  # type: ignore
+            BoundingBox.label_id,
+            BoundingBox.center_x,
+            BoundingBox.center_y,
+            BoundingBox.width.label("box_width"),  # type: ignore
+            BoundingBox.height.label("box_height"),  # type: ignore
+        )
+        .outerjoin(
+            BoundingBox,
+            and_(
+                BoundingBox.sample_id == ObjectDetectionSample.id,
+                BoundingBox.is_head,
+                BoundingBox.label_id.in_(labels),  # type: ignore
+            ),
+        )
+        .where(ObjectDetectionSample.function_id == function_id, ObjectDetectionSample.deleted_at.is_(None))  # type: ignore
+        .order_by(ObjectDetectionSample.id)
+        .execution_options(yield_per=export_chunk_size)
+    )
+    for _, group in groupby(session.exec(query), key=lambda row: row.id):
+        rows = list(group)
+        sample = export_sample(rows[0])
+        for row in rows:
+            if row.box_id is not None:
+                sample.boxes.append(
+                    ExportBox(row.box_id, row.label_id, row.center_x, row.center_y, row.box_width, row.box_height)
+                )
+        yield sample
+
+
+def iterate_file(path: str, chunk_size: int = 1024**2) -> Iterator[bytes]:
+    with open(path, "rb") as file:
+        while chunk := file.read(chunk_size):
+            yield chunk
+
+
+class ZipStream:
+    """A write-only file that collects what zipfile writes to it, until it is drained."""
+
+    def __init__(self):
+        self.chunks: list[bytes] = []
+
+    def write(self, data) -> int:
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self) -> None:
+        pass
+
+    def drain(self) -> bytes:
+        data = b"".join(self.chunks)
+        self.chunks.clear()
+        return data
+
+
+# A member of an archive: its name, and its content or an iterator over its content.
+ZipMember = tuple[str, Union[bytes, Iterator[bytes]]]
+
+
+def stream_zip(members: Iterable[ZipMember], stored_prefixes: tuple[str, ...] = ()) -> Iterator[bytes]:
+    """
+    Write the members to a zip archive and yield the archive as it is written.
+
+    Members whose name starts with one of `stored_prefixes` are stored without compression, e.g. images, which are
+    compressed already.
+    """
+    stream = ZipStream()
+    with zipfile.ZipFile(stream, "w", compression=zipfile.ZIP_DEFLATED) as archive:
+        for name, content in members:
+            info = zipfile.ZipInfo(name, date_time=time.localtime()[:6])
+            info.compress_type = zipfile.ZIP_STORED if name.startswith(stored_prefixes) else zipfile.ZIP_DEFLATED
+            if isinstance(content, bytes):
+                archive.writestr(info, content)
+            else:
+                # The size is not known up front, so always leave room for more than 4 GiB.
+                with archive.open(info, "w", force_zip64=True) as member:
+                    for chunk in content:
+                        member.write(chunk)
+                        if stream.chunks:
+                            yield stream.drain()
+            if stream.chunks:
+                yield stream.drain()
+    yield stream.drain()  # The central directory.
+
+
+def coco_chunks(session: Session, function: YapFunction, labels: list[Label]) -> Iterator[bytes]:
+    """
+    COCO detection JSON. Images and annotations are separate arrays, so the samples are read twice. Run it in a
+    read_snapshot for both passes to see the same samples.
+
+    Category ids are label ids, image ids are sample ids and annotation ids are box ids.
+    """
+    header = {
+        "info": {"description": function.name, "date_created": function.created_at.isoformat()},
+        "categories": [{"id": label.id, "name": label.name} for label in labels],
+    }
+    yield json.dumps(header)[:-1].encode() + b', "images": ['
+    for i, sample in enumerate(iterate_samples(session, function.id)):  # type: ignore
+        image = {"id": sample.id, "file_name": sample.file_name, "width": sample.width, "height": sample.height}
+        yield (", " if i else "").encode() + json.dumps(image).encode()
+    yield b'], "annotations": ['
+    first = True
+    for sample in iterate_samples(session, function.id):  # type: ignore
+        annotations = []
+        for box in sample.boxes:
+            x_min, y_min, x_max, y_max = sample.box_corners(box)
+            width, height = x_max - x_min, y_max - y_min
+            annotations.append(
+                json.dumps(
+                    {
+                        "id": box.id,
+                        "image_id": sample.id,
+                        "category_id": box.label_id,
+                        "bbox": [x_min, y_min, width, height],
+                        "area": width * height,
+                        "iscrowd": 0,
+                    }
+                )
+            )
+        if annotations:
+            yield ("" if first else ", ").encode() + ", ".join(annotations).encode()
+            first = False
+    yield b"]}"
+
+
+def yolo_label_file(sample: ExportSample, class_indexes: dict[int, int]) -> bytes:
+    lines = [
+        f"{class_indexes[box.label_id]} {box.center_x:.6f} {box.center_y:.6f} {box.width:.6f} {box.height:.6f}\n"
+        for box in sample.boxes
+    ]
+    return "".join(lines).encode()
+
+
+def voc_annotation(sample: ExportSample, folder: str, label_names: dict[int, str]) -> bytes:
+    annotation = ElementTree.Element("annotation")
+    ElementTree.SubElement(annotation, "folder").text = folder
+    ElementTree.SubElement(annotation, "filename").text = sample.file_name
+    size = ElementTree.SubElement(annotation, "size")
+    ElementTree.SubElement(size, "width").text = str(sample.width)
+    ElementTree.SubElement(size, "height").text = str(sample.height)
+    ElementTree.SubElement(size, "depth").text = "3"
+    for box in sample.boxes:
+        element = ElementTree.SubElement(annotation, "object")
+        ElementTree.SubElement(element, "name").text = label_names[box.label_id]
+        ElementTree.SubElement(element, "difficult").text = "0"
+        bndbox = ElementTree.SubElement(element, "bndbox")
+        for name, value in zip(("xmin", "ymin", "xmax", "ymax"), sample.box_corners(box)):
+            ElementTree.SubElement(bndbox, name).text = str(round(value))
+    return ElementTree.tostring(annotation, encoding="utf-8")
+
+
+def dataset_members(
+    session: Session, function: YapFunction, labels: list[Label], export_format: ExportFormat, images: bool
+) -> Iterator[ZipMember]:
+    if export_format == "coco":
+        yield "annotations.json", coco_chunks(session, function, labels)
+        if images:
+            for sample in iterate_samples(session, function.id):  # type: ignore
+                if sample.image_path is not None:
+                    yield f"images/{sample.file_name}", iterate_file(sample.image_path)
+        return
+
+    image_folder = IMAGE_FOLDERS[export_format]
+    if export_format == "yolo":
+        # YOLO classes are numbered from 0, in the order of classes.txt.
+        class_indexes = {label.id: i for i, label in enumerate(labels)}
+        yield "classes.txt", "".join(f"{label.name}\n" for label in labels).encode()
+    label_names = {label.id: label.name for label in labels}
+    for sample in iterate_samples(session, function.id):  # type: ignore
+        if images and sample.image_path is not None:
+            yield f"{image_folder}/{sample.file_name}", iterate_file(sample.image_path)
+        if export_format == "yolo":
+            yield f"labels/{sample.id}.txt", yolo_label_file(sample, class_indexes)
+        else:
+            yield f"Annotations/{sample.id}.xml", voc_annotation(sample, image_folder, label_names)
+
+
+def export_dataset(
+    session: Session, function: YapFunction, labels: list[Label], export_format: ExportFormat, images: bool = False
+) -> Iterator[bytes]:
+    """
+    Export the current boxes of a function. COCO without images is a single JSON document, everything else a zip
+    archive, with the images from image_dir if `images` is set. Labels are the categories, in the given order.
+    """
+    if export_format == "coco" and not images:
+        return buffered(coco_chunks(session, function, labels))
+    stored_prefixes = (f"{IMAGE_FOLDERS[export_format]}/",)
+    return buffered(stream_zip(dataset_members(session, function, labels, export_format, images), stored_prefixes))
+
+
+def buffered(chunks: Iterable[bytes], size: int = export_buffer_size) -> Iterator[bytes]:
+    """Join small chunks into chunks of at least `size` bytes, except for the last one."""
+    buffer = bytearray()
+    for chunk in chunks:
+        buffer += chunk
+        if len(buffer) >= size:
+            yield bytes(buffer)
+            buffer.clear()
+    if buffer:
+        yield bytes(buffer)
@@ -0,0 +1,57 @@
+import hashlib
+from typing import BinaryIO, Optional
+
+import numpy as np
+from PIL import Image
+
+from yapml.config import image_hash_strategy
+
+HASH_STRATEGIES = ("blake2b", "pixel-md5")
+
+
+class ImageHasher:
+    """Computes image_hash values with one of the HASH_STRATEGIES."""
+
+    def __init__(self, strategy: str = image_hash_strategy):
+        if strategy not in HASH_STRATEGIES:
+            raise ValueError(f"Unknown hash strategy {strategy}. Must be one of {HASH_STRATEGIES}")
+        self.strategy = strategy
+
+    @property
+    def hashes_pixels(self) -> bool:
+        return self.strategy == "pixel-md5"
+
+    def new_incremental(self) -> Optional["hashlib._Hash"]:
+        """A hash object to feed encoded bytes into as they arrive, or None if the strategy needs the pixels."""
+        if self.hashes_pixels:
+            return None
+        return hashlib.blake2b(digest_size=16)
+
+    def hash(self, image_bytes: BinaryIO, image: Optional[Image.Image] = None) -> str:
+        """Hash an encoded image. `image` is the opened image, if the caller already has it."""
+        if self.hashes_pixels:
+            if image is None:
+                image_bytes.seek(0)
+                image = Image.open(image_bytes)
+            return hashlib.md5(image.tobytes()).hexdigest()
+
+        hasher = self.new_incremental()
+        assert hasher is not None
+        image_bytes.seek(0)
+        while chunk := image_bytes.read(1024**2):
+            hasher.update(chunk)
+        return hasher.hexdigest()
+
+
+def perceptual_hash(image: Image.Image) -> str:
+    """
+    64-bit difference hash (dHash) of an image, as 16 hex characters.
+
+    Each bit says whether a pixel of a 9x8 grayscale thumbnail is brighter than its left neighbour, so the hash
+    survives re-encoding, resizing and small edits. Similar images have hashes with a small Hamming distance.
+    """
+    # Let the JPEG decoder downscale while decoding. This is a no-op for other formats or loaded images.
+    image.draft("L", (64, 64))
+    pixels = np.asarray(image.convert("L").resize((9, 8), Image.Resampling.BILINEAR), dtype=np.int16)
+    bits = (pixels[:, 1:] > pixels[:, :-1]).flatten()
+    return np.packbits(bits).tobytes().hex()
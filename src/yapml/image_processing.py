@@ -1,10 +1,99 @@
+import asyncio
 import base64
 import os
+import weakref
+from contextlib import asynccontextmanager
 from io import BytesIO
+from typing import AsyncIterator, Optional
 
+import anyio.to_thread
+import httpx
 import requests  # type: ignore
 from PIL import Image  # type: ignore
 
+from yapml.config import (
+    image_fetch_max_connections,
+    image_fetch_per_host_limit,
+    image_fetch_timeout,
+    max_image_bytes,
+)
+
+
+class RemoteImageFetcher:
+    """
+    Downloads images over a shared pool of keep-alive connections.
+
+    At most `per_host_limit` downloads run against the same host at once, and bodies larger than `max_bytes` are
+    rejected while streaming, before they are fully read.
+    """
+
+    def __init__(
+        self,
+        max_connections: int = image_fetch_max_connections,
+        per_host_limit: int = image_fetch_per_host_limit,
+        max_bytes: int = max_image_bytes,
+        timeout: float = image_fetch_timeout,
+        transport: Optional[httpx.AsyncBaseTransport] = None,
+    ):
+        self.max_bytes = max_bytes
+        self.client = httpx.AsyncClient(
+            limits=httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections),
+            timeout=timeout,
+            follow_redirects=True,
+            transport=transport,
+        )
+        self.per_host_limit = per_host_limit
+        # Host -> its semaphore and the number of downloads that hold or wait for it. Hosts without downloads are
+        # dropped, so that the map does not grow with every host ever fetched from.
+        self._hosts: dict[str, tuple[asyncio.Semaphore, int]] = {}
+
+    @asynccontextmanager
+    async def _host_slot(self, host: str) -> AsyncIterator[None]:
+        semaphore, users = self._hosts.get(host, (None, 0))
+        semaphore = semaphore or asyncio.Semaphore(self.per_host_limit)
+        self._hosts[host] = (semaphore, users + 1)
+        try:
+            async with semaphore:
+                yield
+        finally:
+            semaphore, users = self._hosts[host]
+            if users == 1:
+                del self._hosts[host]
+            else:
+                self._hosts[host] = (semaphore, users - 1)
+
+    async def fetch(self, url: str) -> BytesIO:
+        async with self._host_slot(httpx.URL(url).host):
+            try:
+                async with self.client.stream("GET", url) as response:
+                    response.raise_for_status()
+                    content_length = response.headers.get("content-length")
+                    if content_length is not None and int(content_length) > self.max_bytes:
+                        raise ValueError(f"Image is larger than {self.max_bytes} bytes")
+                    stream = BytesIO()
+                    async for chunk in response.aiter_bytes():
+                        if stream.tell() + len(chunk) > self.max_bytes:
+                            raise ValueError(f"Image is larger than {self.max_bytes} bytes")
+                        stream.write(chunk)
+            except httpx.HTTPError as e:
+                raise ValueError(f"Unable to fetch {url}: {e}")
+        stream.seek(0)
+        return stream
+
+
+# Connection pools and semaphores belong to the event loop they were created on, so keep one fetcher per loop.
+_fetchers: weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, RemoteImageFetcher] = weakref.WeakKeyDictionary()
+
+
+def get_remote_image_fetcher() -> RemoteImageFetcher:
+    loop = asyncio.get_running_loop()
+    if loop not in _fetchers:
+        _fetchers[loop] = RemoteImageFetcher()
+    return _fetchers[loop]
+
+
+_requests_session = requests.Session()
+
 
 class ImageDecoder:
     def to_image(self, sample_data: str) -> Image.Image:
@@ -24,11 +113,20 @@ class ImageDecoder:
             return self._load_from_data_uri(sample_data)
         raise ValueError(f"Unable to parse input {sample_data=}.")
 
+    async def to_stream_async(self, sample_data: str) -> BytesIO:
+        """
+        Like to_stream, but downloads URLs without blocking the event loop, and reads local files and decodes data URIs
+        in a worker thread.
+        """
+        if self.looks_like_url(sample_data):
+            return await get_remote_image_fetcher().fetch(sample_data)
+        return await anyio.to_thread.run_sync(self.to_stream, sample_data)
+
     def looks_like_url(self, sample_data: str) -> bool:
         return sample_data.startswith("https://") or sample_data.startswith("http://")
 
     def _load_from_url(self, url: str) -> BytesIO:
-        response = requests.get(url, timeout=5)
+        response = _requests_session.get(url, timeout=image_fetch_timeout)
         return BytesIO(response.content)
 
     def looks_like_local_filepath(self, local_path: str) -> bool:
@@ -0,0 +1,474 @@
+"""
+Import COCO and YOLO datasets into a function.
+
+An import runs in two phases. Planning reads the dataset, creates the labels it needs in the target function and
+lists every image, with its boxes, as an ImportItem. Ingestion then feeds the pending items to `ingest_samples`,
+which fetches, decodes, hashes and deduplicates the images in parallel. The boxes of the new samples are bulk
+inserted, and the items and counters of the run updated, in the same transaction as the samples. An interrupted
+import therefore resumes with exactly the images that were not ingested yet.
+"""
+
+import hashlib
+import json
+import os
+import re
+import shutil
+import tempfile
+import zipfile
+from collections import defaultdict
+from dataclasses import dataclass, field
+from datetime import datetime
+from typing import BinaryIO, Callable, Iterator, Literal, Optional
+
+import anyio.to_thread
+from pydantic import BaseModel
+from sqlalchemy import insert, update
+from sqlmodel import Session, select
+
+from yapml.box_batches import insert_new_boxes
+from yapml.config import (
+    import_annotator_name,
+    import_batch_size,
+    import_dir,
+    ingest_concurrency,
+    max_import_upload_bytes,
+)
+from yapml.datamodel import ImportItem, ImportRun, Label, ObjectDetectionSample
+from yapml.deletion import label_deletion_pending
+from yapml.ingestion import IngestResult, ingest_samples
+
+ImportFormat = Literal["coco", "yolo"]
+
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".bmp", ".gif", ".tif", ".tiff", ".webp")
+
+# Box as (label name, center_x, center_y, width, height), relative to the image size.
+PlannedBox = tuple[str, float, float, float, float]
+
+
+@dataclass
+class PlannedImage:
+    source: str
+    key: str
+    width: Optional[int] = None
+    height: Optional[int] = None
+    boxes: list[PlannedBox] = field(default_factory=list)
+
+
+class ImportProgress(BaseModel):
+    id: int
+    function_id: int
+    source_format: str
+    status: str
+    total_images: int
+    processed_images: int
+    created_samples: int
+    duplicate_images: int
+    failed_images: int
+    created_boxes: int
+    error: Optional[str]
+    started_at: Optional[datetime]
+    finished_at: Optional[datetime]
+    # Throughput of the latest attempt.
+    images_per_second: Optional[float]
+    boxes_per_second: Optional[float]
+    eta_seconds: Optional[float]
+    job_id: Optional[int] = None  # The job that was queued to run the import, if any.
+
+
+def import_progress(run: ImportRun, now: Optional[datetime] = None) -> ImportProgress:
+    images_per_second = boxes_per_second = eta_seconds = None
+    if run.started_at is not None:
+        seconds = ((run.finished_at or now or datetime.now()) - run.started_at).total_seconds()
+        if seconds > 0:
+            images_per_second = (run.processed_images - run.processed_before_start) / seconds
+            boxes_per_second = (run.created_boxes - run.boxes_before_start) / seconds
+        if images_per_second and run.planned and run.status == "running":
+            eta_seconds = (run.total_images - run.processed_images) / images_per_second
+    return ImportProgress(
+        **run.model_dump(include=set(ImportProgress.model_fields)),
+        images_per_second=images_per_second,
+        boxes_per_second=boxes_per_second,
+        eta_seconds=eta_seconds,
+    )
+
+
+def clip_box(
+    center_x: float, center_y: float, width: float, height: float
+) -> Optional[tuple[float, float, float, float]]:
+    """Clip a relative box to the image. Returns None if nothing of it is left."""
+    x_min, y_min = center_x - width / 2, center_y - height / 2
+    x_max, y_max = center_x + width / 2, center_y + height / 2
+    if x_min >= 0 and y_min >= 0 and x_max <= 1 and y_max <= 1:
+        return center_x, center_y, width, height
+    x_min, y_min = max(x_min, 0.0), max(y_min, 0.0)
+    x_max, y_max = min(x_max, 1.0), min(y_max, 1.0)
+    if x_max <= x_min or y_max <= y_min:
+        return None
+    return (x_min + x_max) / 2, (y_min + y_max) / 2, x_max - x_min, y_max - y_min
+
+
+def label_name(name: str) -> str:
+    """Turn a class name into a valid label name, e.g. "traffic light" into "traffic_light"."""
+    return re.sub(r"[^a-zA-Z0-9_]+", "_", name.strip()) or "unnamed"
+
+
+def read_coco(path: str, images_dir: Optional[str] = None) -> tuple[list[str], Iterator[PlannedImage]]:
+    """
+    Read a COCO detection file. Returns the label names and the images.
+
+    Image file names are looked up in `images_dir`, or next to the file or in an images/ directory next to it, which
+    is what the COCO export writes. Images that are not found there are fetched from their coco_url, if they have one.
+    """
+    with open(path) as file:
+        coco = json.load(file)
+    categories = {category["id"]: label_name(category["name"]) for category in coco.get("categories", [])}
+    annotations = defaultdict(list)
+    for annotation in coco.get("annotations", []):
+        annotations[annotation["image_id"]].append(annotation)
+    base_dirs = [images_dir] if images_dir else [os.path.dirname(path), os.path.join(os.path.dirname(path), "images")]
+
+    def images() -> Iterator[PlannedImage]:
+        for image in coco["images"]:
+            width, height = image.get("width"), image.get("height")
+            if not width or not height:
+                raise ValueError(f"COCO image {image['id']} has no width and height")
+            candidates = [os.path.join(base_dir, image["file_name"]) for base_dir in base_dirs]
+            source = next((path for path in candidates if os.path.exists(path)), image.get("coco_url", candidates[0]))
+            planned = PlannedImage(source=source, key=image["file_name"], width=width, height=height)
+            for annotation in annotations.pop(image["id"], []):
+                x, y, w, h = annotation["bbox"]
+                box = clip_box((x + w / 2) / width, (y + h / 2) / height, w / width, h / height)
+                if box is not None:
+                    planned.boxes.append((categories[annotation["category_id"]], *box))
+            yield planned
+
+    return list(categories.values()), images()
+
+
+def read_yolo(root: str) -> tuple[list[str], Iterator[PlannedImage]]:
+    """
+    Read a YOLO dataset directory. Returns the label names and the images.
+
+    Class names are read from classes.txt or obj.names. Images are found under images/, or under the root if there
+    is no images/ directory, and their boxes in a .txt file with the same path under labels/, or next to the image.
+    """
+    for names_file in ("classes.txt", "obj.names"):
+        if os.path.exists(os.path.join(root, names_file)):
+            with open(os.path.join(root, names_file)) as file:
+                classes = [label_name(line) for line in file if line.strip()]
+            break
+    else:
+        raise ValueError("No classes.txt or obj.names in the dataset")
+    images_root = os.path.join(root, "images") if os.path.isdir(os.path.join(root, "images")) else root
+
+    def images() -> Iterator[PlannedImage]:
+        for directory, dirs, files in os.walk(images_root):
+            dirs.sort()
+            for name in sorted(files):
+                if not name.lower().endswith(IMAGE_EXTENSIONS):
+                    continue
+                path = os.path.join(directory, name)
+                key = os.path.relpath(path, images_root)
+                planned = PlannedImage(source=path, key=key)
+                label_file = (
+                    os.path.splitext(os.path.join(root, "labels", key) if images_root != root else path)[0] + ".txt"
+                )
+                if os.path.exists(label_file):
+                    planned.boxes = read_yolo_labels(label_file, classes)
+                yield planned
+
+    return classes, images()
+
+
+def read_yolo_labels(path: str, classes: list[str]) -> list[PlannedBox]:
+    boxes = []
+    with open(path) as file:
+        for line in file:
+            values = line.split()
+            if len(values) != 5:  # Segmentation polygons, or empty lines.
+                continue
+            center_x, center_y, width, height = map(float, values[1:])
+            box = clip_box(center_x, center_y, width, height)
+            if box is not None:
+                boxes.append((classes[int(values[0])], *box))
+    return boxes
+
+
+def ensure_labels(session: Session, function_id: int, names: list[str]) -> dict[str, int]:
+    """
+    Find or create labels with the given names in a function, and return their ids by name. Deleted labels are
+    restored. Raises ValueError for a label that a job is deleting, the import can be resumed once it is deleted.
+    """
+    existing = {
+        label.name: (label, deleting)
+        for label, deleting in session.exec(
+            select(Label, label_deletion_pending(Label.id)).where(Label.name.in_(names))  # type: ignore
+        ).all()
+    }
+    labels = {}
+    for name in dict.fromkeys(names):
+        label, deleting = existing.get(name, (None, False))
+        if label is None:
+            color = "#" + hashlib.md5(name.encode()).hexdigest()[:6]
+            label = Label(name=name, color=color, function_id=function_id)
+            Label.model_validate(label)
+            session.add(label)
+        elif label.function_id != function_id:
+            raise ValueError(f"Label name {name} is used by another function")
+        elif deleting:
+            raise ValueError(f"Label {name} is being deleted")
+        label.deleted_at = None
+        labels[name] = label
+    session.flush()
+    return {name: label.id for name, label in labels.items()}  # type: ignore
+
+
+def plan_import(session_factory: Callable[[], Session], run_id: int) -> None:
+    """Create the labels of an import and list its images. Runs in one transaction, so it is all or nothing."""
+    with session_factory() as session:
+        run = session.get(ImportRun, run_id)
+        assert run is not None
+        if run.source_format == "coco":
+            names, images = read_coco(run.source_path, run.images_dir)
+        else:
+            names, images = read_yolo(run.source_path)
+        label_ids = ensure_labels(session, run.function_id, names)
+
+        rows, total = [], 0
+        for image in images:
+            boxes = [[label_ids[name], *coordinates] for name, *coordinates in image.boxes]
+            rows.append(
+                dict(
+                    import_run_id=run_id,
+                    source=image.source,
+                    key=image.key,
+                    width=image.width,
+                    height=image.height,
+                    boxes=json.dumps(boxes),
+                    status="pending",
+                )
+            )
+            if len(rows) == import_batch_size:
+                session.execute(insert(ImportItem), rows)
+                total, rows = total + len(rows), []
+        if rows:
+            session.execute(insert(ImportItem), rows)
+            total += len(rows)
+        run.total_images, run.planned = total, True
+        session.add(run)
+        session.commit()
+
+
+def pending_items(session_factory: Callable[[], Session], run_id: int, limit: int) -> list[ImportItem]:
+    with session_factory() as session:
+        return list(
+            session.exec(
+                select(ImportItem)
+                .where(ImportItem.import_run_id == run_id, ImportItem.status == "pending")
+                .order_by(ImportItem.id)  # type: ignore
+                .limit(limit)
+            ).all()
+        )
+
+
+def check_labels(session: Session, label_ids: set[int]) -> set[int]:
+    """
+    Of the labels an import planned to use, return the ids of those deleted since. Raises ValueError if a job is
+    deleting one of them, as boxes added meanwhile could outlive the label.
+    """
+    deleted = set()
+    for label_id, name, deleted_at, deleting in session.exec(
+        select(Label.id, Label.name, Label.deleted_at, label_deletion_pending(Label.id)).where(  # type: ignore
+            Label.id.in_(label_ids)  # type: ignore
+        )
+    ).all():
+        if deleting:
+            raise ValueError(f"Label {name} is being deleted")
+        if deleted_at is not None:
+            deleted.add(label_id)
+    return deleted
+
+
+def record_results(session: Session, results: list[IngestResult], run: ImportRun, items: list[ImportItem]) -> None:
+    """
+    Insert the boxes of the new samples, and record what became of each image and the run. Boxes of labels that were
+    deleted after the import was planned are left out, like exports leave them out.
+    """
+    session.execute(
+        update(ImportItem),
+        [
+            {
+                "id": items[result.index].id,
+                "status": result.status,
+                "sample_id": result.sample_id,
+                "detail": result.detail,
+            }
+            for result in results
+        ],
+    )
+    now = datetime.now()
+    boxes = [
+        dict(
+            sample_id=result.sample_id,
+            function_id=run.function_id,
+            label_id=label_id,
+            center_x=center_x,
+            center_y=center_y,
+            width=width,
+            height=height,
+            annotator_name=import_annotator_name,
+            created_at=now,
+            version=1,
+            is_head=True,
+        )
+        for result in results
+        if result.status == "created"
+        for label_id, center_x, center_y, width, height in json.loads(items[result.index].boxes)
+    ]
+    if deleted := check_labels(session, {box["label_id"] for box in boxes}):
+        boxes = [box for box in boxes if box["label_id"] not in deleted]
+    insert_new_boxes(session, boxes)
+    statuses = [result.status for result in results]
+    session.execute(
+        update(ImportRun)
+        .where(ImportRun.id == run.id)  # type: ignore
+        .values(
+            processed_images=ImportRun.processed_images + len(results),
+            created_samples=ImportRun.created_samples + statuses.count("created"),
+            duplicate_images=ImportRun.duplicate_images + statuses.count("duplicate"),
+            failed_images=ImportRun.failed_images + statuses.count("error"),
+            created_boxes=ImportRun.created_boxes + len(boxes),
+        )
+        .execution_options(synchronize_session=False)
+    )
+
+
+def update_run(session_factory: Callable[[], Session], run_id: int, **values) -> ImportRun:
+    with session_factory() as session:
+        run = session.get(ImportRun, run_id)
+        assert run is not None
+        for name, value in values.items():
+            setattr(run, name, value)
+        session.add(run)
+        session.commit()
+        session.refresh(run)
+        return run
+
+
+async def run_import(
+    session_factory: Callable[[], Session],
+    run_id: int,
+    batch_size: int = import_batch_size,
+    concurrency: int = ingest_concurrency,
+    on_batch: Optional[Callable[[ImportRun], None]] = None,
+) -> None:
+    """
+    Plan an import if needed, then ingest its pending images `batch_size` at a time, until none are left, and call
+    `on_batch` with the run after each batch. Errors are recorded on the run and raised. The run can be resumed by
+    calling this again.
+    """
+    with session_factory() as session:
+        run = session.get(ImportRun, run_id)
+        assert run is not None
+        processed, boxes = run.processed_images, run.created_boxes
+    run = update_run(
+        session_factory,
+        run_id,
+        status="running",
+        error=None,
+        started_at=datetime.now(),
+        finished_at=None,
+        processed_before_start=processed,
+        boxes_before_start=boxes,
+    )
+    try:
+        if not run.planned:
+            await anyio.to_thread.run_sync(plan_import, session_factory, run_id)
+        while items := await anyio.to_thread.run_sync(pending_items, session_factory, run_id, batch_size):
+            samples = [
+                ObjectDetectionSample(
+                    function_id=run.function_id, url=item.source, key=item.key, width=item.width, height=item.height
+                )
+                for item in items
+            ]
+
+            def on_insert(session: Session, results: list[IngestResult], items=items) -> None:
+                record_results(session, results, run, items)
+
+            async for _ in ingest_samples(session_factory, samples, concurrency=concurrency, on_insert=on_insert):
+                pass
+            if on_batch:
+                await anyio.to_thread.run_sync(on_batch, update_run(session_factory, run_id))
+    except Exception as e:
+        update_run(
+            session_factory, run_id, status="failed", error=str(e) or type(e).__name__, finished_at=datetime.now()
+        )
+        raise
+    run = update_run(session_factory, run_id, status="completed", finished_at=datetime.now())
+    if run.upload_dir is not None:
+        shutil.rmtree(run.upload_dir, ignore_errors=True)
+
+
+def extract_upload(archive_path: str, target_dir: str) -> None:
+    """Extract an uploaded zip archive. Raises ValueError if it is not a zip archive or has paths outside of it."""
+    try:
+        with zipfile.ZipFile(archive_path) as archive:
+            target = os.path.realpath(target_dir)
+            for name in archive.namelist():
+                if not os.path.realpath(os.path.join(target, name)).startswith(target + os.sep):
+                    raise ValueError(f"Archive member {name} is outside of the archive")
+            archive.extractall(target)
+    except zipfile.BadZipFile as e:
+        raise ValueError(str(e))
+
+
+def find_dataset(directory: str, source_format: ImportFormat, annotations: Optional[str] = None) -> str:
+    """
+    Find the dataset in an extracted upload: the COCO annotation file, or the YOLO root directory, which may be a
+    single top-level directory of the archive.
+    """
+    entries = [entry for entry in os.listdir(directory) if not entry.startswith((".", "__MACOSX"))]
+    if len(entries) == 1 and os.path.isdir(os.path.join(directory, entries[0])):
+        directory = os.path.join(directory, entries[0])
+    if source_format == "yolo":
+        return directory
+    if annotations is not None:
+        path = os.path.realpath(os.path.join(directory, annotations))
+        if not path.startswith(os.path.realpath(directory) + os.sep) or not os.path.isfile(path):
+            raise ValueError(f"{annotations} is not in the archive")
+        return path
+    for parent, dirs, files in sorted(os.walk(directory)):
+        dirs.sort()
+        for name in sorted(files):
+            if name.endswith(".json"):
+                return os.path.join(parent, name)
+    raise ValueError("No COCO annotation file in the archive")
+
+
+def unpack_upload(
+    archive: BinaryIO, source_format: ImportFormat, annotations: Optional[str] = None, chunk_size: int = 1024**2
+) -> tuple[str, str]:
+    """
+    Copy an uploaded zip archive to a new directory in import_dir, extract it there and find the dataset in it. Returns
+    the directory and the path of the dataset. This blocks on file I/O, so the server runs it in a worker thread.
+
+    Raises ValueError, and removes the directory, if the archive is too large or not a valid dataset.
+    """
+    os.makedirs(import_dir, exist_ok=True)
+    upload_dir = tempfile.mkdtemp(dir=import_dir, prefix="upload-")
+    try:
+        archive_path = os.path.join(upload_dir, "upload.zip")
+        size = 0
+        with open(archive_path, "wb") as file:
+            while chunk := archive.read(chunk_size):
+                size += len(chunk)
+                if size > max_import_upload_bytes:
+                    raise ValueError(f"Archive is larger than {max_import_upload_bytes} bytes")
+                file.write(chunk)
+        dataset_dir = os.path.join(upload_dir, "dataset")
+        extract_upload(archive_path, dataset_dir)
+        os.remove(archive_path)
+        return upload_dir, find_dataset(dataset_dir, source_format, annotations)
+    except ValueError:
+        shutil.rmtree(upload_dir, ignore_errors=True)
+        raise
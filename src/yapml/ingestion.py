@@ -0,0 +1,472 @@
+import os
+import shutil
+import tempfile
+from dataclasses import dataclass
+from typing import AsyncIterator, BinaryIO, Callable, Optional, Sequence, Union
+
+import anyio
+from PIL import Image as PILImage
+from pydantic import BaseModel
+from sqlalchemy import ColumnElement
+from sqlalchemy.exc import IntegrityError
+from sqlmodel import Session, func, select
+
+from yapml.config import image_dir, image_url_prefix, ingest_chunk_size, ingest_concurrency, max_image_bytes
+from yapml.datamodel import ObjectDetectionSample
+from yapml.hashing import ImageHasher, perceptual_hash
+from yapml.image_processing import ImageDecoder
+from yapml.near_duplicates import hamming_distance, near_duplicate_registry
+
+
+@dataclass
+class DecodedSample:
+    sample: ObjectDetectionSample
+    image_bytes: BinaryIO
+    image_hash: str
+    spool_path: Optional[str] = None  # Set if the bytes were spooled to a temporary file in image_dir.
+
+
+class IngestResult(BaseModel):
+    index: int
+    status: str  # One of "created", "duplicate" or "error".
+    sample_id: Optional[int] = None
+    image_hash: Optional[str] = None
+    detail: Optional[str] = None
+
+
+async def fetch_and_decode_sample(
+    sample: ObjectDetectionSample, limiter: Optional[anyio.CapacityLimiter] = None
+) -> DecodedSample:
+    """
+    Fetch the image of a sample without blocking the event loop, then decode and hash it in a worker thread.
+
+    Raises ValueError if the image can not be loaded or does not match the given dimensions.
+    """
+    try:
+        image_bytes = await ImageDecoder().to_stream_async(sample.url)
+    except Exception as e:
+        raise ValueError(str(e))
+    return await anyio.to_thread.run_sync(decode_sample, sample, image_bytes, limiter=limiter)
+
+
+def decode_sample(
+    sample: ObjectDetectionSample, image_bytes: BinaryIO, image_hash: Optional[str] = None
+) -> DecodedSample:
+    """
+    Read the image header of a sample, fill in or check its dimensions and hash it.
+
+    Pass `image_hash` if it was already computed while the bytes were read. Raises ValueError if the image can not
+    be opened or does not match the given dimensions.
+    """
+    try:
+        image = PILImage.open(image_bytes)
+    except Exception as e:
+        raise ValueError(str(e))
+
+    if sample.width is None:
+        sample.width = image.width
+    elif image.width != sample.width:
+        raise ValueError("Given width does not match image width")
+    if sample.height is None:
+        sample.height = image.height
+    elif image.height != sample.height:
+        raise ValueError("Given height does not match image height")
+
+    try:
+        if image_hash is None:
+            image_hash = ImageHasher().hash(image_bytes, image)
+        sample.perceptual_hash = perceptual_hash(image)
+    except OSError as e:
+        raise ValueError(str(e))
+    sample.mime_type = PILImage.MIME.get(image.format or "")
+    return DecodedSample(sample=sample, image_bytes=image_bytes, image_hash=image_hash)
+
+
+def store_image(decoded: DecodedSample) -> None:
+    """Write the image bytes to disk and point the sample at them. Note that there is no file extension."""
+    file_path = f"{image_dir}/{decoded.image_hash}"
+    if decoded.spool_path is not None:
+        decoded.image_bytes.close()
+        os.replace(decoded.spool_path, file_path)
+        decoded.spool_path = None
+    else:
+        decoded.image_bytes.seek(0)
+        with open(file_path, "wb") as file:
+            shutil.copyfileobj(decoded.image_bytes, file)
+    decoded.sample.image_hash = decoded.image_hash
+    decoded.sample.url = f"{image_url_prefix}/{decoded.image_hash}"
+
+
+@dataclass
+class SpooledUpload:
+    path: str
+    image_hash: Optional[str]  # None if the hash strategy needs the decoded pixels.
+
+
+async def spool_upload(chunks: AsyncIterator[bytes], max_bytes: int = max_image_bytes) -> SpooledUpload:
+    """
+    Write an uploaded image to a temporary file in image_dir chunk by chunk, hashing it on the way.
+
+    The file lives on the same file system as the stored images, so that storing it is a rename rather than a copy.
+    Raises ValueError, and removes the file, if the upload is empty or larger than `max_bytes`.
+    """
+    hasher = ImageHasher().new_incremental()
+    fd, path = tempfile.mkstemp(dir=image_dir, suffix=".upload")
+    nbytes = 0
+    try:
+        with os.fdopen(fd, "wb") as file:
+            async for chunk in chunks:
+                nbytes += len(chunk)
+                if nbytes > max_bytes:
+                    raise ValueError(f"Image is larger than {max_bytes} bytes")
+                file.write(chunk)
+                if hasher is not None:
+                    hasher.update(chunk)
+        if nbytes == 0:
+            raise ValueError("Empty image content")
+    except BaseException:
+        os.remove(path)
+        raise
+    return SpooledUpload(path=path, image_hash=hasher.hexdigest() if hasher is not None else None)
+
+
+def decode_spooled_sample(sample: ObjectDetectionSample, spooled: SpooledUpload) -> DecodedSample:
+    """Like decode_sample, for an image spooled to disk by spool_upload. Removes the file if decoding fails."""
+    image_file = open(spooled.path, "rb")
+    try:
+        decoded = decode_sample(sample, image_file, spooled.image_hash)
+    except BaseException:
+        image_file.close()
+        os.remove(spooled.path)
+        raise
+    decoded.spool_path = spooled.path
+    return decoded
+
+
+def discard_spooled_image(decoded: DecodedSample) -> None:
+    if decoded.spool_path is not None:
+        decoded.image_bytes.close()
+        os.remove(decoded.spool_path)
+        decoded.spool_path = None
+
+
+async def ingest_samples(
+    session_factory: Callable[[], Session],
+    samples: list[ObjectDetectionSample],
+    concurrency: int = ingest_concurrency,
+    chunk_size: int = ingest_chunk_size,
+    near_duplicate_radius: Optional[int] = None,
+    on_insert: Optional[Callable[[Session, list[IngestResult]], None]] = None,
+) -> AsyncIterator[IngestResult]:
+    """
+    Ingest many samples, yielding one result per sample in input order.
+
+    Images are fetched and decoded `concurrency` at a time. Duplicates, within the batch or of samples already in
+    the database, are reported instead of inserted. So are near-duplicates if `near_duplicate_radius` is given.
+    Samples are inserted `chunk_size` per transaction, and results for a chunk are yielded as soon as it is
+    committed. `on_insert` is called with the session and the results of each chunk before it is committed, to
+    write rows that belong with the new samples in the same transaction. If the chunk has to be inserted one sample
+    at a time, it is called once per transaction, with the results that transaction commits.
+    """
+    semaphore = anyio.Semaphore(concurrency)
+    limiter = anyio.CapacityLimiter(concurrency)
+    seen_hashes: dict[str, int] = {}
+    for start in range(0, len(samples), chunk_size):
+        chunk = samples[start : start + chunk_size]
+        decoded: list[Union[DecodedSample, Exception]] = [ValueError("Not decoded")] * len(chunk)
+
+        async def decode(position: int, sample: ObjectDetectionSample) -> None:
+            async with semaphore:
+                try:
+                    decoded[position] = await fetch_and_decode_sample(sample, limiter=limiter)
+                except Exception as e:
+                    decoded[position] = e
+
+        async with anyio.create_task_group() as task_group:
+            for position, sample in enumerate(chunk):
+                task_group.start_soon(decode, position, sample)
+
+        results = await anyio.to_thread.run_sync(
+            _insert_chunk, session_factory, start, decoded, seen_hashes, near_duplicate_radius, on_insert
+        )
+        for result in results:
+            yield result
+
+
+def _insert_chunk(
+    session_factory: Callable[[], Session],
+    start: int,
+    decoded: list[Union[DecodedSample, Exception]],
+    seen_hashes: dict[str, int],
+    near_duplicate_radius: Optional[int] = None,
+    on_insert: Optional[Callable[[Session, list[IngestResult]], None]] = None,
+) -> list[IngestResult]:
+    results: list[IngestResult] = []
+    to_insert: list[tuple[IngestResult, DecodedSample]] = []
+    with session_factory() as session:
+        hashes = [item.image_hash for item in decoded if isinstance(item, DecodedSample)]
+        existing = dict(
+            session.exec(
+                select(ObjectDetectionSample.image_hash, ObjectDetectionSample.id).where(
+                    ObjectDetectionSample.image_hash.in_(hashes)  # type: ignore
+                )
+            ).all()
+        )
+        for index, item in enumerate(decoded, start=start):
+            if isinstance(item, Exception):
+                results.append(IngestResult(index=index, status="error", detail=str(item)))
+            elif item.image_hash in existing:
+                results.append(
+                    IngestResult(
+                        index=index,
+                        status="duplicate",
+                        sample_id=existing[item.image_hash],
+                        image_hash=item.image_hash,
+                        detail="Image already exists in database",
+                    )
+                )
+            elif item.image_hash in seen_hashes:
+                results.append(
+                    IngestResult(
+                        index=index,
+                        status="duplicate",
+                        image_hash=item.image_hash,
+                        detail=f"Image is a duplicate of item {seen_hashes[item.image_hash]}",
+                    )
+                )
+            elif near_duplicate_radius is not None and (
+                near_duplicate := find_near_duplicate(session, item.sample, near_duplicate_radius, to_insert)
+            ):
+                results.append(
+                    IngestResult(index=index, status="duplicate", image_hash=item.image_hash, detail=near_duplicate)
+                )
+            else:
+                seen_hashes[item.image_hash] = index
+                result = IngestResult(index=index, status="created", image_hash=item.image_hash)
+                results.append(result)
+                to_insert.append((result, item))
+
+        for result, item in to_insert:
+            try:
+                ObjectDetectionSample.model_validate(item.sample)
+                store_image(item)
+            except Exception as e:
+                result.status, result.detail = "error", str(e)
+        to_insert = [(result, item) for result, item in to_insert if result.status == "created"]
+
+        try:
+            session.add_all([item.sample for _, item in to_insert])
+            session.flush()
+            for result, item in to_insert:
+                result.sample_id = item.sample.id
+            if on_insert is not None:
+                on_insert(session, results)
+            session.commit()
+        except IntegrityError:
+            # Another request inserted one of the images meanwhile. Fall back to one transaction per sample, which
+            # also records the result of the sample, so that the chunk stops halfway at a consistent state.
+            session.rollback()
+            inserting = {id(result) for result, _ in to_insert}
+            if on_insert is not None and (others := [result for result in results if id(result) not in inserting]):
+                on_insert(session, others)
+                session.commit()
+            for result, item in to_insert:
+                try:
+                    session.add(item.sample)
+                    session.flush()
+                    result.sample_id = item.sample.id
+                    if on_insert is not None:
+                        on_insert(session, [result])
+                    session.commit()
+                except IntegrityError:
+                    session.rollback()
+                    result.status, result.sample_id = "duplicate", None
+                    result.detail = "Image already exists in database"
+                    if on_insert is not None:
+                        on_insert(session, [result])
+                        session.commit()
+        for result, item in to_insert:
+            if result.status == "created":
+                near_duplicate_registry.add(item.sample)
+    return results
+
+
+def find_near_duplicate(
+    session: Session,
+    sample: ObjectDetectionSample,
+    radius: int,
+    pending: Sequence[tuple[IngestResult, DecodedSample]] = (),
+) -> Optional[str]:
+    """
+    Describe the first near-duplicate of a sample among the samples of its function, or return None.
+
+    `pending` are samples about to be inserted along with this one, which are not in the index yet.
+    """
+    if sample.perceptual_hash is None:
+        return None
+    matches = near_duplicate_registry.get(session, sample.function_id).query(sample.perceptual_hash, radius)
+    if matches:
+        return f"Image is a near-duplicate of sample {matches[0].sample_id} (distance {matches[0].distance})"
+    for result, item in pending:
+        other = item.sample
+        if other.function_id == sample.function_id and other.perceptual_hash is not None:
+            distance = hamming_distance(other.perceptual_hash, sample.perceptual_hash)
+            if distance <= radius:
+                return f"Image is a near-duplicate of item {result.index} (distance {distance})"
+    return None
+
+
+class RekeyReport(BaseModel):
+    strategy: str
+    rekeyed: int = 0
+    unchanged: int = 0
+    missing: int = 0  # Samples whose image file is not in image_dir.
+    conflicts: list[int] = []  # Samples whose new hash is already taken by another sample.
+
+
+def count_stored_images(session: Session) -> int:
+    query = select(func.count()).select_from(ObjectDetectionSample)
+    return session.exec(query.where(ObjectDetectionSample.image_hash.is_not(None))).one()  # type: ignore
+
+
+def rekey_image_hashes(
+    session: Session,
+    strategy: str,
+    chunk_size: int = ingest_chunk_size,
+    on_chunk: Optional[Callable[[RekeyReport, int], None]] = None,
+) -> RekeyReport:
+    """
+    Recompute image_hash of every stored sample with `strategy`, renaming image files to match.
+
+    The images of a chunk of `chunk_size` samples are hashed while the session holds no connection, and the new hashes
+    of the chunk are committed together. An image is linked to its new name before the commit and unlinked from its
+    old name after it, so a run that fails or is interrupted at any point can simply be restarted. `on_chunk` is called
+    with the report and the number of samples seen so far after every chunk.
+    """
+    hasher = ImageHasher(strategy)
+    report = RekeyReport(strategy=strategy)
+    seen = 0
+    cursor = 0
+    while True:
+        samples = session.exec(
+            select(ObjectDetectionSample.id, ObjectDetectionSample.image_hash)
+            .where(ObjectDetectionSample.image_hash.is_not(None))  # type: ignore
+            .where(ObjectDetectionSample.id > cursor)  # type: ignore
+            .order_by(ObjectDetectionSample.id)  # type: ignore
+            .limit(chunk_size)
+        ).all()
+        session.commit()  # Give the connection back while the images are read.
+        if not samples:
+            return report
+        new_hashes = {}
+        for sample_id, image_hash in samples:
+            old_path = f"{image_dir}/{image_hash}"
+            if not os.path.exists(old_path):
+                report.missing += 1
+                continue
+            with open(old_path, "rb") as file:
+                new_hash = hasher.hash(file)
+            if new_hash == image_hash:
+                report.unchanged += 1
+                continue
+            new_hashes[sample_id] = (image_hash, new_hash)
+        linked = []  # Files created for the new hashes, and the files they replace.
+        rekeyed = 0
+        try:
+            for sample_id, (image_hash, new_hash) in new_hashes.items():
+                sample = session.get(ObjectDetectionSample, sample_id)
+                if sample is None or sample.image_hash != image_hash:
+                    continue  # Deleted or re-keyed meanwhile.
+                taken = session.exec(
+                    select(ObjectDetectionSample.id).where(ObjectDetectionSample.image_hash == new_hash)
+                ).first()
+                if taken is not None:
+                    report.conflicts.append(sample_id)
+                    continue
+                new_path = f"{image_dir}/{new_hash}"
+                if not os.path.exists(new_path):  # Left by an earlier run that stopped before its commit.
+                    os.link(f"{image_dir}/{image_hash}", new_path)
+                    linked.append((new_path, f"{image_dir}/{image_hash}"))
+                else:
+                    linked.append((None, f"{image_dir}/{image_hash}"))
+                sample.image_hash = new_hash
+                sample.url = f"{image_url_prefix}/{new_hash}"
+                session.add(sample)
+                rekeyed += 1
+            session.commit()
+        except BaseException:
+            # The rows still point at the old files, which are all still there.
+            session.rollback()
+            for new_path, _ in linked:
+                if new_path is not None:
+                    os.remove(new_path)
+            raise
+        # The new names are linked to the files before the commit, and the old names removed after it, so the files of
+        # both the old and the new hashes exist whenever the rows might point at them.
+        for _, old_path in linked:
+            try:
+                os.remove(old_path)
+            except FileNotFoundError:
+                pass
+        report.rekeyed += rekeyed
+        seen += len(samples)
+        cursor = samples[-1][0]
+        if on_chunk:
+            on_chunk(report, seen)
+
+
+def perceptual_hash_missing() -> ColumnElement[bool]:
+    return ObjectDetectionSample.image_hash.is_not(None) & ObjectDetectionSample.perceptual_hash.is_(None)  # type: ignore
+
+
+def count_missing_perceptual_hashes(session: Session) -> int:
+    query = select(func.count()).select_from(ObjectDetectionSample)
+    return session.exec(query.where(perceptual_hash_missing())).one()
+
+
+def backfill_perceptual_hashes(
+    session: Session, chunk_size: int = ingest_chunk_size, on_chunk: Optional[Callable[[int, int], None]] = None
+) -> int:
+    """
+    Compute the perceptual hash of stored samples that have none, e.g. samples ingested before they existed.
+
+    Like rekey_image_hashes, the images of a chunk are decoded while the session holds no connection, and the hashes
+    of a chunk are committed together. A run that stops halfway continues with the samples that still have no hash.
+    `on_chunk` is called with the number of samples updated and seen so far after every chunk.
+    """
+    updated = 0
+    seen = 0
+    cursor = 0
+    while True:
+        samples = session.exec(
+            select(ObjectDetectionSample.id, ObjectDetectionSample.image_hash)
+            .where(perceptual_hash_missing(), ObjectDetectionSample.id > cursor)  # type: ignore
+            .order_by(ObjectDetectionSample.id)  # type: ignore
+            .limit(chunk_size)
+        ).all()
+        session.commit()  # Give the connection back while the images are decoded.
+        if not samples:
+            near_duplicate_registry.invalidate()
+            return updated
+        hashes = {}
+        for sample_id, image_hash in samples:
+            path = f"{image_dir}/{image_hash}"
+            if not os.path.exists(path):
+                continue
+            try:
+                with PILImage.open(path) as image:
+                    hashes[sample_id] = perceptual_hash(image)
+            except OSError:
+                continue
+        for sample_id, value in hashes.items():
+            sample = session.get(ObjectDetectionSample, sample_id)
+            if sample is None or sample.perceptual_hash is not None:
+                continue
+            sample.perceptual_hash = value
+            session.add(sample)
+            updated += 1
+        session.commit()
+        seen += len(samples)
+        cursor = samples[-1][0]
+        if on_chunk:
+            on_chunk(updated, seen)
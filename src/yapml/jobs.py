@@ -0,0 +1,391 @@
+"""
+Run long operations, like dataset imports, large deletions, database resets and maintenance, as background jobs.
+
+Jobs are rows of the Job table, so they outlive the request that queued them and the server process. Worker threads
+claim due jobs one at a time, oldest first, with a single UPDATE, and run the handler of their kind. Handlers report
+their progress, and learn that their job was cancelled, through a JobContext. What a handler returns is stored as the
+result of its job.
+
+Some kinds of jobs, like maintenance, are also queued periodically, see JOB_SCHEDULES.
+
+Every handler is idempotent: running it again continues where an earlier attempt stopped. So a job that fails is
+queued again, after a delay, until it used up its attempts, and jobs that were running when the server stopped are
+queued again when it starts. This assumes a single server process runs the jobs of a database.
+"""
+
+import json
+import logging
+import threading
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+from typing import Any, Callable, Optional
+
+import anyio
+from pydantic import BaseModel
+from sqlalchemy import Table, func, update
+from sqlalchemy.exc import IntegrityError
+from sqlmodel import Session, SQLModel, select
+
+from yapml.config import (
+    box_history_retention_days,
+    job_max_attempts,
+    job_poll_interval,
+    job_retry_delay,
+    job_worker_count,
+    maintenance_interval,
+)
+from yapml.datamodel import ACTIVE_JOB_STATUSES, FunctionGeneration, ImportRun, Job, bump_all_generations
+from yapml.db import engine
+from yapml.deletion import DELETERS, ROW_COUNTERS
+from yapml.importer import run_import
+from yapml.ingestion import (
+    RekeyReport,
+    backfill_perceptual_hashes,
+    count_missing_perceptual_hashes,
+    count_stored_images,
+    rekey_image_hashes,
+)
+from yapml.maintenance import MaintenanceReport, compact_box_history, count_compactable_versions, vacuum_and_analyze
+from yapml.migrations import migrate
+from yapml.near_duplicates import near_duplicate_registry
+
+logger = logging.getLogger(__name__)
+
+
+class JobCancelled(Exception):
+    pass
+
+
+class JobStatus(BaseModel):
+    id: int
+    kind: str
+    key: Optional[str]
+    status: str
+    progress: int
+    total: Optional[int]
+    attempts: int
+    max_attempts: int
+    cancel_requested: bool
+    error: Optional[str]
+    result: Optional[dict[str, Any]]
+    created_at: datetime
+    started_at: Optional[datetime]
+    finished_at: Optional[datetime]
+
+
+def job_status(job: Job) -> JobStatus:
+    values = job.model_dump()
+    values["result"] = json.loads(job.result) if job.result is not None else None
+    return JobStatus.model_validate(values)
+
+
+@dataclass
+class JobContext:
+    session_factory: Callable[[], Session]
+    job_id: int
+    params: dict
+
+    def report(self, progress: int, total: Optional[int] = None) -> None:
+        """Record the progress of the job. Raises JobCancelled if the job was asked to stop."""
+        table: Table = Job.__table__  # type: ignore
+        values = {"progress": progress} if total is None else {"progress": progress, "total": total}
+        with self.session_factory() as session:
+            cancel_requested = session.execute(
+                update(table).where(table.c.id == self.job_id).values(**values).returning(table.c.cancel_requested)
+            ).scalar_one()
+            session.commit()
+        if cancel_requested:
+            raise JobCancelled("Job was cancelled")
+
+
+def import_job(context: JobContext) -> None:
+    def on_batch(run: ImportRun) -> None:
+        context.report(run.processed_images, run.total_images)
+
+    run_id = context.params["import_run_id"]
+    anyio.run(lambda: run_import(context.session_factory, run_id, on_batch=on_batch))
+
+
+def delete_job(context: JobContext) -> None:
+    target, target_id = context.params["target"], context.params["target_id"]
+    deleted = 0
+
+    def on_chunk(count: int) -> None:
+        nonlocal deleted
+        deleted += count
+        context.report(deleted)
+
+    # Progress is reported between chunks, when the session has committed and given its connection back, as there may
+    # be only one writer connection.
+    with context.session_factory() as session:
+        total = ROW_COUNTERS[target](session, target_id)
+    context.report(0, total)
+    with context.session_factory() as session:
+        DELETERS[target](session, target_id, on_chunk=on_chunk)
+
+
+def rehash_images_job(context: JobContext) -> dict:
+    """Re-key the image_hash of all stored samples. Returns a RekeyReport."""
+
+    def on_chunk(report: RekeyReport, seen: int) -> None:
+        context.report(seen)
+
+    with context.session_factory() as session:
+        total = count_stored_images(session)
+    context.report(0, total)
+    with context.session_factory() as session:
+        return rekey_image_hashes(session, context.params["strategy"], on_chunk=on_chunk).model_dump()
+
+
+def backfill_perceptual_hashes_job(context: JobContext) -> dict:
+    """Compute the missing perceptual hashes. Returns the number of samples updated."""
+
+    def on_chunk(updated: int, seen: int) -> None:
+        context.report(seen)
+
+    with context.session_factory() as session:
+        total = count_missing_perceptual_hashes(session)
+    context.report(0, total)
+    with context.session_factory() as session:
+        return {"updated": backfill_perceptual_hashes(session, on_chunk=on_chunk)}
+
+
+def reset_db_job(context: JobContext) -> None:
+    # Imported here, as the fixtures are only needed for a reset.
+    from yapml.fixtures import populate_db
+
+    with context.session_factory() as session:
+        bind = session.get_bind()
+    # The job table holds this job. The generations are kept, and bumped, so that no ETag from before the reset is
+    # valid after it.
+    kept = {Job.__tablename__, FunctionGeneration.__tablename__}
+    SQLModel.metadata.drop_all(
+        bind, tables=[table for table in SQLModel.metadata.sorted_tables if table.name not in kept]
+    )
+    migrate(bind)  # type: ignore
+    populate_db()
+    with context.session_factory() as session:
+        bump_all_generations(session)
+        session.commit()
+    near_duplicate_registry.invalidate()
+
+
+def maintenance_job(context: JobContext) -> dict:
+    """Compact the box history, then vacuum and analyze the database. Returns a MaintenanceReport."""
+    retention_days = context.params.get("retention_days", box_history_retention_days)
+    cutoff = datetime.now() - timedelta(days=retention_days)
+    report = MaintenanceReport()
+
+    def on_chunk(count: int) -> None:
+        report.compacted_versions += count
+        context.report(report.compacted_versions)
+
+    with context.session_factory() as session:
+        total = count_compactable_versions(session, cutoff)
+        bind = session.get_bind()
+    context.report(0, total)
+    with context.session_factory() as session:
+        compact_box_history(session, cutoff, on_chunk=on_chunk)
+    before, report.database_bytes = vacuum_and_analyze(bind)  # type: ignore
+    report.bytes_reclaimed = before - report.database_bytes
+    logger.info("Maintenance: %s", report)
+    return report.model_dump()
+
+
+JOB_HANDLERS: dict[str, Callable[[JobContext], Optional[dict]]] = {
+    "import": import_job,
+    "delete": delete_job,
+    "reset_db": reset_db_job,
+    "rehash_images": rehash_images_job,
+    "backfill_perceptual_hashes": backfill_perceptual_hashes_job,
+    "maintenance": maintenance_job,
+}
+
+# Kinds of jobs that are queued every so many seconds, counted from the end of their previous run.
+JOB_SCHEDULES: dict[str, float] = {"maintenance": maintenance_interval}
+
+
+def find_active_job(session: Session, kind: str, key: str) -> Optional[Job]:
+    return session.exec(
+        select(Job).where(Job.kind == kind, Job.key == key, Job.status.in_(ACTIVE_JOB_STATUSES))  # type: ignore
+    ).first()
+
+
+def enqueue_job(
+    session: Session, kind: str, params: dict, key: Optional[str] = None, max_attempts: int = job_max_attempts
+) -> Job:
+    """Queue a job, or return the queued or running job of the same kind and key."""
+    if kind not in JOB_HANDLERS:
+        raise ValueError(f"Unknown job kind {kind}")
+    if key is not None and (active := find_active_job(session, kind, key)):
+        if active.status == "queued" and active.run_after > datetime.now():
+            # Asked for again, so a retry that waits for its delay is due right away.
+            active.run_after = datetime.now()
+            session.add(active)
+            session.commit()
+            session.refresh(active)
+            job_runner.notify()
+        return active
+    job = Job(kind=kind, key=key, params=json.dumps(params), max_attempts=max_attempts)
+    session.add(job)
+    try:
+        session.commit()
+    except IntegrityError:
+        # Another process queued it after the lookup, see ix_job_kind_key_active.
+        session.rollback()
+        if key is None or (active := find_active_job(session, kind, key)) is None:
+            raise
+        return active
+    session.refresh(job)
+    job_runner.notify()
+    return job
+
+
+def cancel_job(session: Session, job: Job) -> Job:
+    """Cancel a queued job right away, and ask a running one to stop. Raises ValueError for finished jobs."""
+    if job.status == "queued":
+        job.status, job.finished_at = "cancelled", datetime.now()
+    elif job.status == "running":
+        job.cancel_requested = True
+    else:
+        raise ValueError(f"Job is {job.status}")
+    session.add(job)
+    session.commit()
+    session.refresh(job)
+    return job
+
+
+def update_job(session_factory: Callable[[], Session], job_id: int, **values) -> None:
+    table: Table = Job.__table__  # type: ignore
+    with session_factory() as session:
+        session.execute(update(table).where(table.c.id == job_id).values(**values))
+        session.commit()
+
+
+def claim_job(session_factory: Callable[[], Session]) -> Optional[Job]:
+    """Mark the oldest due job as running and return it, or None if no job is due."""
+    table: Table = Job.__table__  # type: ignore
+    now = datetime.now()
+    due = (
+        select(table.c.id)
+        .where(table.c.status == "queued", table.c.run_after <= now)
+        .order_by(table.c.id)
+        .limit(1)
+        .scalar_subquery()
+    )
+    with session_factory() as session:
+        job_id = session.execute(
+            update(table)
+            .where(table.c.id == due, table.c.status == "queued")
+            .values(status="running", attempts=table.c.attempts + 1, started_at=now, finished_at=None)
+            .returning(table.c.id)
+        ).scalar()
+        session.commit()
+        return session.get(Job, job_id) if job_id is not None else None
+
+
+def run_job(session_factory: Callable[[], Session], job: Job) -> None:
+    """Run a claimed job, and record how it ended. A failed job is queued again while it has attempts left."""
+    assert job.id is not None
+    try:
+        result = JOB_HANDLERS[job.kind](JobContext(session_factory, job.id, json.loads(job.params)))
+    except JobCancelled:
+        update_job(session_factory, job.id, status="cancelled", finished_at=datetime.now())
+    except Exception as e:
+        error = str(e) or type(e).__name__
+        if job.attempts < job.max_attempts:
+            retry_at = datetime.now() + timedelta(seconds=job_retry_delay * job.attempts)
+            update_job(session_factory, job.id, status="queued", error=error, run_after=retry_at)
+        else:
+            update_job(session_factory, job.id, status="failed", error=error, finished_at=datetime.now())
+    else:
+        result = json.dumps(result) if result is not None else None
+        update_job(session_factory, job.id, status="completed", error=None, result=result, finished_at=datetime.now())
+
+
+def requeue_interrupted_jobs(session_factory: Callable[[], Session]) -> None:
+    """Queue the jobs again that were running when the server stopped."""
+    table: Table = Job.__table__  # type: ignore
+    with session_factory() as session:
+        session.execute(update(table).where(table.c.status == "running").values(status="queued"))
+        session.commit()
+
+
+def schedule_jobs(session_factory: Callable[[], Session], schedules: dict[str, float]) -> None:
+    """
+    Queue the scheduled kinds of jobs whose previous run finished longer ago than their interval, or that never ran.
+    Scheduled jobs use their kind as key, so a job asked for through the API meanwhile counts as a run.
+    """
+    with session_factory() as session:
+        for kind, interval in schedules.items():
+            if find_active_job(session, kind, kind):
+                continue
+            last_run = session.exec(
+                select(func.max(Job.finished_at)).where(Job.kind == kind, Job.key == kind)  # type: ignore
+            ).one()
+            if last_run is None or last_run <= datetime.now() - timedelta(seconds=interval):
+                enqueue_job(session, kind, {}, key=kind)
+
+
+class JobRunner:
+    """Worker threads that run the queued jobs of a database, and queue the scheduled ones."""
+
+    def __init__(
+        self,
+        session_factory: Callable[[], Session],
+        worker_count: int = job_worker_count,
+        poll_interval: float = job_poll_interval,
+        schedules: Optional[dict[str, float]] = None,
+    ):
+        self.session_factory = session_factory
+        self.worker_count = worker_count
+        self.poll_interval = poll_interval
+        self.schedules = schedules or {}
+        self._threads: list[threading.Thread] = []
+        self._wake = threading.Event()
+        self._stopping = threading.Event()
+
+    def start(self) -> None:
+        requeue_interrupted_jobs(self.session_factory)
+        self._stopping.clear()
+        self._threads = [
+            threading.Thread(target=self._work, name=f"job-worker-{i}", daemon=True) for i in range(self.worker_count)
+        ]
+        for thread in self._threads:
+            thread.start()
+
+    def stop(self, timeout: float = 5.0) -> None:
+        """
+        Stop the workers. Jobs that do not finish within `timeout` seconds are interrupted when the process exits, and
+        queued again on the next start.
+        """
+        self._stopping.set()
+        self._wake.set()
+        for thread in self._threads:
+            thread.join(timeout)
+        self._threads = []
+
+    def notify(self) -> None:
+        """Wake the workers, e.g. after a job was queued."""
+        self._wake.set()
+
+    def run_pending(self) -> int:
+        """Run due jobs in the calling thread until none are left, and return how many ran."""
+        count = 0
+        while not self._stopping.is_set() and (job := claim_job(self.session_factory)):
+            run_job(self.session_factory, job)
+            count += 1
+        return count
+
+    def _work(self) -> None:
+        while not self._stopping.is_set():
+            try:
+                schedule_jobs(self.session_factory, self.schedules)
+                self.run_pending()
+            except Exception:
+                logger.exception("Job worker failed")
+            self._wake.wait(self.poll_interval)
+            self._wake.clear()
+
+
+job_runner = JobRunner(lambda: Session(engine), schedules=JOB_SCHEDULES)
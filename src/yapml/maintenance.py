@@ -0,0 +1,133 @@
+"""
+Keep the database compact and its query planner statistics fresh. Runs as a scheduled job, see jobs.py.
+
+Box history is append-only, so every edit of a box adds a version. Compaction drops the intermediate versions that
+are older than a retention window: the edits that were replaced by a later version. What remains of a lineage is its
+first version, the versions within the window, and its current or deleted version, still chained through
+previous_box_id. So the history keeps the creation and deletion of every box, and the recent edits.
+
+Then the pages that were freed are given back to the file system with an incremental vacuum, and the statistics are
+refreshed with ANALYZE and PRAGMA optimize.
+"""
+
+from datetime import datetime
+from typing import Callable, Optional
+
+from pydantic import BaseModel
+from sqlalchemy import ColumnElement, Connection, Engine, Table, bindparam, delete, func, update
+from sqlmodel import Session, select
+
+from yapml.config import delete_chunk_size, sqlite_analysis_limit
+from yapml.datamodel import BoundingBox, bump_generations
+
+ChunkCallback = Callable[[int], None]
+
+INCREMENTAL = 2  # PRAGMA auto_vacuum
+
+
+class MaintenanceReport(BaseModel):
+    compacted_versions: int = 0
+    bytes_reclaimed: int = 0
+    database_bytes: int = 0
+
+
+def compactable_condition(cutoff: datetime) -> ColumnElement[bool]:
+    """Versions that edited a box before `cutoff` and were replaced since."""
+    return (
+        BoundingBox.previous_box_id.is_not(None)  # type: ignore
+        & ~BoundingBox.is_head  # type: ignore
+        & BoundingBox.deleted_at.is_(None)  # type: ignore
+        & (BoundingBox.created_at < cutoff)  # type: ignore
+    )
+
+
+def count_compactable_versions(session: Session, cutoff: datetime) -> int:
+    return session.exec(select(func.count()).select_from(BoundingBox).where(compactable_condition(cutoff))).one()
+
+
+def compact_box_history(
+    session: Session, cutoff: datetime, chunk_size: int = delete_chunk_size, on_chunk: Optional[ChunkCallback] = None
+) -> int:
+    """
+    Delete the versions of boxes that compactable_condition selects, `chunk_size` lineages per transaction, and
+    point the versions after them at the version before them. Returns the number of versions deleted.
+    """
+    table: Table = BoundingBox.__table__  # type: ignore
+    compacted = 0
+    cursor = 0
+    while True:
+        lineage_ids = session.exec(
+            select(BoundingBox.lineage_id)
+            .where(compactable_condition(cutoff), BoundingBox.lineage_id > cursor)  # type: ignore
+            .distinct()
+            .order_by(BoundingBox.lineage_id)  # type: ignore
+            .limit(chunk_size)
+        ).all()
+        if not lineage_ids:
+            return compacted
+        cursor = lineage_ids[-1]
+        versions = session.execute(
+            select(
+                table.c.id,
+                table.c.previous_box_id,
+                table.c.function_id,
+                compactable_condition(cutoff).label("compactable"),
+            ).where(table.c.lineage_id.in_(lineage_ids))
+        ).all()
+        dropped = {row.id: row.previous_box_id for row in versions if row.compactable}
+
+        def kept_ancestor(box_id: int) -> int:
+            while box_id in dropped:
+                box_id = dropped[box_id]
+            return box_id
+
+        relinked = [
+            {"box_id": row.id, "previous_box_id": kept_ancestor(row.previous_box_id)}
+            for row in versions
+            if row.id not in dropped and row.previous_box_id in dropped
+        ]
+        # The dropped versions go first, as previous_box_id is unique.
+        session.execute(delete(table).where(table.c.id.in_(list(dropped))))
+        if relinked:
+            session.connection().execute(
+                update(table)
+                .where(table.c.id == bindparam("box_id"))
+                .values(previous_box_id=bindparam("previous_box_id")),
+                relinked,
+            )
+        bump_generations(session, [row.function_id for row in versions if row.id in dropped])
+        session.commit()
+        compacted += len(dropped)
+        if on_chunk:
+            on_chunk(len(dropped))
+
+
+def database_file_bytes(connection: Connection) -> int:
+    page_size = connection.exec_driver_sql("PRAGMA page_size").scalar_one()
+    return connection.exec_driver_sql("PRAGMA page_count").scalar_one() * page_size
+
+
+def vacuum_and_analyze(engine: Engine, analysis_limit: int = sqlite_analysis_limit) -> tuple[int, int]:
+    """
+    Give the free pages of the database back to the file system, and refresh the query planner's statistics. Returns
+    the size of the database file in bytes before and after the vacuum. Converting a database can grow it a little,
+    as incremental vacuum keeps a map of its pages.
+
+    Databases created before auto_vacuum was configured are converted with a full VACUUM the first time, which holds
+    the write lock until it is done. After that, freeing pages is incremental and cheap.
+    """
+    with engine.connect() as connection:
+        connection = connection.execution_options(isolation_level="AUTOCOMMIT")
+        before = database_file_bytes(connection)
+        if connection.exec_driver_sql("PRAGMA auto_vacuum").scalar_one() != INCREMENTAL:
+            connection.exec_driver_sql("PRAGMA auto_vacuum = INCREMENTAL")
+            connection.exec_driver_sql("VACUUM")
+        else:
+            # The sqlite3 module steps a statement only once, which frees a single page. A script runs to the end.
+            connection.connection.driver_connection.executescript("PRAGMA incremental_vacuum;")  # type: ignore
+        after = database_file_bytes(connection)
+        connection.exec_driver_sql(f"PRAGMA analysis_limit = {analysis_limit}")
+        connection.exec_driver_sql("ANALYZE")
+        connection.exec_driver_sql("PRAGMA optimize")
+        connection.exec_driver_sql("PRAGMA wal_checkpoint(TRUNCATE)")
+        return before, after
@@ -0,0 +1,137 @@
+"""
+Schema migrations for the SQLite database.
+
+The schema version is stored in SQLite's `PRAGMA user_version`. A new database is created from the models and starts
+at the latest version. An existing database is brought up to date by running the migrations it has not seen yet, in
+order. SQLite runs DDL outside of transactions, so every migration is written to be safe to run again if it was
+interrupted halfway.
+
+Indexes are not migrated one by one. The models declare the full index set, and `sync_indexes` creates missing ones
+and drops `ix_` indexes that are no longer declared, every time the database is migrated.
+
+To migrate the database in place:
+
+    python -m yapml.migrations
+"""
+
+from datetime import datetime
+from typing import Callable
+
+from sqlalchemy import Connection, Engine, inspect, text
+from sqlmodel import SQLModel
+
+import yapml.datamodel  # noqa: F401  Registers the tables with SQLModel.metadata.
+
+
+def table_columns(connection: Connection, table: str) -> set[str]:
+    return {row[1] for row in connection.exec_driver_sql(f"PRAGMA table_info({table})")}
+
+
+def add_column(connection: Connection, table: str, column: str, definition: str) -> None:
+    if column not in table_columns(connection, table):
+        connection.exec_driver_sql(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
+
+
+def add_hash_and_box_version_columns(connection: Connection) -> None:
+    add_column(connection, "objectdetectionsample", "perceptual_hash", "VARCHAR")
+    add_column(connection, "boundingbox", "lineage_id", "INTEGER")
+    add_column(connection, "boundingbox", "version", "INTEGER NOT NULL DEFAULT 1")
+    add_column(connection, "boundingbox", "is_head", "BOOLEAN NOT NULL DEFAULT 1")
+
+
+def backfill_box_versions(connection: Connection) -> None:
+    """Derive lineage_id, version and is_head of existing boxes from their previous_box_id chains."""
+    rows = connection.exec_driver_sql("SELECT id, previous_box_id, deleted_at FROM boundingbox ORDER BY id").all()
+    replaced = {previous_box_id for _, previous_box_id, _ in rows if previous_box_id is not None}
+    lineage: dict[int, tuple[int, int]] = {}  # box id -> (lineage_id, version)
+    updates = []
+    for box_id, previous_box_id, deleted_at in rows:
+        # A box always has a higher id than the version it replaced.
+        if previous_box_id in lineage:
+            lineage_id, version = lineage[previous_box_id]
+            lineage[box_id] = (lineage_id, version + 1)
+        else:
+            lineage[box_id] = (box_id, 1)
+        is_head = deleted_at is None and box_id not in replaced
+        updates.append(
+            {"id": box_id, "lineage_id": lineage[box_id][0], "version": lineage[box_id][1], "is_head": is_head}
+        )
+    if updates:
+        connection.execute(
+            text(
+                "UPDATE boundingbox SET lineage_id = :lineage_id, version = :version, is_head = :is_head WHERE id = :id"
+            ),
+            updates,
+        )
+
+
+def add_sample_mime_type_column(connection: Connection) -> None:
+    # Samples stored before the column existed get their type sniffed when their image is served.
+    add_column(connection, "objectdetectionsample", "mime_type", "VARCHAR")
+
+
+def add_job_result_column(connection: Connection) -> None:
+    add_column(connection, "job", "result", "VARCHAR")
+
+
+def cancel_duplicate_active_jobs(connection: Connection) -> None:
+    """Keep the first of the active jobs with the same kind and key, so that ix_job_kind_key_active can be created."""
+    connection.execute(
+        text(
+            """
+            UPDATE job SET status = 'cancelled', finished_at = :now
+            WHERE status IN ('queued', 'running') AND key IS NOT NULL AND id > (
+                SELECT min(first.id) FROM job AS first
+                WHERE first.kind = job.kind AND first.key = job.key AND first.status IN ('queued', 'running')
+            )
+            """
+        ),
+        {"now": datetime.now().isoformat(sep=" ")},
+    )
+
+
+# Append only. The schema version of a database is the number of migrations it has been through.
+MIGRATIONS: list[Callable[[Connection], None]] = [
+    add_hash_and_box_version_columns,
+    backfill_box_versions,
+    add_sample_mime_type_column,
+    add_job_result_column,
+    cancel_duplicate_active_jobs,
+]
+
+
+def schema_version(connection: Connection) -> int:
+    return connection.exec_driver_sql("PRAGMA user_version").scalar_one()
+
+
+def sync_indexes(connection: Connection) -> None:
+    """Create the indexes declared on the models that are missing, and drop `ix_` indexes that are not declared."""
+    for table in SQLModel.metadata.sorted_tables:
+        declared = {index.name: index for index in table.indexes}
+        existing = {row[1] for row in connection.exec_driver_sql(f"PRAGMA index_list({table.name})") if row[3] == "c"}
+        for name in existing - declared.keys():
+            if name.startswith("ix_"):
+                connection.exec_driver_sql(f"DROP INDEX {name}")
+        for name in declared.keys() - existing:
+            declared[name].create(connection)
+
+
+def migrate(engine: Engine) -> int:
+    """Create or upgrade the database schema, and return the resulting schema version."""
+    with engine.begin() as connection:
+        is_new = not inspect(connection).get_table_names()
+        # Creates tables added since the database was created. Columns are added by the migrations.
+        SQLModel.metadata.create_all(connection)
+        version = len(MIGRATIONS) if is_new else schema_version(connection)
+        for number, migration in enumerate(MIGRATIONS[version:], start=version + 1):
+            migration(connection)
+            connection.exec_driver_sql(f"PRAGMA user_version = {number}")
+        connection.exec_driver_sql(f"PRAGMA user_version = {len(MIGRATIONS)}")
+        sync_indexes(connection)
+    return len(MIGRATIONS)
+
+
+if __name__ == "__main__":
+    from yapml.db import engine
+
+    print(f"Database is at schema version {migrate(engine)}")
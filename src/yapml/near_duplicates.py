@@ -0,0 +1,212 @@
+import threading
+from itertools import combinations
+from typing import Iterator, Optional
+
+import numpy as np
+from pydantic import BaseModel
+from sqlmodel import Session, select
+
+from yapml.config import near_duplicate_radius
+from yapml.datamodel import ObjectDetectionSample
+
+# Items added since the last rebuild are kept in a small buffer that is scanned linearly.
+_BUFFER_SIZE = 4096
+
+
+def hamming_distance(perceptual_hash_a: str, perceptual_hash_b: str) -> int:
+    return (int(perceptual_hash_a, 16) ^ int(perceptual_hash_b, 16)).bit_count()
+
+
+class NearDuplicate(BaseModel):
+    sample_id: int
+    distance: int
+
+
+class NearDuplicateCluster(BaseModel):
+    sample_ids: list[int]
+
+
+class NearDuplicateIndex:
+    """
+    Multi-index hashing index of 64-bit perceptual hashes, for Hamming-radius queries.
+
+    The hash is split into `blocks` blocks. If two hashes differ in at most r bits, at least one of their blocks
+    differs in at most r // blocks bits (pigeonhole principle). So a query only needs to look at hashes that have a
+    block within that distance of the query's block, found by binary search in per-block sorted arrays, and checks
+    the true distance of those candidates only. With `blocks` > r this means exact block matches.
+    """
+
+    def __init__(self, blocks: int = near_duplicate_radius + 1):
+        self.blocks = blocks
+        widths = [64 // blocks + (1 if i < 64 % blocks else 0) for i in range(blocks)]
+        self._shifts = [sum(widths[i + 1 :]) for i in range(blocks)]
+        self._widths = widths
+        self._ids = np.empty(0, dtype=np.int64)
+        self._hashes = np.empty(0, dtype=np.uint64)
+        self._sorted_blocks: list[tuple[np.ndarray, np.ndarray]] = []  # (sorted block values, positions)
+        self._buffer_ids: list[int] = []
+        self._buffer_hashes: list[int] = []
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._ids) + len(self._buffer_ids)
+
+    def add(self, sample_id: int, perceptual_hash: str) -> None:
+        with self._lock:
+            self._buffer_ids.append(sample_id)
+            self._buffer_hashes.append(int(perceptual_hash, 16))
+            if len(self._buffer_ids) >= _BUFFER_SIZE:
+                self._rebuild()
+
+    def add_many(self, sample_ids: list[int], perceptual_hashes: list[str]) -> None:
+        with self._lock:
+            self._buffer_ids.extend(sample_ids)
+            self._buffer_hashes.extend(int(h, 16) for h in perceptual_hashes)
+            self._rebuild()
+
+    def _rebuild(self) -> None:
+        self._ids = np.concatenate([self._ids, np.array(self._buffer_ids, dtype=np.int64)])
+        self._hashes = np.concatenate([self._hashes, np.array(self._buffer_hashes, dtype=np.uint64)])
+        self._buffer_ids, self._buffer_hashes = [], []
+        self._sorted_blocks = []
+        for block in range(self.blocks):
+            values = self._block_values(self._hashes, block)
+            order = np.argsort(values, kind="stable")
+            self._sorted_blocks.append((values[order], order))
+
+    def _block_values(self, hashes: np.ndarray, block: int) -> np.ndarray:
+        mask = np.uint64((1 << self._widths[block]) - 1)
+        return (hashes >> np.uint64(self._shifts[block])) & mask
+
+    def _probes(self, value: int, block: int, radius: int) -> Iterator[int]:
+        """All block values within `radius` bits of `value`."""
+        for r in range(radius + 1):
+            for bits in combinations(range(self._widths[block]), r):
+                probe = value
+                for bit in bits:
+                    probe ^= 1 << bit
+                yield probe
+
+    def _candidates(self, target: int, radius: int) -> tuple[np.ndarray, np.ndarray]:
+        """Ids and hashes of everything that may be within `radius` of `target`. Call with the lock held."""
+        positions = [np.empty(0, dtype=np.int64)]
+        sub_radius = radius // self.blocks
+        for block, (values, order) in enumerate(self._sorted_blocks):
+            target_value = (target >> self._shifts[block]) & ((1 << self._widths[block]) - 1)
+            for probe in self._probes(target_value, block, sub_radius):
+                # Probes must match the dtype of the values, or numpy converts the whole array on every search.
+                start, stop = values.searchsorted(np.array([probe, probe + 1], dtype=values.dtype))
+                positions.append(order[start:stop])
+        unique_positions = np.unique(np.concatenate(positions))
+        ids = np.concatenate([self._ids[unique_positions], np.array(self._buffer_ids, dtype=np.int64)])
+        hashes = np.concatenate([self._hashes[unique_positions], np.array(self._buffer_hashes, dtype=np.uint64)])
+        return ids, hashes
+
+    def query(self, perceptual_hash: str, radius: int = near_duplicate_radius) -> list[NearDuplicate]:
+        """Samples whose hash is within `radius` bits of `perceptual_hash`, closest first."""
+        target = int(perceptual_hash, 16)
+        with self._lock:
+            ids, hashes = self._candidates(target, radius)
+        distances = np.bitwise_count(hashes ^ np.uint64(target))
+        matches = np.flatnonzero(distances <= radius)
+        matches = matches[np.argsort(distances[matches], kind="stable")]
+        return [NearDuplicate(sample_id=int(ids[i]), distance=int(distances[i])) for i in matches]
+
+    def clusters(self, radius: int = near_duplicate_radius) -> list[NearDuplicateCluster]:
+        """
+        Group samples into clusters of near-duplicates, i.e. connected components of the "within `radius`" graph.
+
+        Only samples that have at least one near-duplicate are returned.
+        """
+        with self._lock:
+            if self._buffer_ids:
+                self._rebuild()
+            ids = self._ids
+            # Samples with identical hashes are trivially clustered, so only distinct hashes are compared.
+            hashes, inverse = np.unique(self._hashes, return_inverse=True)
+            if radius >= self.blocks:
+                candidates = [self._candidates(int(value), radius)[1] for value in hashes]
+
+        parents = np.arange(len(hashes))
+
+        def find(i: int) -> int:
+            while parents[i] != i:
+                parents[i] = parents[parents[i]]
+                i = parents[i]
+            return i
+
+        def union(pairs_a: np.ndarray, pairs_b: np.ndarray) -> None:
+            for a, b in zip(pairs_a.tolist(), pairs_b.tolist()):
+                root_a, root_b = find(a), find(b)
+                if root_a != root_b:
+                    parents[max(root_a, root_b)] = min(root_a, root_b)
+
+        if radius < self.blocks:
+            # Every near-duplicate pair shares at least one block exactly, so only compare within runs of equal
+            # block values. Rows are compared in chunks to bound memory for large runs.
+            for block in range(self.blocks):
+                values = self._block_values(hashes, block)
+                order = np.argsort(values, kind="stable")
+                boundaries = np.flatnonzero(values[order][1:] != values[order][:-1]) + 1
+                for members in np.split(order, boundaries):
+                    if len(members) < 2:
+                        continue
+                    for chunk_start in range(0, len(members), 1024):
+                        rows = members[chunk_start : chunk_start + 1024]
+                        distances = np.bitwise_count(hashes[rows][:, None] ^ hashes[members][None, :])
+                        a, b = np.nonzero(distances <= radius)
+                        keep = rows[a] < members[b]
+                        union(rows[a][keep], members[b][keep])
+        else:
+            for position, value in enumerate(hashes):
+                candidate_hashes = candidates[position]
+                matches = np.unique(candidate_hashes[np.bitwise_count(candidate_hashes ^ value) <= radius])
+                union(np.full(len(matches), position), np.searchsorted(hashes, matches))
+
+        roots = np.array([find(i) for i in range(len(hashes))], dtype=np.int64)[inverse]
+        clusters: dict[int, list[int]] = {}
+        for position in np.argsort(roots, kind="stable"):
+            clusters.setdefault(int(roots[position]), []).append(int(ids[position]))
+        return [NearDuplicateCluster(sample_ids=sorted(members)) for members in clusters.values() if len(members) > 1]
+
+
+class NearDuplicateRegistry:
+    """In-process near-duplicate indexes, one per function, loaded from the database on first use."""
+
+    def __init__(self):
+        self._indexes: dict[int, NearDuplicateIndex] = {}
+        self._lock = threading.Lock()
+
+    def get(self, session: Session, function_id: int) -> NearDuplicateIndex:
+        with self._lock:
+            if function_id in self._indexes:
+                return self._indexes[function_id]
+        rows = session.exec(
+            select(ObjectDetectionSample.id, ObjectDetectionSample.perceptual_hash)
+            .where(ObjectDetectionSample.function_id == function_id)
+            .where(ObjectDetectionSample.perceptual_hash.is_not(None))  # type: ignore
+        ).all()
+        index = NearDuplicateIndex()
+        index.add_many([sample_id for sample_id, _ in rows], [phash for _, phash in rows])
+        with self._lock:
+            return self._indexes.setdefault(function_id, index)
+
+    def add(self, sample: ObjectDetectionSample) -> None:
+        """Add a committed sample to the index of its function, if that index is loaded."""
+        if sample.id is None or sample.perceptual_hash is None:
+            return
+        with self._lock:
+            index = self._indexes.get(sample.function_id)
+        if index is not None:
+            index.add(sample.id, sample.perceptual_hash)
+
+    def invalidate(self, function_id: Optional[int] = None) -> None:
+        """Drop the index of a function, or all indexes, e.g. after samples were deleted."""
+        with self._lock:
+            if function_id is None:
+                self._indexes.clear()
+            else:
+                self._indexes.pop(function_id, None)
+
+
+near_duplicate_registry = NearDuplicateRegistry()
@@ -1,11 +1,13 @@
 from .admin_routes import router as admin_router
-from .boundingbox_routes import list_boxes
+from .boundingbox_routes import fetch_box_history, get_box, list_boxes
 from .boundingbox_routes import router as boundingbox_router
 from .function_routes import list_functions
 from .function_routes import router as function_router
-from .label_routes import list_labels
+from .import_routes import router as import_router
+from .job_routes import router as job_router
+from .label_routes import fetch_labels, list_labels
 from .label_routes import router as label_router
-from .sample_routes import get_sample, list_samples
+from .sample_routes import SamplePage, fetch_sample_page, get_sample, list_samples
 from .sample_routes import router as sample_router
 
 __all__ = [
@@ -14,9 +16,16 @@ __all__ = [
     "label_router",
     "sample_router",
     "list_samples",
+    "fetch_sample_page",
+    "SamplePage",
     "get_sample",
     "list_labels",
+    "fetch_labels",
     "function_router",
+    "import_router",
+    "job_router",
     "list_boxes",
+    "fetch_box_history",
+    "get_box",
     "list_functions",
 ]
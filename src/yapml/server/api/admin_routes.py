@@ -1,23 +1,49 @@
-from fastapi import APIRouter, Depends
+from fastapi import APIRouter, Depends, HTTPException, Query, Request
 from fastapi.responses import JSONResponse
-from sqlmodel import SQLModel
 
-from yapml.db import engine, get_session
-from yapml.fixtures import populate_db
+from yapml.config import box_history_retention_days, image_hash_strategy
+from yapml.db import get_session
+from yapml.hashing import HASH_STRATEGIES
+from yapml.jobs import enqueue_job
+from yapml.server.api.job_routes import accepted
 
 router = APIRouter(prefix="/api/detection", dependencies=[Depends(get_session)], tags=["Admin"])
 
 
-@router.post("/reset-db")
-async def reset_db() -> JSONResponse:
-    try:
-        # Drop all tables
-        SQLModel.metadata.drop_all(engine)
+@router.post("/reset-db", status_code=202)
+def reset_db(request: Request) -> JSONResponse:
+    """Drop and recreate all tables, and fill them with the fixtures, in a job."""
+    return accepted(enqueue_job(request.state.session, "reset_db", {}, key="reset_db", max_attempts=1))
 
-        # Create new tables
-        SQLModel.metadata.create_all(engine)
-        populate_db()
 
-        return JSONResponse({"status": "success", "message": "Database was reset successfully"})
-    except Exception as e:
-        return JSONResponse(status_code=500, content={"status": "error", "message": str(e)})
+@router.post("/maintenance", status_code=202)
+def run_maintenance(
+    request: Request, retention_days: int = Query(default=box_history_retention_days, ge=0)
+) -> JSONResponse:
+    """
+    Compact box versions that were replaced more than `retention_days` ago, then vacuum and analyze the database, in
+    a job. The job's result reports the versions compacted and the bytes reclaimed. This also runs on a schedule.
+    """
+    params = {"retention_days": retention_days}
+    return accepted(enqueue_job(request.state.session, "maintenance", params, key="maintenance"))
+
+
+@router.post("/rehash-images", status_code=202)
+def rehash_images(request: Request, strategy: str = image_hash_strategy) -> JSONResponse:
+    """
+    Re-key the image_hash of all stored samples, e.g. after changing the configured hash strategy, in a job. The job's
+    result is a RekeyReport.
+    """
+    if strategy not in HASH_STRATEGIES:
+        raise HTTPException(status_code=422, detail=f"Strategy must be one of {HASH_STRATEGIES}")
+    return accepted(enqueue_job(request.state.session, "rehash_images", {"strategy": strategy}, key="rehash_images"))
+
+
+@router.post("/backfill-perceptual-hashes", status_code=202)
+def backfill_hashes(request: Request) -> JSONResponse:
+    """
+    Compute perceptual hashes for stored samples that have none, so they take part in near-duplicate search, in a job.
+    The job's result holds the number of samples updated.
+    """
+    job = enqueue_job(request.state.session, "backfill_perceptual_hashes", {}, key="backfill_perceptual_hashes")
+    return accepted(job)
@@ -2,13 +2,33 @@
 from datetime import datetime
 from typing import Annotated, Optional
 
-from fastapi import APIRouter, Depends, HTTPException, Request, Response
+from fastapi import APIRouter, Depends, HTTPException, Query, Request, Response
 from fastlite import ver2tuple
 from pydantic import AfterValidator, BaseModel, ValidationError
-from sqlmodel import select
+from sqlalchemy import literal, or_, tuple_, union_all
+from sqlalchemy.orm import selectinload
+from sqlmodel import Session, select
 
-from yapml.datamodel import BoundingBox, Label, ObjectDetectionSample
+from yapml.box_batches import (
+    GEOMETRY_FIELDS,
+    BoxBatchResult,
+    BoxBatchUpdate,
+    BoxCreate,
+    create_boxes,
+    delete_boxes,
+    update_boxes,
+)
+from yapml.config import (
+    box_edit_coalesce_window,
+    box_history_page_size,
+    max_box_batch_size,
+    max_box_history_page_size,
+)
+from yapml.datamodel import BoundingBox, BoxHistoryPage, Label, ObjectDetectionSample
 from yapml.db import get_session
+from yapml.deletion import label_deletion_pending
+from yapml.server.etags import check_etag, check_sample_etag, etag_headers
+from yapml.utils import box_change
 
 router = APIRouter(prefix="/api/detection", dependencies=[Depends(get_session)], tags=["Object Detection Boxes"])
 
@@ -22,7 +42,7 @@ def validate_box(box: BoundingBox) -> BoundingBox:
 
 
 @router.get("/boxes/{box_id}")
-async def get_box(request: Request, box_id: int) -> BoundingBox:
+def get_box(request: Request, box_id: int) -> BoundingBox:
     session = request.state.session
     box = session.get(BoundingBox, box_id)
     if not box:
@@ -31,24 +51,40 @@ async def get_box(request: Request, box_id: int) -> BoundingBox:
 
 
 @router.get("/boxes")
-async def list_boxes(
+def list_boxes(
     request: Request,
+    response: Response,
     include_deleted: bool = False,
+    include_stale: bool = False,
     sample_id: Optional[int] = None,
     function_id: Optional[int] = None,
 ) -> list[BoundingBox]:
+    """
+    List the current version of boxes. Pass `include_stale` to also list the versions that were replaced by an
+    update, and `include_deleted` to also list deleted boxes.
+    """
     session = request.state.session
-    boxes = session.exec(
-        select(BoundingBox)
-        .where(BoundingBox.deleted_at.is_(None) if not include_deleted else True)  # type: ignore
-        .where(BoundingBox.sample_id == sample_id if sample_id else True)
-        .where(BoundingBox.sample.function_id == function_id if function_id else True)
-    ).all()
-    return boxes
+    if function_id is None and sample_id is not None:
+        etag = check_sample_etag(request, sample_id)
+    else:
+        etag = check_etag(request, function_id)
+    response.headers.update(etag_headers(etag))
+    query = select(BoundingBox)
+    if include_stale and not include_deleted:
+        query = query.where(BoundingBox.deleted_at.is_(None))  # type: ignore
+    elif include_deleted and not include_stale:
+        query = query.where(or_(BoundingBox.is_head, BoundingBox.deleted_at.is_not(None)))  # type: ignore
+    elif not include_stale and not include_deleted:
+        query = query.where(BoundingBox.is_head)
+    if sample_id is not None:
+        query = query.where(BoundingBox.sample_id == sample_id)
+    if function_id is not None:
+        query = query.where(BoundingBox.function_id == function_id)
+    return list(session.exec(query).all())
 
 
 @router.post("/boxes", response_model=BoundingBox)
-async def create_box(request: Request, box: BoundingBox) -> BoundingBox:
+def create_box(request: Request, box: BoundingBox) -> BoundingBox:
     session = request.state.session
 
     # Verify sample and label exist
@@ -57,8 +93,10 @@ async def create_box(request: Request, box: BoundingBox) -> BoundingBox:
         raise HTTPException(status_code=404, detail="Sample not found")
 
     label = session.get(Label, box.label_id)
-    if not label:
+    if not label or label.deleted_at is not None:
         raise HTTPException(status_code=404, detail="Label not found")
+    if session.exec(select(label_deletion_pending(Label.id)).where(Label.id == label.id)).one():  # type: ignore
+        raise HTTPException(status_code=409, detail="Label is being deleted")
 
     # Create new box
     _ = validate_box(box)
@@ -68,6 +106,38 @@ async def create_box(request: Request, box: BoundingBox) -> BoundingBox:
     return box
 
 
+def check_batch_size(items: list) -> None:
+    if len(items) > max_box_batch_size:
+        raise HTTPException(status_code=413, detail=f"At most {max_box_batch_size} boxes per batch")
+
+
+@router.post("/boxes/batch")
+def create_boxes_batch(request: Request, boxes: list[BoxCreate]) -> list[BoxBatchResult]:
+    """
+    Create many boxes at once, e.g. model pre-annotations.
+
+    Returns one result per box, in input order, with its status: "created" or "error". Boxes with errors are skipped,
+    the others are created.
+    """
+    check_batch_size(boxes)
+    return create_boxes(request.state.session, boxes)
+
+
+# Declared before PUT /boxes/{box_id}, which would match "batch" too.
+@router.put("/boxes/batch")
+def update_boxes_batch(request: Request, updates: list[BoxBatchUpdate]) -> list[BoxBatchResult]:
+    """Update many boxes at once. Returns one result per update, with its status: "updated" or "error"."""
+    check_batch_size(updates)
+    return update_boxes(request.state.session, updates)
+
+
+@router.post("/boxes/batch/delete")
+def delete_boxes_batch(request: Request, box_ids: list[int]) -> list[BoxBatchResult]:
+    """Delete many boxes at once. Returns one result per box id, with its status: "deleted" or "error"."""
+    check_batch_size(box_ids)
+    return delete_boxes(request.state.session, box_ids)
+
+
 class BoxUpdate(BaseModel):
     center_x: Optional[float] = None
     center_y: Optional[float] = None
@@ -76,17 +146,38 @@ class BoxUpdate(BaseModel):
     annotator_name: Optional[str] = None
 
 
+def amends_edit(box: BoundingBox, annotator_name: str, now: datetime, window: float) -> bool:
+    """
+    True if an edit of `box` should change it in place rather than add a new version: the box is itself an edit, by
+    the same annotator, made less than `window` seconds ago. A window of 0 turns this off.
+    """
+    return (
+        window > 0
+        and box.previous_box_id is not None
+        and box.annotator_name == annotator_name
+        and (now - box.created_at).total_seconds() < window
+    )
+
+
 @router.put("/boxes/{box_id}")
 def update_box(request: Request, box_id: int, update_data: BoxUpdate) -> BoundingBox:
+    """
+    Replace a box with a new version. Repeated edits of the same annotator within box_edit_coalesce_window seconds of
+    the version they made, like the steps of a drag, amend that version instead, which keeps its id and created_at.
+    """
     session = request.state.session
     box = session.get(BoundingBox, box_id)
     if not box:
         raise HTTPException(status_code=404, detail="Box not found")
+    if not box.is_head:
+        raise HTTPException(status_code=409, detail="Box is deleted or was replaced by a newer version")
     new_box = BoundingBox(
         sample_id=box.sample_id,
         function_id=box.function_id,
         previous_box_id=box.id,
-        label_id=box.label.id,
+        lineage_id=box.lineage_id or box.id,
+        version=box.version + 1,
+        label_id=box.label_id,
         center_x=update_data.center_x if update_data.center_x else box.center_x,
         center_y=update_data.center_y if update_data.center_y else box.center_y,
         width=update_data.width if update_data.width else box.width,
@@ -94,6 +185,18 @@ def update_box(request: Request, box_id: int, update_data: BoxUpdate) -> Boundin
         annotator_name=update_data.annotator_name if update_data.annotator_name else box.annotator_name,
     )
     _ = validate_box(new_box)
+    now = datetime.now()
+    if amends_edit(box, new_box.annotator_name, now, box_edit_coalesce_window):
+        # created_at stays when the version was made, so that the window is not restarted and a version holds the
+        # edits of one window at most.
+        for name in GEOMETRY_FIELDS:
+            setattr(box, name, getattr(new_box, name))
+        session.add(box)
+        session.commit()
+        session.refresh(box)
+        return box
+    new_box.created_at = now
+    box.is_head = False
     session.add_all([new_box, box])
     session.commit()
     session.refresh(new_box)
@@ -101,12 +204,100 @@ def update_box(request: Request, box_id: int, update_data: BoxUpdate) -> Boundin
 
 
 @router.delete("/boxes/{box_id}")
-async def delete_box(request: Request, box_id: int) -> Response:
+def delete_box(request: Request, box_id: int) -> Response:
     session = request.state.session
     box = session.get(BoundingBox, box_id)
     if not box:
         raise HTTPException(status_code=404, detail="Box not found")
     box.deleted_at = datetime.now()
+    box.is_head = False
     session.add(box)
     session.commit()
     return Response(status_code=204)
+
+
+def fetch_box_history(
+    session: Session,
+    sample_id: int,
+    lineage_id: Optional[int] = None,
+    cursor: Optional[str] = None,
+    limit: int = box_history_page_size,
+) -> BoxHistoryPage:
+    """
+    Fetch the box changes of a sample, newest first, starting after `cursor`.
+
+    Every box version is a "created", "moved" or "resized" event at its created_at, and a deleted version is also a
+    "deleted" event at its deleted_at. The events are ordered and paged in the database, so a page costs the same
+    however long the history is. Pass `lineage_id` to only show the history of one box.
+    """
+    versions = select(
+        BoundingBox.id.label("box_id"),  # type: ignore
+        BoundingBox.created_at.label("at"),  # type: ignore
+        literal(0).label("deleted"),
+    ).where(BoundingBox.sample_id == sample_id)
+    deletions = select(
+        BoundingBox.id.label("box_id"),  # type: ignore
+        BoundingBox.deleted_at.label("at"),  # type: ignore
+        literal(1).label("deleted"),
+    ).where(BoundingBox.sample_id == sample_id, BoundingBox.deleted_at.is_not(None))  # type: ignore
+    if lineage_id is not None:
+        versions = versions.where(BoundingBox.lineage_id == lineage_id)
+        deletions = deletions.where(BoundingBox.lineage_id == lineage_id)
+    events = union_all(versions, deletions).subquery()
+    query = select(events.c.box_id, events.c.at, events.c.deleted).order_by(
+        events.c.at.desc(), events.c.box_id.desc(), events.c.deleted.desc()
+    )
+    if cursor is not None:
+        query = query.where(
+            tuple_(events.c.at, events.c.box_id, events.c.deleted) < tuple_(*parse_history_cursor(cursor))
+        )
+    rows = session.exec(query.limit(limit + 1)).all()  # type: ignore
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = f"{rows[-1].at.isoformat()},{rows[-1].box_id},{rows[-1].deleted}"
+
+    # Load the boxes of the page, then the versions they replaced, to tell moves from resizes.
+    box_ids = {row.box_id for row in rows}
+    boxes = {box.id: box for box in load_boxes(session, box_ids)}
+    previous_ids = {box.previous_box_id for box in boxes.values() if box.previous_box_id is not None}
+    boxes.update({box.id: box for box in load_boxes(session, previous_ids - box_ids)})
+
+    now = datetime.now()
+    changes = []
+    for row in rows:
+        box = boxes[row.box_id]
+        change = box_change(box, bool(row.deleted), boxes.get(box.previous_box_id), now)
+        if change is not None:
+            changes.append(change)
+    return BoxHistoryPage(changes=changes, next_cursor=next_cursor)
+
+
+def parse_history_cursor(cursor: str) -> tuple[datetime, int, int]:
+    try:
+        at, box_id, deleted = cursor.split(",")
+        return datetime.fromisoformat(at), int(box_id), int(deleted)
+    except ValueError:
+        raise ValueError(f"Invalid history cursor: {cursor}")
+
+
+def load_boxes(session: Session, box_ids: set[int]) -> list[BoundingBox]:
+    if not box_ids:
+        return []
+    query = select(BoundingBox).where(BoundingBox.id.in_(box_ids)).options(selectinload(BoundingBox.label))  # type: ignore
+    return list(session.exec(query).all())
+
+
+@router.get("/samples/{sample_id}/history")
+def get_box_history(
+    request: Request,
+    sample_id: int,
+    lineage_id: Optional[int] = None,
+    cursor: Optional[str] = None,
+    limit: Annotated[int, Query(ge=1, le=max_box_history_page_size)] = box_history_page_size,
+) -> BoxHistoryPage:
+    """Page through the box changes of a sample, newest first. Pass `next_cursor` as `cursor` for the next page."""
+    try:
+        return fetch_box_history(request.state.session, sample_id, lineage_id=lineage_id, cursor=cursor, limit=limit)
+    except ValueError as e:
+        raise HTTPException(status_code=422, detail=str(e))
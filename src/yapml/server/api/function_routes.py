@@ -1,10 +1,18 @@
-from fastapi import APIRouter, Depends, Form, HTTPException, Request, Response
-from fastapi.responses import RedirectResponse
+import re
+from typing import Annotated
+from urllib.parse import quote
+
+from fastapi import APIRouter, Depends, Form, HTTPException, Query, Request, Response
+from fastapi.responses import RedirectResponse, StreamingResponse
 from pydantic import BaseModel, ValidationError
-from sqlmodel import select
+from sqlmodel import Session, select
 
-from yapml.datamodel import FunctionType, YapFunction
-from yapml.db import get_session
+from yapml.datamodel import FunctionType, Label, YapFunction
+from yapml.db import get_session, read_snapshot
+from yapml.deletion import count_function_rows
+from yapml.export import ExportFormat, export_dataset
+from yapml.jobs import JobStatus
+from yapml.server.api.job_routes import delete_or_enqueue
 
 router = APIRouter(prefix="/api/detection", dependencies=[Depends(get_session)], tags=["Functions"])
 
@@ -18,7 +26,7 @@ def validate_function(function: YapFunction) -> YapFunction:
 
 
 @router.get("/functions/{function_id}")
-async def get_function(request: Request, function_id: int) -> YapFunction:
+def get_function(request: Request, function_id: int) -> YapFunction:
     session = request.state.session
     function = session.get(YapFunction, function_id)
     if not function:
@@ -27,15 +35,65 @@ async def get_function(request: Request, function_id: int) -> YapFunction:
 
 
 @router.get("/functions")
-async def list_functions(request: Request) -> list[YapFunction]:
+def list_functions(request: Request) -> list[YapFunction]:
     session = request.state.session
     query = select(YapFunction)
     results = session.exec(query).all()
     return results
 
 
+@router.get("/functions/{function_id}/export")
+def export_function(
+    request: Request,
+    function_id: int,
+    export_format: Annotated[ExportFormat, Query(alias="format")] = "coco",
+    images: bool = False,
+) -> StreamingResponse:
+    """
+    Download the current boxes of a function as a COCO, YOLO or Pascal VOC dataset.
+
+    COCO is a JSON file, unless `images` is set. YOLO and VOC are zip archives. With `images`, the archive also holds
+    the images that are stored on this server. The dataset is streamed while it is read from the database.
+    """
+    session = request.state.session
+    function = session.get(YapFunction, function_id)
+    if not function:
+        raise HTTPException(status_code=404, detail="Function not found")
+    labels = session.exec(
+        select(Label).where(Label.function_id == function_id, Label.deleted_at.is_(None)).order_by(Label.id)  # type: ignore
+    ).all()
+
+    # The request session is closed before the response is streamed, so the export opens its own session. Formats
+    # like COCO read the samples more than once, and each pass has to see the same samples and boxes.
+    bind = session.get_bind()
+
+    def stream_export():
+        with Session(bind) as export_session, read_snapshot(export_session):
+            yield from export_dataset(export_session, function, list(labels), export_format, images)
+
+    is_json = export_format == "coco" and not images
+    suffix = f"-{export_format}.{'json' if is_json else 'zip'}"
+    return StreamingResponse(
+        stream_export(),
+        media_type="application/json" if is_json else "application/zip",
+        headers={"Content-Disposition": content_disposition(function.name, suffix)},
+    )
+
+
+def content_disposition(name: str, suffix: str) -> str:
+    """
+    An attachment header for a file named after `name`. Headers are Latin-1, so the plain filename keeps only ASCII
+    characters, and a name with other characters is also sent in full as an RFC 5987 `filename*`.
+    """
+    ascii_name = re.sub(r"[^A-Za-z0-9_.-]+", "_", name) + suffix
+    header = f'attachment; filename="{ascii_name}"'
+    if not name.isascii():
+        header += "; filename*=UTF-8''" + quote(re.sub(r"[^\w.-]+", "_", name) + suffix)
+    return header
+
+
 @router.post("/functions", response_model=YapFunction)
-async def create_function(request: Request, function: YapFunction) -> YapFunction:
+def create_function(request: Request, function: YapFunction) -> YapFunction:
     session = request.state.session
 
     # Check if function with this name already exists
@@ -52,9 +110,7 @@ async def create_function(request: Request, function: YapFunction) -> YapFunctio
 
 
 @router.post("/functions-form", include_in_schema=False)
-async def create_function_form(
-    request: Request, name: str = Form(...), description: str = Form(...)
-) -> RedirectResponse:
+def create_function_form(request: Request, name: str = Form(...), description: str = Form(...)) -> RedirectResponse:
     function = YapFunction(name=name, description=description, function_type=FunctionType.OBJECT_DETECTION)
     validate_function(function)
 
@@ -70,7 +126,7 @@ class FunctionUpdate(BaseModel):
 
 
 @router.put("/functions/{function_id}")
-async def update_function(request: Request, function_id: int, update_data: FunctionUpdate) -> YapFunction:
+def update_function(request: Request, function_id: int, update_data: FunctionUpdate) -> YapFunction:
     session = request.state.session
     function = session.get(YapFunction, function_id)
     if not function:
@@ -96,13 +152,14 @@ async def update_function(request: Request, function_id: int, update_data: Funct
     return function
 
 
-@router.delete("/functions/{function_id}")
-async def delete_function(request: Request, function_id: int) -> Response:
+@router.delete("/functions/{function_id}", status_code=204, responses={202: {"model": JobStatus}})
+def delete_function(request: Request, function_id: int) -> Response:
+    """
+    Delete a function with its samples, boxes, labels and imports. Large functions are deleted by a job.
+    """
     session = request.state.session
     function = session.get(YapFunction, function_id)
     if not function:
         raise HTTPException(status_code=404, detail="Function not found")
-
-    session.delete(function)
-    session.commit()
-    return Response(status_code=204)
+    total_rows = count_function_rows(session, function_id)
+    return delete_or_enqueue(session, "function", function_id, total_rows)
@@ -0,0 +1,118 @@
+import os
+from typing import Annotated, Optional
+
+from fastapi import APIRouter, Depends, Form, HTTPException, Request, UploadFile
+from fastapi.concurrency import run_in_threadpool
+from pydantic import BaseModel
+from sqlmodel import Session, select
+
+from yapml.datamodel import ImportRun, YapFunction
+from yapml.db import get_session
+from yapml.importer import ImportFormat, ImportProgress, import_progress, unpack_upload
+from yapml.jobs import enqueue_job
+
+router = APIRouter(prefix="/api/detection", dependencies=[Depends(get_session)], tags=["Imports"])
+
+
+class ImportRequest(BaseModel):
+    source_format: ImportFormat
+    path: str  # The COCO annotation file or the YOLO dataset directory, on the server.
+    images_dir: Optional[str] = None  # For COCO, if the images are not next to the annotation file.
+
+
+def start_import(session: Session, run: ImportRun) -> ImportProgress:
+    job = enqueue_job(session, "import", {"import_run_id": run.id}, key=str(run.id))
+    return import_progress(run).model_copy(update={"job_id": job.id})
+
+
+def get_function_or_404(session: Session, function_id: int) -> YapFunction:
+    function = session.get(YapFunction, function_id)
+    if not function:
+        raise HTTPException(status_code=404, detail="Function not found")
+    return function
+
+
+def create_run(session: Session, run: ImportRun) -> ImportRun:
+    session.add(run)
+    session.commit()
+    session.refresh(run)
+    return run
+
+
+@router.post("/functions/{function_id}/imports", status_code=202)
+def create_import(request: Request, function_id: int, import_request: ImportRequest) -> ImportProgress:
+    """
+    Import a COCO or YOLO dataset that is on the server into a function. The import runs as a job, follow it with
+    GET /api/detection/imports/{import_id}.
+    """
+    session = request.state.session
+    get_function_or_404(session, function_id)
+    if not os.path.exists(import_request.path):
+        raise HTTPException(status_code=422, detail=f"{import_request.path} does not exist")
+    run = ImportRun(
+        function_id=function_id,
+        source_format=import_request.source_format,
+        source_path=import_request.path,
+        images_dir=import_request.images_dir,
+    )
+    return start_import(session, create_run(session, run))
+
+
+@router.post("/functions/{function_id}/imports/upload", status_code=202)
+async def upload_import(
+    request: Request,
+    function_id: int,
+    archive: UploadFile,
+    source_format: Annotated[ImportFormat, Form()],
+    annotations: Annotated[Optional[str], Form()] = None,
+) -> ImportProgress:
+    """
+    Import a COCO or YOLO dataset uploaded as a zip archive. For COCO, `annotations` is the path of the annotation file
+    in the archive, by default the first JSON file in it.
+    """
+    session = request.state.session
+    await run_in_threadpool(get_function_or_404, session, function_id)
+    # Give the connection back while the archive is copied and extracted, which can take long.
+    await run_in_threadpool(session.close)
+    try:
+        upload_dir, source_path = await run_in_threadpool(unpack_upload, archive.file, source_format, annotations)
+    except ValueError as e:
+        raise HTTPException(status_code=422, detail=str(e))
+
+    run = ImportRun(
+        function_id=function_id, source_format=source_format, source_path=source_path, upload_dir=upload_dir
+    )
+    return await run_in_threadpool(lambda: start_import(session, create_run(session, run)))
+
+
+@router.get("/imports/{import_id}")
+def get_import(request: Request, import_id: int) -> ImportProgress:
+    """The progress and throughput of an import."""
+    run = request.state.session.get(ImportRun, import_id)
+    if not run:
+        raise HTTPException(status_code=404, detail="Import not found")
+    return import_progress(run)
+
+
+@router.get("/functions/{function_id}/imports")
+def list_imports(request: Request, function_id: int) -> list[ImportProgress]:
+    session = request.state.session
+    runs = session.exec(
+        select(ImportRun).where(ImportRun.function_id == function_id).order_by(ImportRun.id.desc())  # type: ignore
+    ).all()
+    return [import_progress(run) for run in runs]
+
+
+@router.post("/imports/{import_id}/resume", status_code=202)
+def resume_import(request: Request, import_id: int) -> ImportProgress:
+    """
+    Continue an import that failed or was interrupted, with the images that were not ingested yet. If its job is
+    still queued, for a retry, it runs right away.
+    """
+    session = request.state.session
+    run = session.get(ImportRun, import_id)
+    if not run:
+        raise HTTPException(status_code=404, detail="Import not found")
+    if run.status == "completed":
+        raise HTTPException(status_code=409, detail=f"Import is {run.status}")
+    return start_import(session, run)
@@ -0,0 +1,64 @@
+from typing import Optional
+
+from fastapi import APIRouter, Depends, HTTPException, Request, Response
+from fastapi.responses import JSONResponse
+from sqlmodel import Session, select
+
+from yapml.config import max_inline_delete_rows
+from yapml.datamodel import Job
+from yapml.db import get_session
+from yapml.deletion import DELETERS, DeletionTarget, deletion_key
+from yapml.jobs import JobStatus, cancel_job, enqueue_job, job_status
+
+router = APIRouter(prefix="/api/detection", dependencies=[Depends(get_session)], tags=["Jobs"])
+
+
+def accepted(job: Job) -> JSONResponse:
+    """Answer a request whose work was queued as a job with 202, the job, and its Location."""
+    return JSONResponse(
+        status_code=202,
+        content=job_status(job).model_dump(mode="json"),
+        headers={"Location": f"/api/detection/jobs/{job.id}"},
+    )
+
+
+def delete_or_enqueue(session: Session, target: DeletionTarget, target_id: int, total_rows: int) -> Response:
+    """Delete small targets right away and answer 204. Larger ones are deleted by a job."""
+    if total_rows <= max_inline_delete_rows:
+        DELETERS[target](session, target_id)
+        return Response(status_code=204)
+    job = enqueue_job(
+        session, "delete", {"target": target, "target_id": target_id}, key=deletion_key(target, target_id)
+    )
+    return accepted(job)
+
+
+def get_job_or_404(session: Session, job_id: int) -> Job:
+    job = session.get(Job, job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job
+
+
+@router.get("/jobs")
+def list_jobs(request: Request, status: Optional[str] = None, limit: int = 100) -> list[JobStatus]:
+    """The most recent jobs, optionally only those with the given status."""
+    query = select(Job).order_by(Job.id.desc()).limit(limit)  # type: ignore
+    if status is not None:
+        query = query.where(Job.status == status)
+    return [job_status(job) for job in request.state.session.exec(query).all()]
+
+
+@router.get("/jobs/{job_id}")
+def get_job(request: Request, job_id: int) -> JobStatus:
+    return job_status(get_job_or_404(request.state.session, job_id))
+
+
+@router.post("/jobs/{job_id}/cancel")
+def cancel(request: Request, job_id: int) -> JobStatus:
+    """Cancel a queued job, or ask a running job to stop at its next progress report."""
+    session = request.state.session
+    try:
+        return job_status(cancel_job(session, get_job_or_404(session, job_id)))
+    except ValueError as e:
+        raise HTTPException(status_code=409, detail=str(e))
@@ -1,12 +1,14 @@
-from datetime import datetime
-
 from fastapi import APIRouter, Depends, Form, HTTPException, Request, Response
 from fastapi.responses import RedirectResponse
 from pydantic import BaseModel, ValidationError
-from sqlmodel import select
+from sqlmodel import Session, func, select
 
-from yapml.datamodel import BoundingBox, Label
+from yapml.datamodel import BoundingBox, Label, LabelSummary
 from yapml.db import get_session
+from yapml.deletion import count_label_rows
+from yapml.jobs import JobStatus
+from yapml.server.api.job_routes import delete_or_enqueue
+from yapml.server.etags import check_etag, etag_headers
 
 router = APIRouter(prefix="/api/detection", dependencies=[Depends(get_session)], tags=["Object Detection Labels"])
 
@@ -20,7 +22,7 @@ def validate_label(label: Label) -> Label:
 
 
 @router.get("/labels/{label_id}")
-async def get_label(request: Request, label_id: int) -> Label:
+def get_label(request: Request, label_id: int) -> Label:
     session = request.state.session
     label = session.get(Label, label_id)
     if not label:
@@ -28,18 +30,54 @@ async def get_label(request: Request, label_id: int) -> Label:
     return label
 
 
-@router.get("/labels")
-async def list_labels(request: Request, function_id: int | None = None) -> list[Label]:
-    session = request.state.session
+def summarize_labels(session: Session, labels: list[Label]) -> list[LabelSummary]:
+    """
+    Count the current boxes of the labels in two grouped queries, whatever the number of boxes. Both are answered from
+    the label index of the boxes, without reading the boxes themselves.
+    """
+    summaries = {
+        label.id: LabelSummary(id=label.id, function_id=label.function_id, name=label.name, color=label.color)
+        for label in labels
+    }
+    if not summaries:
+        return []
+    head_boxes = (BoundingBox.label_id.in_(summaries), BoundingBox.is_head)  # type: ignore
+    counts = session.exec(
+        select(BoundingBox.label_id, func.count(), func.count(BoundingBox.sample_id.distinct()))  # type: ignore
+        .where(*head_boxes)
+        .group_by(BoundingBox.label_id)
+    )
+    for label_id, box_count, sample_count in counts:
+        summaries[label_id].box_count = box_count
+        summaries[label_id].sample_count = sample_count
+    annotator_counts = session.exec(
+        select(BoundingBox.label_id, BoundingBox.annotator_name, func.count())
+        .where(*head_boxes)
+        .group_by(BoundingBox.label_id, BoundingBox.annotator_name)
+    )
+    for label_id, annotator_name, box_count in annotator_counts:
+        summaries[label_id].annotator_box_counts[annotator_name] = box_count
+    return list(summaries.values())
+
+
+def fetch_labels(session: Session, function_id: int | None = None) -> list[LabelSummary]:
+    """The labels that are not deleted, with counts of their current boxes."""
     query = select(Label).where(Label.deleted_at.is_(None))  # type: ignore
     if function_id is not None:
         query = query.where(Label.function_id == function_id)
-    results = session.exec(query).all()
-    return results
+    results = session.exec(query.order_by(Label.id)).all()
+    return summarize_labels(session, results)
+
+
+@router.get("/labels")
+def list_labels(request: Request, response: Response, function_id: int | None = None) -> list[LabelSummary]:
+    """The labels that are not deleted, with counts of their current boxes."""
+    response.headers.update(etag_headers(check_etag(request, function_id)))
+    return fetch_labels(request.state.session, function_id)
 
 
 @router.post("/labels", response_model=Label)
-async def create_label_json(request: Request, label: Label) -> Label:
+def create_label_json(request: Request, label: Label) -> Label:
     session = request.state.session
 
     # Check if label with this name already exists
@@ -57,7 +95,7 @@ async def create_label_json(request: Request, label: Label) -> Label:
 
 # This is used for the form submission from the labels page.
 @router.post("/labels-form", include_in_schema=False)
-async def create_label_form(
+def create_label_form(
     request: Request, name: str = Form(...), color: str = Form(...), function_id: int = Form(...)
 ) -> RedirectResponse:
     label = Label(name=name, color=color, function_id=function_id)
@@ -75,7 +113,7 @@ class LabelUpdate(BaseModel):
 
 
 @router.put("/labels/{label_id}")
-async def update_label(request: Request, label_id: int, update_data: LabelUpdate) -> Label:
+def update_label(request: Request, label_id: int, update_data: LabelUpdate) -> Label:
     session = request.state.session
     label = session.get(Label, label_id)
     if not label:
@@ -98,22 +136,11 @@ async def update_label(request: Request, label_id: int, update_data: LabelUpdate
     return label
 
 
-@router.delete("/labels/{label_id}")
-async def delete_label(request: Request, label_id: int) -> Response:
+@router.delete("/labels/{label_id}", status_code=204, responses={202: {"model": JobStatus}})
+def delete_label(request: Request, label_id: int) -> Response:
+    """Delete a label and its current boxes. Labels with many boxes are deleted by a job."""
     session = request.state.session
     label = session.get(Label, label_id)
     if not label:
         raise HTTPException(status_code=404, detail="Label not found")
-
-    # Check if the label is used by any boxes
-    boxes = session.exec(select(BoundingBox).where(BoundingBox.label_id == label_id)).all()
-    for box in boxes:
-        box.deleted_at = datetime.now()
-        session.add(box)
-
-    label.deleted_at = datetime.now()
-    session.add(label)
-    session.commit()
-
-    # Return empty response with 204 No Content status
-    return Response(status_code=204)
+    return delete_or_enqueue(session, "label", label_id, count_label_rows(session, label_id))
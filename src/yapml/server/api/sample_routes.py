@@ -1,17 +1,39 @@
-import hashlib
-
-from fastapi import APIRouter, Depends, HTTPException, Request, Response
-from PIL import Image as PILImage
-from pydantic import ValidationError
-from sqlmodel import select
-
-from yapml.config import image_dir, image_url_prefix
-from yapml.datamodel import ObjectDetectionSample
+from typing import Annotated, AsyncIterator, Optional
+
+from fastapi import APIRouter, Depends, HTTPException, Query, Request, Response
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import StreamingResponse
+from pydantic import BaseModel, ValidationError
+from sqlalchemy.orm import selectinload
+from sqlmodel import Session, select
+from starlette.datastructures import UploadFile
+
+from yapml.config import (
+    max_image_bytes,
+    max_ingest_batch_size,
+    max_sample_page_size,
+    near_duplicate_radius,
+    sample_page_size,
+)
+from yapml.datamodel import BoundingBox, ObjectDetectionSample
 from yapml.db import get_session
-from yapml.image_processing import ImageDecoder
+from yapml.ingestion import (
+    DecodedSample,
+    decode_spooled_sample,
+    discard_spooled_image,
+    fetch_and_decode_sample,
+    find_near_duplicate,
+    ingest_samples,
+    spool_upload,
+    store_image,
+)
+from yapml.near_duplicates import NearDuplicate, NearDuplicateCluster, near_duplicate_registry
+from yapml.server.etags import check_etag, etag_headers
 
 router = APIRouter(prefix="/api/detection", dependencies=[Depends(get_session)], tags=["Object Detection Samples"])
 
+NearDuplicateRadius = Annotated[Optional[int], Query(ge=0, le=16)]
+
 
 def validate_sample(sample: ObjectDetectionSample) -> ObjectDetectionSample:
     try:
@@ -22,7 +44,7 @@ def validate_sample(sample: ObjectDetectionSample) -> ObjectDetectionSample:
 
 
 @router.get("/samples/{sample_id}")
-async def get_sample(request: Request, sample_id: int) -> ObjectDetectionSample:
+def get_sample(request: Request, sample_id: int) -> ObjectDetectionSample:
     session = request.state.session
     sample = session.get(ObjectDetectionSample, sample_id)
     if not sample:
@@ -30,69 +52,200 @@ async def get_sample(request: Request, sample_id: int) -> ObjectDetectionSample:
     return sample
 
 
-@router.get("/samples")
-async def list_samples(request: Request, function_id: int | None = None) -> list[ObjectDetectionSample]:
-    session = request.state.session
+class SamplePage(BaseModel):
+    samples: list[ObjectDetectionSample]
+    next_cursor: Optional[int] = None
+
 
-    query = select(ObjectDetectionSample)
+def fetch_sample_page(
+    session: Session, function_id: Optional[int] = None, cursor: Optional[int] = None, limit: Optional[int] = None
+) -> SamplePage:
+    """
+    Fetch samples ordered by id, starting after `cursor`.
+
+    The boxes of every sample on the page, and their labels, are loaded with one extra query each
+    instead of one query per sample. Pass `limit=None` to fetch everything after the cursor.
+    """
+    query = (
+        select(ObjectDetectionSample)
+        .options(selectinload(ObjectDetectionSample.boxes).selectinload(BoundingBox.label))  # type: ignore
+        .order_by(ObjectDetectionSample.id)  # type: ignore
+    )
     if function_id is not None:
         query = query.where(ObjectDetectionSample.function_id == function_id)
-    results = session.exec(query).all()
-    for sample in results:
-        _ = sample.boxes
-    return results
+    if cursor is not None:
+        query = query.where(ObjectDetectionSample.id > cursor)  # type: ignore
+    if limit is not None:
+        # Fetch one extra row to find out whether there is a next page.
+        query = query.limit(limit + 1)
+    samples = list(session.exec(query).all())
+    if limit is not None and len(samples) > limit:
+        samples = samples[:limit]
+        return SamplePage(samples=samples, next_cursor=samples[-1].id)
+    return SamplePage(samples=samples)
 
 
-@router.post("/samples", response_model=ObjectDetectionSample)
-async def create_sample(request: Request, sample: ObjectDetectionSample) -> ObjectDetectionSample:
+@router.get("/samples")
+def list_samples(
+    request: Request,
+    response: Response,
+    function_id: int | None = None,
+    cursor: int | None = None,
+    limit: Annotated[int, Query(ge=1, le=max_sample_page_size)] = sample_page_size,
+) -> list[ObjectDetectionSample]:
     session = request.state.session
+    response.headers.update(etag_headers(check_etag(request, function_id)))
+    page = fetch_sample_page(session, function_id=function_id, cursor=cursor, limit=limit)
+    if page.next_cursor is not None:
+        next_url = request.url.include_query_params(cursor=page.next_cursor)
+        response.headers["X-Next-Cursor"] = str(page.next_cursor)
+        response.headers["Link"] = f'<{next_url}>; rel="next"'
+    return page.samples
 
+
+@router.post("/samples", response_model=ObjectDetectionSample)
+async def create_sample(
+    request: Request, sample: ObjectDetectionSample, near_duplicate_radius: NearDuplicateRadius = None
+) -> ObjectDetectionSample:
+    """
+    Create a sample from an image URL.
+
+    If `near_duplicate_radius` is given, images within that many bits of an existing sample's perceptual hash are
+    rejected as duplicates too.
+    """
     # Step1: Fetch and decode the image.
-    source_url = sample.url
     try:
-        image_bytes = ImageDecoder().to_stream(source_url)
-        image = PILImage.open(image_bytes)
-    except Exception as e:
+        decoded = await fetch_and_decode_sample(sample)
+    except ValueError as e:
         raise HTTPException(status_code=422, detail=str(e))
 
-    if sample.width is None:
-        sample.width = image.width
-    elif image.width != sample.width:
-        raise HTTPException(status_code=422, detail="Given width does not match image width")
-    if sample.height is None:
-        sample.height = image.height
-    elif image.height != sample.height:
-        raise HTTPException(status_code=422, detail="Given height does not match image height")
-
-    # Step2: Check if the image already exists in the database.
-    image_hash = hashlib.md5(image.tobytes()).hexdigest()
-    statement = select(ObjectDetectionSample).where(ObjectDetectionSample.image_hash == image_hash)
-    result = session.exec(statement).first()
-    if result:
-        raise HTTPException(status_code=409, detail="Image already exists in database")
+    # Step2: Check for duplicates and save the image and sample, off the event loop.
+    return await run_in_threadpool(insert_decoded_sample, request.state.session, decoded, near_duplicate_radius)
 
-    # Step3: Update fields and save image to the database.
-    sample.image_hash = image_hash
-    sample.url = f"{image_url_prefix}/{image_hash}"
-    validate_sample(sample)  # Validate the sample again to ensure all fields are valid
 
-    # Write the bytes to disk. Note that there is no file extension.
-    file_path = f"{image_dir}/{image_hash}"
-    with open(file_path, "wb") as file:  # Open the file in binary write mode
-        file.write(image_bytes.getbuffer())  # Write the byte stream to the file
+def insert_decoded_sample(
+    session: Session, decoded: DecodedSample, near_duplicate_radius: Optional[int] = None
+) -> ObjectDetectionSample:
+    """Reject a decoded sample if its image already exists in the database, or else store its image and insert it."""
+    sample = decoded.sample
+    statement = select(ObjectDetectionSample).where(ObjectDetectionSample.image_hash == decoded.image_hash)
+    if session.exec(statement).first():
+        discard_spooled_image(decoded)
+        raise HTTPException(status_code=409, detail="Image already exists in database")
+    if near_duplicate_radius is not None and (detail := find_near_duplicate(session, sample, near_duplicate_radius)):
+        discard_spooled_image(decoded)
+        raise HTTPException(status_code=409, detail=detail)
+
+    try:
+        validate_sample(sample)  # Validate the sample again to ensure all fields are valid
+    except HTTPException:
+        discard_spooled_image(decoded)
+        raise
+    store_image(decoded)
 
     session.add(sample)
     session.commit()
     session.refresh(sample)
+    near_duplicate_registry.add(sample)
     return sample
 
 
+@router.post("/samples/upload", response_model=ObjectDetectionSample)
+async def upload_sample(
+    request: Request, function_id: int, key: Optional[str] = None, near_duplicate_radius: NearDuplicateRadius = None
+) -> ObjectDetectionSample:
+    """
+    Create a sample from an uploaded image.
+
+    The body is either the raw image, with an image/* content type, or multipart/form-data with the image in a
+    `file` field. The upload is streamed to disk, so its size does not affect memory use. `near_duplicate_radius`
+    works as in `create_sample`.
+    """
+    content_type = request.headers.get("content-type", "")
+    if content_type.startswith("multipart/form-data"):
+        form = await request.form()
+        upload = form.get("file")
+        if not isinstance(upload, UploadFile):
+            raise HTTPException(status_code=422, detail="Missing file field")
+        chunks = iterate_upload(upload)
+    elif content_type.startswith("image/"):
+        chunks = request.stream()
+    else:
+        raise HTTPException(status_code=415, detail="Expected an image/* or multipart/form-data body")
+
+    try:
+        spooled = await spool_upload(chunks, max_bytes=max_image_bytes)
+    except ValueError as e:
+        raise HTTPException(status_code=422, detail=str(e))
+
+    sample = ObjectDetectionSample(function_id=function_id, key=key, url=spooled.path)
+    try:
+        decoded = await run_in_threadpool(decode_spooled_sample, sample, spooled)
+    except ValueError as e:
+        raise HTTPException(status_code=422, detail=str(e))
+
+    return await run_in_threadpool(insert_decoded_sample, request.state.session, decoded, near_duplicate_radius)
+
+
+async def iterate_upload(upload: UploadFile, chunk_size: int = 1024**2) -> AsyncIterator[bytes]:
+    while chunk := await upload.read(chunk_size):
+        yield chunk
+
+
+@router.post("/samples/batch")
+async def create_samples_batch(
+    request: Request, samples: list[ObjectDetectionSample], near_duplicate_radius: NearDuplicateRadius = None
+) -> StreamingResponse:
+    """
+    Create many samples at once.
+
+    Streams back one JSON line per sample, in input order, with its status: "created", "duplicate" or "error".
+    `near_duplicate_radius` works as in `create_sample`.
+    """
+    if len(samples) > max_ingest_batch_size:
+        raise HTTPException(status_code=413, detail=f"At most {max_ingest_batch_size} samples per batch")
+
+    # The request session is closed before the response is streamed, so the ingestion opens its own sessions.
+    bind = request.state.session.get_bind()
+
+    async def stream_results():
+        async for result in ingest_samples(lambda: Session(bind), samples, near_duplicate_radius=near_duplicate_radius):
+            yield result.model_dump_json() + "\n"
+
+    return StreamingResponse(stream_results(), media_type="application/x-ndjson")
+
+
 @router.delete("/samples/{sample_id}")
-async def delete_sample(request: Request, sample_id: int) -> Response:
+def delete_sample(request: Request, sample_id: int) -> Response:
     session = request.state.session
     sample = session.get(ObjectDetectionSample, sample_id)
     if not sample:
         raise HTTPException(status_code=404, detail="Sample not found")
     session.delete(sample)
     session.commit()
+    near_duplicate_registry.invalidate(sample.function_id)
     return Response(status_code=204)
+
+
+@router.get("/samples/{sample_id}/near-duplicates")
+def list_sample_near_duplicates(
+    request: Request, sample_id: int, radius: Annotated[int, Query(ge=0, le=16)] = near_duplicate_radius
+) -> list[NearDuplicate]:
+    """List the samples of the same function whose perceptual hash is within `radius` bits, closest first."""
+    session = request.state.session
+    sample = session.get(ObjectDetectionSample, sample_id)
+    if not sample:
+        raise HTTPException(status_code=404, detail="Sample not found")
+    if sample.perceptual_hash is None:
+        raise HTTPException(status_code=409, detail="Sample has no perceptual hash")
+    index = near_duplicate_registry.get(session, sample.function_id)
+    return [match for match in index.query(sample.perceptual_hash, radius) if match.sample_id != sample_id]
+
+
+@router.get("/functions/{function_id}/near-duplicates")
+def list_near_duplicate_clusters(
+    request: Request, function_id: int, radius: Annotated[int, Query(ge=0, le=16)] = near_duplicate_radius
+) -> list[NearDuplicateCluster]:
+    """Group the samples of a function into clusters of near-duplicates. Samples without duplicates are left out."""
+    session = request.state.session
+    return near_duplicate_registry.get(session, function_id).clusters(radius)
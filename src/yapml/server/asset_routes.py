@@ -0,0 +1,27 @@
+from fastapi import APIRouter, HTTPException, Request, Response
+
+import yapml.client  # noqa: F401  Defines the assets of the pages.
+from yapml.client.assets import ASSETS
+from yapml.config import asset_url_prefix
+from yapml.server.etags import matches
+
+router = APIRouter(prefix=asset_url_prefix)
+
+
+@router.get("/{file_name}", include_in_schema=False)
+def get_asset(request: Request, file_name: str) -> Response:
+    """A script or style of the UI. The file name holds a hash of the content, so it is cached for good."""
+    asset = ASSETS.get(file_name)
+    if asset is None:
+        raise HTTPException(status_code=404, detail="Asset not found")
+    headers = {
+        "ETag": f'W/"{asset.fingerprint}"',  # Weak, as it is the same for the gzipped and the plain content.
+        "Cache-Control": "public, max-age=31536000, immutable",
+        "Vary": "Accept-Encoding",
+    }
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None and matches(if_none_match, headers["ETag"]):
+        return Response(status_code=304, headers=headers)
+    if "gzip" in request.headers.get("accept-encoding", ""):
+        return Response(asset.gzipped, media_type=asset.media_type, headers={**headers, "Content-Encoding": "gzip"})
+    return Response(asset.content, media_type=asset.media_type, headers=headers)
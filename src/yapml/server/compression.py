@@ -0,0 +1,35 @@
+from starlette.datastructures import Headers
+from starlette.middleware.gzip import GZipMiddleware, GZipResponder
+from starlette.types import Message, Receive, Scope, Send
+
+from yapml.config import compressed_media_types, compression_minimum_size
+
+
+class MediaTypeGZipResponder(GZipResponder):
+    """Gzips responses of compressed_media_types only, and passes everything else through untouched."""
+
+    async def send_with_compression(self, message: Message) -> None:
+        if message["type"] == "http.response.start":
+            await super().send_with_compression(message)
+            content_type = Headers(raw=message["headers"]).get("content-type", "")
+            self.content_type_is_excluded = not content_type.startswith(compressed_media_types)
+            return
+        await super().send_with_compression(message)
+
+
+class CompressionMiddleware(GZipMiddleware):
+    """
+    Starlette's GZipMiddleware, restricted to text responses. Images and archives are compressed already, and
+    gzipping a streamed NDJSON response would hold its results back until the compressor flushes.
+    """
+
+    def __init__(self, app, minimum_size: int = compression_minimum_size, compresslevel: int = 6) -> None:
+        super().__init__(app, minimum_size=minimum_size, compresslevel=compresslevel)
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http" or "gzip" not in Headers(scope=scope).get("accept-encoding", ""):
+            await super().__call__(scope, receive, send)
+            return
+        await MediaTypeGZipResponder(self.app, self.minimum_size, compresslevel=self.compresslevel)(
+            scope, receive, send
+        )
@@ -0,0 +1,67 @@
+"""
+Conditional GETs for listings, with ETags derived from the write generation of a function, see FunctionGeneration.
+
+A poll of an unchanged listing costs the lookup of one generation and is answered with 304 Not Modified. Responses
+are marked `Cache-Control: no-cache`, so that clients that keep them always revalidate.
+
+The ETags are weak, as the same response may be sent gzipped or not. HTML pages link the assets by fingerprinted URLs,
+so their ETags also hold page_version, and a page cached before a deploy is not revalidated after it.
+"""
+
+import hashlib
+from functools import cache
+from importlib.metadata import PackageNotFoundError, version
+from typing import Optional
+
+from fastapi import HTTPException, Request
+from sqlmodel import select
+
+import yapml.client  # noqa: F401  Defines the assets of the pages.
+from yapml.client.assets import ASSETS
+from yapml.datamodel import ALL_FUNCTIONS, ObjectDetectionSample, function_generation
+
+
+def etag_headers(etag: str) -> dict[str, str]:
+    return {"ETag": etag, "Cache-Control": "no-cache"}
+
+
+def matches(if_none_match: str, etag: str) -> bool:
+    # If-None-Match uses the weak comparison, so a W/ prefix does not matter.
+    tags = [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+    return etag.removeprefix("W/") in tags or "*" in tags
+
+
+@cache
+def page_version() -> str:
+    """A hash of the package version and the asset file names, which changes when a deploy changes the pages."""
+    try:
+        package_version = version("yapml")
+    except PackageNotFoundError:
+        package_version = ""
+    content = "\n".join([package_version, *sorted(ASSETS)]).encode()
+    return hashlib.blake2b(content, digest_size=6).hexdigest()
+
+
+def check_etag(request: Request, function_id: Optional[int], html: bool = False) -> str:
+    """
+    The ETag of a read of a function's data, or of all functions for None, at its current write generation. Set
+    `html` for pages, whose ETag also changes with page_version. Raises 304 Not Modified if the request has a matching
+    If-None-Match header.
+    """
+    generation = function_generation(request.state.session, function_id)
+    etag = f"{function_id or ALL_FUNCTIONS}-{generation}"
+    if html:
+        etag += f"-{page_version()}"
+    etag = f'W/"{etag}"'
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None and matches(if_none_match, etag):
+        raise HTTPException(status_code=304, headers=etag_headers(etag))
+    return etag
+
+
+def check_sample_etag(request: Request, sample_id: int, html: bool = False) -> str:
+    """Like check_etag, for the function of a sample."""
+    function_id = request.state.session.exec(
+        select(ObjectDetectionSample.function_id).where(ObjectDetectionSample.id == sample_id)
+    ).first()
+    return check_etag(request, function_id, html)
@@ -0,0 +1,77 @@
+import os
+
+from fastapi import APIRouter, Depends, HTTPException, Request, Response
+from fastapi.responses import FileResponse
+from PIL import Image as PILImage
+from sqlmodel import select
+
+from yapml.config import (
+    image_dir,
+    image_url_prefix,
+    thumbnail_cache_max_bytes,
+    thumbnail_dir,
+    thumbnail_format,
+    thumbnail_url_prefix,
+)
+from yapml.datamodel import ObjectDetectionSample
+from yapml.db import get_session
+from yapml.server.etags import matches
+from yapml.thumbnails import ThumbnailCache
+
+router = APIRouter(prefix="")
+
+thumbnail_cache = ThumbnailCache(thumbnail_dir, image_dir, thumbnail_cache_max_bytes, image_format=thumbnail_format)
+
+IMMUTABLE = "public, max-age=31536000, immutable"
+
+
+def sniff_mime_type(path: str) -> str:
+    """The type of an image file from its header, for images stored without one."""
+    try:
+        with PILImage.open(path) as image:
+            return PILImage.MIME.get(image.format or "", "application/octet-stream")
+    except OSError:
+        return "application/octet-stream"
+
+
+@router.api_route(
+    image_url_prefix + "/{name}", methods=["GET", "HEAD"], include_in_schema=False, dependencies=[Depends(get_session)]
+)
+def get_image(request: Request, name: str) -> Response:
+    """
+    An original image. Images stored by ingestion are named by their hash, so they never change and are cached for
+    good. Other files in image_dir, like the fixture images, are revalidated. Range requests are supported.
+    """
+    path = f"{image_dir}/{name}"
+    # Uploads are spooled to image_dir until they are stored, and are not served.
+    if name.startswith(".") or name.endswith(".upload") or not os.path.isfile(path):
+        raise HTTPException(status_code=404, detail="Image not found")
+    sample = request.state.session.exec(
+        select(ObjectDetectionSample.id, ObjectDetectionSample.mime_type).where(
+            ObjectDetectionSample.image_hash == name
+        )
+    ).first()
+    if sample is None:
+        return FileResponse(path, media_type=sniff_mime_type(path), headers={"Cache-Control": "no-cache"})
+
+    headers = {"ETag": f'"{name}"', "Cache-Control": IMMUTABLE}
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None and matches(if_none_match, headers["ETag"]):
+        return Response(status_code=304, headers=headers)
+    return FileResponse(path, media_type=sample.mime_type or sniff_mime_type(path), headers=headers)
+
+
+@router.get(thumbnail_url_prefix + "/{size}/{image_hash}", include_in_schema=False)
+def get_thumbnail(size: int, image_hash: str) -> FileResponse:
+    try:
+        path = thumbnail_cache.get(image_hash, size)
+    except ValueError as e:
+        raise HTTPException(status_code=422, detail=str(e))
+    except FileNotFoundError:
+        raise HTTPException(status_code=404, detail="Image not found")
+    # The original is content addressed, so a variant never changes.
+    return FileResponse(
+        path,
+        media_type=f"image/{thumbnail_cache.extension}",
+        headers={"Cache-Control": IMMUTABLE},
+    )
@@ -1,55 +1,105 @@
 import fasthtml.common as fh
-from fastapi import APIRouter, Depends, Request
+from fastapi import APIRouter, Depends, HTTPException, Request
 from fastapi.responses import FileResponse, HTMLResponse
 
 import yapml.client as client
-from yapml.config import favicon_path
+from yapml.config import favicon_path, samples_grid_page_size
 from yapml.db import get_session
-from yapml.server.api import get_sample, list_boxes, list_functions, list_labels, list_samples
+from yapml.server.api import (
+    fetch_box_history,
+    fetch_labels,
+    fetch_sample_page,
+    get_box,
+    get_sample,
+    list_functions,
+)
+from yapml.server.etags import check_etag, check_sample_etag, etag_headers
 
 router = APIRouter(prefix="", dependencies=[Depends(get_session)])
 
 
 @router.get("/", include_in_schema=False)
-async def homepage(request: Request) -> HTMLResponse:
-    functions = await list_functions(request)
+def homepage(request: Request) -> HTMLResponse:
+    etag = check_etag(request, None, html=True)
+    functions = list_functions(request)
     page = client.render_function_list_page(functions)
-    return HTMLResponse(fh.to_xml(page))
+    return HTMLResponse(fh.to_xml(page), headers=etag_headers(etag))
 
 
 @router.get("/functions", include_in_schema=False)
-async def functions_page(request: Request) -> HTMLResponse:
-    functions = await list_functions(request)
+def functions_page(request: Request) -> HTMLResponse:
+    etag = check_etag(request, None, html=True)
+    functions = list_functions(request)
     page = client.render_function_list_page(functions)
-    return HTMLResponse(fh.to_xml(page))
+    return HTMLResponse(fh.to_xml(page), headers=etag_headers(etag))
 
 
 @router.get("/functions/{function_id}/samples", include_in_schema=False)
-async def samples_list_page(request: Request, function_id: int) -> HTMLResponse:
-    samples = await list_samples(request, function_id=function_id)
-    page = client.render_sample_list_page(function_id, samples)
-    return HTMLResponse(fh.to_xml(page))
+def samples_list_page(request: Request, function_id: int) -> HTMLResponse:
+    etag = check_etag(request, function_id, html=True)
+    sample_page = fetch_sample_page(request.state.session, function_id=function_id, limit=samples_grid_page_size)
+    page = client.render_sample_list_page(function_id, sample_page.samples, sample_page.next_cursor)
+    return HTMLResponse(fh.to_xml(page), headers=etag_headers(etag))
+
+
+@router.get("/functions/{function_id}/sample-cards", include_in_schema=False)
+def sample_cards_fragment(request: Request, function_id: int, cursor: int) -> HTMLResponse:
+    etag = check_etag(request, function_id, html=True)
+    sample_page = fetch_sample_page(
+        request.state.session, function_id=function_id, cursor=cursor, limit=samples_grid_page_size
+    )
+    cells = client.render_sample_cells(function_id, sample_page.samples, sample_page.next_cursor)
+    return HTMLResponse(fh.to_xml(tuple(cells)), headers=etag_headers(etag))
 
 
 @router.get("/functions/{function_id}/labels", include_in_schema=False)
-async def labels_page(request: Request, function_id: int) -> HTMLResponse:
-    labels = await list_labels(request, function_id=function_id)
+def labels_page(request: Request, function_id: int) -> HTMLResponse:
+    etag = check_etag(request, function_id, html=True)
+    labels = fetch_labels(request.state.session, function_id=function_id)
     page = client.render_label_list_page(function_id, labels)
-    return HTMLResponse(fh.to_xml(page))
+    return HTMLResponse(fh.to_xml(page), headers=etag_headers(etag))
 
 
 @router.get("/functions/{function_id}/samples/{sample_id}", include_in_schema=False)
-async def sample_page(request: Request, function_id: int, sample_id: int) -> HTMLResponse:
-    sample = await get_sample(request, sample_id)
-    boxes = await list_boxes(request, sample_id=sample_id, include_deleted=True)
-    page = client.render_sample_details_page(function_id, sample, list(boxes))
-    return HTMLResponse(fh.to_xml(page))
+def sample_page(request: Request, function_id: int, sample_id: int) -> HTMLResponse:
+    etag = check_sample_etag(request, sample_id, html=True)
+    sample = get_sample(request, sample_id)
+    history = fetch_box_history(request.state.session, sample_id)
+    page = client.render_sample_details_page(function_id, sample, history)
+    return HTMLResponse(fh.to_xml(page), headers=etag_headers(etag))
+
+
+@router.get("/samples/{sample_id}/card", include_in_schema=False)
+def sample_card_fragment(request: Request, sample_id: int) -> HTMLResponse:
+    """The card of one sample, to update it in place."""
+    etag = check_sample_etag(request, sample_id, html=True)
+    sample = get_sample(request, sample_id)
+    return HTMLResponse(fh.to_xml(client.render_image_card(sample)), headers=etag_headers(etag))
+
+
+@router.get("/boxes/{box_id}/element", include_in_schema=False)
+def box_fragment(request: Request, box_id: int, max_width: int = 500, max_height: int = 500) -> HTMLResponse:
+    """A single box, to add to the card it was drawn on. The size is that of the card's image."""
+    box = get_box(request, box_id)
+    return HTMLResponse(fh.to_xml(client.render_box(box, max_width, max_height)))
 
 
 @router.get("/samples/{sample_id}/history", include_in_schema=False)
-async def get_history(request: Request, sample_id: int) -> HTMLResponse:
-    boxes = await list_boxes(request, sample_id=sample_id, include_deleted=True)
-    return HTMLResponse(fh.to_xml(client.render_sample_history(list(boxes), sample_id)))
+def get_history(request: Request, sample_id: int) -> HTMLResponse:
+    etag = check_sample_etag(request, sample_id, html=True)
+    history = fetch_box_history(request.state.session, sample_id)
+    return HTMLResponse(fh.to_xml(client.render_sample_history(sample_id, history)), headers=etag_headers(etag))
+
+
+@router.get("/samples/{sample_id}/history-items", include_in_schema=False)
+def get_history_items(request: Request, sample_id: int, cursor: str) -> HTMLResponse:
+    etag = check_sample_etag(request, sample_id, html=True)
+    try:
+        history = fetch_box_history(request.state.session, sample_id, cursor=cursor)
+    except ValueError as e:
+        raise HTTPException(status_code=422, detail=str(e))
+    items = client.render_history_items(sample_id, history)
+    return HTMLResponse(fh.to_xml(tuple(items)), headers=etag_headers(etag))
 
 
 @router.get("/favicon.ico", include_in_schema=False)
@@ -1,24 +1,49 @@
 import os
+from contextlib import asynccontextmanager
 from datetime import datetime
 
 from fastapi import FastAPI
 from fastapi.responses import Response
-from fastapi.staticfiles import StaticFiles
 
-from yapml.server.api import admin_router, boundingbox_router, function_router, label_router, sample_router
+from yapml.config import image_dir
+from yapml.jobs import job_runner
+from yapml.server.api import (
+    admin_router,
+    boundingbox_router,
+    function_router,
+    import_router,
+    job_router,
+    label_router,
+    sample_router,
+)
+from yapml.server.asset_routes import router as asset_router
+from yapml.server.compression import CompressionMiddleware
+from yapml.server.image_routes import router as image_router
 from yapml.server.ui_routes import router as ui_router
 
-web_app = FastAPI()
 
-os.makedirs("/data/images", exist_ok=True)
-web_app.mount("/images", StaticFiles(directory="/data/images"), name="images")
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    job_runner.start()
+    yield
+    job_runner.stop()
+
+
+web_app = FastAPI(lifespan=lifespan)
+web_app.add_middleware(CompressionMiddleware)
+
+os.makedirs(image_dir, exist_ok=True)
 
 web_app.include_router(admin_router)
 web_app.include_router(boundingbox_router)
 web_app.include_router(label_router)
 web_app.include_router(sample_router)
 web_app.include_router(function_router)
+web_app.include_router(import_router)
+web_app.include_router(job_router)
 web_app.include_router(ui_router)
+web_app.include_router(image_router)
+web_app.include_router(asset_router)
 
 
 @web_app.get("/sitemap.xml", response_class=Response, include_in_schema=False)
@@ -0,0 +1,123 @@
+import os
+import re
+import threading
+from collections import OrderedDict
+from typing import Optional
+
+from PIL import Image, ImageOps
+
+from yapml.config import thumbnail_sizes, thumbnail_url_prefix
+from yapml.datamodel import ObjectDetectionSample
+
+_HASH_PATTERN = re.compile(r"^[0-9a-f]+$")
+
+
+class ThumbnailCache:
+    """
+    Disk cache of resized variants of the content-addressed images in `source_dir`.
+
+    Variants are created on first request and evicted least-recently-used first once the cache holds more than
+    `max_bytes`. Since originals never change, a cached variant never has to be invalidated.
+    """
+
+    def __init__(
+        self,
+        cache_dir: str,
+        source_dir: str,
+        max_bytes: int,
+        sizes: tuple[int, ...] = thumbnail_sizes,
+        image_format: str = "WEBP",
+    ):
+        self.cache_dir = cache_dir
+        self.source_dir = source_dir
+        self.max_bytes = max_bytes
+        self.sizes = sizes
+        self.image_format = image_format
+        self.extension = image_format.lower()
+        self.total_bytes = 0
+        self._entries: OrderedDict[str, int] = OrderedDict()  # file name -> size in bytes, oldest first.
+        self._lock = threading.Lock()
+        os.makedirs(cache_dir, exist_ok=True)
+        self._load_index()
+
+    def _load_index(self) -> None:
+        entries = []
+        for entry in os.scandir(self.cache_dir):
+            if entry.is_file() and not entry.name.endswith(".tmp"):
+                stat = entry.stat()
+                entries.append((stat.st_atime, entry.name, stat.st_size))
+        for _, name, size in sorted(entries):
+            self._entries[name] = size
+            self.total_bytes += size
+
+    def get(self, image_hash: str, size: int) -> str:
+        """Return the path of the `size` variant of the image, creating it if needed."""
+        if size not in self.sizes:
+            raise ValueError(f"Unsupported thumbnail size {size}. Must be one of {self.sizes}")
+        if not _HASH_PATTERN.match(image_hash):
+            raise ValueError("Invalid image hash")
+
+        name = f"{image_hash}_{size}.{self.extension}"
+        path = os.path.join(self.cache_dir, name)
+        with self._lock:
+            if name in self._entries and os.path.exists(path):
+                self._entries.move_to_end(name)
+                return path
+
+        source_path = os.path.join(self.source_dir, image_hash)
+        if not os.path.exists(source_path):
+            raise FileNotFoundError(image_hash)
+        nbytes = self._render(source_path, path, size)
+
+        with self._lock:
+            if name not in self._entries:
+                self.total_bytes += nbytes
+            self._entries[name] = nbytes
+            self._entries.move_to_end(name)
+            self._evict()
+        return path
+
+    def _render(self, source_path: str, path: str, size: int) -> int:
+        with Image.open(source_path) as img:
+            # Let the JPEG decoder downscale while decoding. This is much cheaper than decoding at full resolution.
+            img.draft("RGB", (size, size))
+            # Browsers show the original upright according to its EXIF orientation, which the variant does not keep.
+            img = ImageOps.exif_transpose(img)
+            img.thumbnail((size, size))
+            if img.mode not in ("RGB", "RGBA"):
+                img = img.convert("RGBA" if "transparency" in img.info else "RGB")
+            if self.image_format == "JPEG" and img.mode == "RGBA":
+                img = img.convert("RGB")
+            tmp_path = f"{path}.{threading.get_ident()}.tmp"
+            img.save(tmp_path, format=self.image_format, quality=85)
+        os.replace(tmp_path, path)
+        return os.path.getsize(path)
+
+    def _evict(self) -> None:
+        while self.total_bytes > self.max_bytes and len(self._entries) > 1:
+            name, nbytes = self._entries.popitem(last=False)
+            self.total_bytes -= nbytes
+            try:
+                os.remove(os.path.join(self.cache_dir, name))
+            except FileNotFoundError:
+                pass
+
+
+def pick_thumbnail_size(display_size: int, sizes: tuple[int, ...] = thumbnail_sizes) -> Optional[int]:
+    """Smallest variant at least as large as `display_size`, or None if the original is needed."""
+    for size in sorted(sizes):
+        if size >= display_size:
+            return size
+    return None
+
+
+def thumbnail_url(sample: ObjectDetectionSample, display_size: int) -> str:
+    """
+    URL of the image variant that fits a `display_size` pixel card.
+
+    Samples that have no image stored under their hash are served from their original url.
+    """
+    size = pick_thumbnail_size(display_size)
+    if sample.image_hash is None or size is None:
+        return sample.url
+    return f"{thumbnail_url_prefix}/{size}/{sample.image_hash}"
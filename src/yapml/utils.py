@@ -1,59 +1,56 @@
 from datetime import datetime
+from typing import Optional
 
 from yapml.client.utils import time_delta_string
 from yapml.datamodel import BoundingBox, BoxChange
 
 
+def box_change(
+    box: BoundingBox, deleted: bool, previous_box: Optional[BoundingBox], now: datetime
+) -> Optional[BoxChange]:
+    """
+    Describe one event in the history of a box: its deletion, or the creation of this version.
+
+    `previous_box` is the version this box replaced, if any. Versions that neither moved nor resized the box, e.g.
+    a change of annotator, have no event and return None.
+    """
+    if deleted:
+        assert box.deleted_at is not None
+        event, at = "deleted", box.deleted_at
+    elif box.previous_box_id is None:
+        event, at = "created", box.created_at
+    elif previous_box is None:
+        event, at = "updated", box.created_at
+    elif previous_box.width != box.width or previous_box.height != box.height:
+        event, at = "resized", box.created_at
+    elif previous_box.center_x != box.center_x or previous_box.center_y != box.center_y:
+        event, at = "moved", box.created_at
+    else:
+        return None
+    return BoxChange(
+        label_name=box.label.name,
+        annotator_name=box.annotator_name,
+        event=event,
+        time_delta=time_delta_string(now - at),
+    )
+
+
 def boxes_to_changes(boxes: list[BoundingBox]) -> list[BoxChange]:
-    if not boxes:
-        return []
+    """
+    List the changes recorded by a set of box versions, newest first.
+
+    Each box is visited once and its previous version looked up by id. Ties in time are broken by box id, with the
+    deletion of a box before its creation.
+    """
     box_by_id = {box.id: box for box in boxes}
-    box_ids_not_yet_seen = [box.id for box in boxes]
+    events: list[tuple[datetime, int, bool, BoundingBox]] = []
+    for box in boxes:
+        assert box.id is not None
+        events.append((box.created_at, box.id, False, box))
+        if box.deleted_at:
+            events.append((box.deleted_at, box.id, True, box))
+    events.sort(key=lambda e: e[:3], reverse=True)
 
-    box = box_by_id[box_ids_not_yet_seen[-1]]
-    changes: list[BoxChange] = []
     now = datetime.now()
-    while box_ids_not_yet_seen:
-        box_ids_not_yet_seen.remove(box.id)
-        if box.deleted_at:
-            changes.append(
-                BoxChange(
-                    label_name=box.label.name,
-                    annotator_name=box.annotator_name,
-                    event="deleted",
-                    time_delta=time_delta_string(now - box.deleted_at),
-                )
-            )
-        if not box.previous_box_id:
-            changes.append(
-                BoxChange(
-                    label_name=box.label.name,
-                    annotator_name=box.annotator_name,
-                    event="created",
-                    time_delta=time_delta_string(now - box.created_at),
-                )
-            )
-            if box_ids_not_yet_seen:
-                box = box_by_id[box_ids_not_yet_seen[-1]]
-        else:
-            previous_box = box_by_id[box.previous_box_id]
-            if previous_box.width != box.width or previous_box.height != box.height:
-                changes.append(
-                    BoxChange(
-                        label_name=box.label.name,
-                        annotator_name=box.annotator_name,
-                        event="resized",
-                        time_delta=time_delta_string(now - box.created_at),
-                    )
-                )
-            elif previous_box.center_x != box.center_x or previous_box.center_y != box.center_y:
-                changes.append(
-                    BoxChange(
-                        label_name=box.label.name,
-                        annotator_name=box.annotator_name,
-                        event="moved",
-                        time_delta=time_delta_string(now - box.created_at),
-                    )
-                )
-            box = previous_box
-    return changes
+    changes = [box_change(box, deleted, box_by_id.get(box.previous_box_id), now) for _, _, deleted, box in events]
+    return [change for change in changes if change is not None]
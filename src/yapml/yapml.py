@@ -1,9 +1,8 @@
 import modal
 from fastapi import FastAPI
-from fastapi.staticfiles import StaticFiles
-from sqlmodel import SQLModel
 
 from yapml.db import engine
+from yapml.migrations import migrate
 from yapml.server.webapp import web_app
 
 volume = modal.Volume.from_name("yapml", create_if_missing=True)
@@ -28,7 +27,5 @@ app = modal.App(name="yapml", image=modal_image)
 )
 @modal.asgi_app()
 def index() -> FastAPI:
-
-    SQLModel.metadata.create_all(engine)
-    web_app.mount("/images", StaticFiles(directory="/data/images"), name="images")
+    migrate(engine)
     return web_app
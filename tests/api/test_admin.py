@@ -0,0 +1,169 @@
+import os
+from base64 import b64encode
+from datetime import datetime, timedelta
+from io import BytesIO
+
+import numpy as np
+import pytest
+from PIL import Image
+from sqlalchemy import update
+from sqlalchemy.exc import OperationalError
+from sqlmodel import Session, select
+
+from yapml.datamodel import BoundingBox, FunctionType, Label, ObjectDetectionSample, YapFunction
+from yapml.hashing import ImageHasher
+from yapml.ingestion import rekey_image_hashes
+
+
+@pytest.fixture
+def function_fixture(test_session):
+    function = YapFunction(name="test", description="test", function_type=FunctionType.OBJECT_DETECTION)
+    test_session.add(function)
+    test_session.commit()
+    return function
+
+
+def data_uri() -> str:
+    img_array = np.random.randint(0, 255, (10, 10, 3), dtype=np.uint8)
+    stream = BytesIO()
+    Image.fromarray(img_array).save(stream, format="PNG")
+    return f"data:image/png;base64,{b64encode(stream.getvalue()).decode('utf-8')}"
+
+
+def test_rehash_images(client, run_jobs, test_session, function_fixture):
+    ids = []
+    for _ in range(3):
+        response = client.post("/api/detection/samples", json={"url": data_uri(), "function_id": function_fixture.id})
+        assert response.status_code == 200
+        ids.append(response.json()["id"])
+
+    def rehash(**params) -> dict:
+        response = client.post("/api/detection/rehash-images", params=params)
+        assert response.status_code == 202
+        assert run_jobs() == 1
+        test_session.expire_all()
+        job = client.get(response.headers["location"]).json()
+        assert (job["status"], job["progress"], job["total"]) == ("completed", 3, 3)
+        return job["result"]
+
+    assert rehash(strategy="pixel-md5")["rekeyed"] == 3
+    for sample_id in ids:
+        sample = test_session.get(ObjectDetectionSample, sample_id)
+        assert sample.url == f"/images/{sample.image_hash}"
+        with open(f"/data/images/{sample.image_hash}", "rb") as file:
+            assert ImageHasher("pixel-md5").hash(file) == sample.image_hash
+
+    # Running it again is a no-op.
+    assert rehash(strategy="pixel-md5")["unchanged"] == 3
+
+    assert rehash()["rekeyed"] == 3
+    for sample_id in ids:
+        sample = test_session.get(ObjectDetectionSample, sample_id)
+        assert os.path.exists(f"/data/images/{sample.image_hash}")
+
+
+def test_rehash_images_commit_fails(client, test_engine, test_session, function_fixture):
+    ids = []
+    for _ in range(2):
+        response = client.post("/api/detection/samples", json={"url": data_uri(), "function_id": function_fixture.id})
+        ids.append(response.json()["id"])
+    old_hashes = [test_session.get(ObjectDetectionSample, sample_id).image_hash for sample_id in ids]
+
+    # The commit of the new hashes fails, after the files were linked to their new names.
+    with Session(test_engine) as session:
+        commit, commits = session.commit, []
+
+        def failing_commit() -> None:
+            commits.append(True)
+            if len(commits) == 2:  # The first commit ends the read of the chunk.
+                raise OperationalError("COMMIT", {}, Exception("database is locked"))
+            commit()
+
+        session.commit = failing_commit  # type: ignore
+        with pytest.raises(OperationalError):
+            rekey_image_hashes(session, "pixel-md5")
+    test_session.expire_all()
+    for sample_id, old_hash in zip(ids, old_hashes):
+        sample = test_session.get(ObjectDetectionSample, sample_id)
+        assert sample.image_hash == old_hash
+        assert client.get(sample.url).status_code == 200
+
+    # A second run completes the re-key.
+    with Session(test_engine) as session:
+        assert rekey_image_hashes(session, "pixel-md5").rekeyed == 2
+    test_session.expire_all()
+    for sample_id, old_hash in zip(ids, old_hashes):
+        sample = test_session.get(ObjectDetectionSample, sample_id)
+        assert sample.image_hash != old_hash
+        assert client.get(sample.url).status_code == 200
+        assert not os.path.exists(f"/data/images/{old_hash}")
+
+
+def test_rehash_images_unknown_strategy(client):
+    response = client.post("/api/detection/rehash-images", params={"strategy": "sha1"})
+    assert response.status_code == 422
+
+
+def test_backfill_perceptual_hashes(client, run_jobs, test_session, function_fixture):
+    for _ in range(2):
+        client.post("/api/detection/samples", json={"url": data_uri(), "function_id": function_fixture.id})
+    test_session.execute(update(ObjectDetectionSample).values(perceptual_hash=None))
+    test_session.commit()
+
+    response = client.post("/api/detection/backfill-perceptual-hashes")
+    assert response.status_code == 202
+    assert run_jobs() == 1
+    test_session.expire_all()
+    job = client.get(response.headers["location"]).json()
+    assert (job["status"], job["progress"], job["total"], job["result"]) == ("completed", 2, 2, {"updated": 2})
+    samples = test_session.exec(select(ObjectDetectionSample)).all()
+    assert all(sample.perceptual_hash is not None for sample in samples)
+
+
+def test_maintenance(client, run_jobs, test_session, function_fixture):
+    sample = ObjectDetectionSample(function_id=function_fixture.id, url="/images/a", width=10, height=10)
+    label = Label(name="cat", color="#FF0000", function_id=function_fixture.id)
+    test_session.add_all([sample, label])
+    test_session.commit()
+
+    def box() -> dict:
+        geometry = dict(center_x=0.5, center_y=0.5, width=0.1, height=0.1)
+        body = dict(function_id=function_fixture.id, sample_id=sample.id, label_id=label.id, annotator_name="a")
+        return client.post("/api/detection/boxes", json=body | geometry).json()
+
+    def edit(box_id: int, center_x: float) -> int:
+        return client.put(f"/api/detection/boxes/{box_id}", json={"center_x": center_x}).json()["id"]
+
+    # A box with three old edits and a recent one, and a box that was edited and deleted long ago.
+    edited = [box()["id"]]
+    for center_x in (0.1, 0.2, 0.3, 0.4):
+        edited.append(edit(edited[-1], center_x))
+    deleted = [box()["id"]]
+    deleted.append(edit(deleted[-1], 0.1))
+    client.delete(f"/api/detection/boxes/{deleted[-1]}")
+    old = datetime.now() - timedelta(days=60)
+    test_session.execute(
+        update(BoundingBox).where(BoundingBox.id.in_(edited[:-1] + deleted)).values(created_at=old, deleted_at=None)  # type: ignore
+    )
+    test_session.execute(update(BoundingBox).where(BoundingBox.id == deleted[-1]).values(deleted_at=old))
+    test_session.commit()
+
+    response = client.post("/api/detection/maintenance", params={"retention_days": 30})
+    assert response.status_code == 202
+    assert run_jobs() == 1
+    test_session.expire_all()
+    job = client.get(response.headers["location"]).json()
+    assert job["status"] == "completed"
+    assert job["result"]["compacted_versions"] == 3
+    assert job["result"]["database_bytes"] > 0
+
+    # The first version of each box, its current or deleted version, and the recent edit remain, still chained.
+    remaining = test_session.exec(select(BoundingBox).order_by(BoundingBox.id)).all()  # type: ignore
+    assert [(b.id, b.previous_box_id) for b in remaining] == [
+        (edited[0], None),
+        (edited[-1], edited[0]),
+        (deleted[0], None),
+        (deleted[1], deleted[0]),
+    ]
+    history = client.get(f"/api/detection/samples/{sample.id}/history").json()["changes"]
+    assert [change["event"] for change in history] == ["moved", "deleted", "moved", "created", "created"]
@@ -0,0 +1,43 @@
+import re
+
+from yapml.client.samples_page import DRAG_SCRIPT
+from yapml.datamodel import FunctionType, YapFunction
+
+
+def test_page_assets(client, test_session):
+    function = YapFunction(name="f", description="", function_type=FunctionType.OBJECT_DETECTION)
+    test_session.add(function)
+    test_session.commit()
+
+    page = client.get(f"/functions/{function.id}/samples").text
+    assert f'data-function-id="{function.id}"' in page
+    assert DRAG_SCRIPT.url in page
+    assert "pageFunctionId" not in page  # The script is no longer inlined.
+    urls = re.findall(r'(?:src|href)="(/assets/[^"]+)"', page)
+    assert len(urls) == 4
+
+    response = client.get(DRAG_SCRIPT.url)
+    assert response.headers["content-encoding"] == "gzip"
+    assert response.headers["content-type"].startswith("text/javascript")
+    assert "immutable" in response.headers["cache-control"]
+    assert response.content == DRAG_SCRIPT.content
+
+    raw = client.get(DRAG_SCRIPT.url, headers={"Accept-Encoding": "identity"})
+    assert "content-encoding" not in raw.headers
+    assert raw.content == DRAG_SCRIPT.content
+    assert client.get(DRAG_SCRIPT.url, headers={"If-None-Match": raw.headers["etag"]}).status_code == 304
+    assert client.get("/assets/drag.000000000000.js").status_code == 404
+
+
+def test_compression(client, test_session):
+    for i in range(20):
+        test_session.add(YapFunction(name=f"f{i}", description="", function_type=FunctionType.OBJECT_DETECTION))
+    test_session.commit()
+
+    for url in ["/", "/api/detection/functions"]:
+        response = client.get(url, headers={"Accept-Encoding": "gzip"})
+        assert response.headers["content-encoding"] == "gzip", url
+        assert response.headers["vary"] == "Accept-Encoding"
+
+    response = client.get("/", headers={"Accept-Encoding": "identity"})
+    assert "content-encoding" not in response.headers
@@ -1,7 +1,9 @@
 from datetime import datetime, timedelta
 
 import pytest
+from sqlmodel import select
 
+from yapml.box_batches import BoxCreate, create_boxes
 from yapml.datamodel import BoundingBox, FunctionType, Label, ObjectDetectionSample, YapFunction
 from yapml.utils import boxes_to_changes
 
@@ -92,6 +94,58 @@ def test_update_box(client, box_fixture):
     assert data["previous_box_id"] == box_fixture.id
 
 
+def test_box_lineage(client, box_fixture):
+    """All versions of a box share the id of the first version as lineage"""
+    assert (box_fixture.lineage_id, box_fixture.version) == (box_fixture.id, 1)
+
+    box_id = box_fixture.id
+    for version in (2, 3):
+        response = client.put(f"/api/detection/boxes/{box_id}", json={"center_x": 0.1 * version})
+        data = response.json()
+        assert (data["lineage_id"], data["version"]) == (box_fixture.id, version)
+        box_id = data["id"]
+
+
+def test_list_boxes_head_versions(client, test_session, box_fixture):
+    """Only the current version of each box is listed, unless stale or deleted boxes are asked for"""
+    updated = client.put(f"/api/detection/boxes/{box_fixture.id}", json={"center_x": 0.5}).json()
+    other = client.put(f"/api/detection/boxes/{updated['id']}", json={"center_x": 0.6}).json()
+    client.delete(f"/api/detection/boxes/{other['id']}")
+    current = client.post(
+        "/api/detection/boxes",
+        json={
+            "sample_id": box_fixture.sample_id,
+            "function_id": box_fixture.function_id,
+            "label_id": box_fixture.label_id,
+            "center_x": 0.2,
+            "center_y": 0.2,
+            "width": 0.1,
+            "height": 0.1,
+            "annotator_name": "Alice",
+        },
+    ).json()
+
+    def listed(**params) -> list[int]:
+        response = client.get("/api/detection/boxes", params={"function_id": box_fixture.function_id, **params})
+        return sorted(box["id"] for box in response.json())
+
+    assert listed() == [current["id"]]
+    assert listed(include_stale=True) == [box_fixture.id, updated["id"], current["id"]]
+    assert listed(include_deleted=True) == [other["id"], current["id"]]
+    assert len(listed(include_stale=True, include_deleted=True)) == 4
+    assert listed(function_id=box_fixture.function_id + 1) == []
+
+    sample = test_session.get(ObjectDetectionSample, box_fixture.sample_id)
+    test_session.refresh(sample)
+    assert [box.id for box in sample.boxes] == [current["id"]]
+
+
+def test_update_stale_box(client, box_fixture):
+    client.put(f"/api/detection/boxes/{box_fixture.id}", json={"center_x": 0.5})
+    response = client.put(f"/api/detection/boxes/{box_fixture.id}", json={"center_x": 0.6})
+    assert response.status_code == 409
+
+
 def test_update_box_too_large(client, box_fixture):
     update_data = {"center_x": 1.1}
     response = client.put(f"/api/detection/boxes/{box_fixture.id}", json=update_data)
@@ -148,6 +202,25 @@ def test_delete_box(client, box_fixture):
     assert response.status_code == 204
 
 
+def test_box_ui_fragments(client, box_fixture):
+    response = client.get(f"/boxes/{box_fixture.id}/element", params={"max_width": 200, "max_height": 100})
+    assert response.status_code == 200
+    assert response.text.startswith('<div data-box-id="') and response.text.count("draggable-box") == 1
+    assert "width: 20.0px" in response.text and "height: 10.0px" in response.text
+    assert client.get("/boxes/9999/element").status_code == 404
+
+    response = client.get(f"/samples/{box_fixture.sample_id}/card")
+    assert response.status_code == 200
+    assert f'data-sample-id="{box_fixture.sample_id}"' in response.text
+    assert response.text.count("draggable-box") == 1
+    assert (
+        client.get(
+            f"/samples/{box_fixture.sample_id}/card", headers={"If-None-Match": response.headers["etag"]}
+        ).status_code
+        == 304
+    )
+
+
 class TestBoxesToChanges:
     @pytest.fixture
     def base_label(self):
@@ -382,3 +455,191 @@ class TestBoxesToChanges:
         assert changes[0].event == "resized"
         assert changes[1].event == "moved"
         assert changes[2].event == "created"
+
+
+class TestBoxHistory:
+    def edit_box(self, client, box_id: int, edits: int) -> int:
+        for i in range(edits):
+            update = {"center_x": 0.2 + i / (2 * edits)} if i % 2 else {"width": 0.2 + i / (2 * edits)}
+            box_id = client.put(f"/api/detection/boxes/{box_id}", json=update).json()["id"]
+        return box_id
+
+    def test_history_pages(self, client, test_session, box_fixture):
+        """Paging through the history gives the same changes as computing them from all boxes at once"""
+        head_id = self.edit_box(client, box_fixture.id, 7)
+        body = {
+            "sample_id": box_fixture.sample_id,
+            "function_id": box_fixture.function_id,
+            "label_id": box_fixture.label_id,
+            "center_x": 0.5,
+            "center_y": 0.5,
+            "width": 0.1,
+            "height": 0.1,
+            "annotator_name": "Bob",
+        }
+        other = client.post("/api/detection/boxes", json=body).json()
+        other_head_id = self.edit_box(client, other["id"], 4)
+        client.delete(f"/api/detection/boxes/{head_id}")
+        self.edit_box(client, other_head_id, 2)
+
+        pages, cursor = [], None
+        while True:
+            params = {"limit": 3, **({"cursor": cursor} if cursor else {})}
+            response = client.get(f"/api/detection/samples/{box_fixture.sample_id}/history", params=params)
+            assert response.status_code == 200
+            pages.append(response.json()["changes"])
+            cursor = response.json()["next_cursor"]
+            if cursor is None:
+                break
+
+        all_boxes = test_session.exec(select(BoundingBox)).all()
+        expected = [change.model_dump() for change in boxes_to_changes(list(all_boxes))]
+        assert [change for page in pages for change in page] == expected
+        assert len(expected) == (1 + 7 + 1) + (1 + 4 + 2)  # Created, edits and deletion of both boxes.
+        assert expected[2]["event"] == "deleted"
+
+        # The history of a single box.
+        response = client.get(
+            f"/api/detection/samples/{box_fixture.sample_id}/history", params={"lineage_id": box_fixture.id}
+        )
+        assert [change["event"] for change in response.json()["changes"]][:2] == ["deleted", "resized"]
+        assert len(response.json()["changes"]) == 9
+
+    def test_history_invalid_cursor(self, client, box_fixture):
+        response = client.get(f"/api/detection/samples/{box_fixture.sample_id}/history", params={"cursor": "x"})
+        assert response.status_code == 422
+
+    def test_history_ui_fragments(self, client, box_fixture):
+        self.edit_box(client, box_fixture.id, 60)
+        response = client.get(f"/samples/{box_fixture.sample_id}/history")
+        assert response.status_code == 200
+        assert response.text.count("<li") == 51
+        assert "Load more" in response.text
+
+        cursor = client.get(f"/api/detection/samples/{box_fixture.sample_id}/history").json()["next_cursor"]
+        response = client.get(f"/samples/{box_fixture.sample_id}/history-items", params={"cursor": cursor})
+        assert response.status_code == 200
+        assert response.text.count("<li") == 11
+        assert "Load more" not in response.text
+
+
+class TestBoxBatches:
+    def box_body(self, box, **values) -> dict:
+        body = {
+            "sample_id": box.sample_id,
+            "label_id": box.label_id,
+            "center_x": 0.5,
+            "center_y": 0.5,
+            "width": 0.2,
+            "height": 0.2,
+            "annotator_name": "model",
+        }
+        return body | values
+
+    def test_create_boxes(self, client, test_session, box_fixture):
+        other_function = YapFunction(name="other", description="", function_type=FunctionType.OBJECT_DETECTION)
+        test_session.add(other_function)
+        test_session.commit()
+        other_label = Label(name="dog", color="#00FF00", function_id=other_function.id)
+        test_session.add(other_label)
+        test_session.commit()
+
+        boxes = [
+            self.box_body(box_fixture),
+            self.box_body(box_fixture, center_x=1.5),
+            self.box_body(box_fixture, sample_id=9999),
+            self.box_body(box_fixture, label_id=9999),
+            self.box_body(box_fixture, label_id=other_label.id),
+            self.box_body(box_fixture, width=0.3),
+        ]
+        response = client.post("/api/detection/boxes/batch", json=boxes)
+        assert response.status_code == 200
+        results = response.json()
+        assert [result["status"] for result in results] == ["created", "error", "error", "error", "error", "created"]
+        assert [result["index"] for result in results] == list(range(6))
+        assert results[1]["detail"].startswith("center_x")
+        assert results[2]["detail"] == "Sample not found"
+        assert results[3]["detail"] == "Label not found"
+
+        box = client.get(f"/api/detection/boxes/{results[5]['box_id']}")
+        assert box.json()["width"] == 0.3
+        assert box.json()["function_id"] == box_fixture.function_id
+        assert box.json()["lineage_id"] == results[5]["box_id"]
+        assert box.json()["version"] == 1
+        assert box.json()["is_head"]
+
+    def test_create_boxes_in_chunks(self, test_session, box_fixture):
+        boxes = [BoxCreate(**self.box_body(box_fixture, center_x=i / 10)) for i in range(10)]
+        results = create_boxes(test_session, boxes, chunk_size=3)
+        assert [result.index for result in results] == list(range(10))
+        assert results[0].status == "created"  # A center of 0 is valid.
+        assert len({result.box_id for result in results}) == 10
+
+    def test_update_boxes(self, client, box_fixture):
+        updates = [
+            {"box_id": box_fixture.id, "center_x": 0.6},
+            {"box_id": box_fixture.id, "center_x": 0.7},
+            {"box_id": 9999, "center_x": 0.7},
+        ]
+        response = client.put("/api/detection/boxes/batch", json=updates)
+        assert response.status_code == 200
+        results = response.json()
+        assert [result["status"] for result in results] == ["updated", "error", "error"]
+        assert results[1]["detail"] == "Box appears more than once in this batch"
+        assert results[2]["detail"] == "Box not found"
+
+        new_box = client.get(f"/api/detection/boxes/{results[0]['box_id']}").json()
+        assert new_box["center_x"] == 0.6
+        assert new_box["width"] == box_fixture.width
+        assert new_box["previous_box_id"] == box_fixture.id
+        assert new_box["lineage_id"] == box_fixture.id
+        assert new_box["version"] == 2
+        assert not client.get(f"/api/detection/boxes/{box_fixture.id}").json()["is_head"]
+
+        updates = [{"box_id": box_fixture.id, "center_x": 0.8}, {"box_id": new_box["id"], "height": 0}]
+        results = client.put("/api/detection/boxes/batch", json=updates).json()
+        assert results[0]["detail"] == "Box is deleted or was replaced by a newer version"
+        assert results[1]["detail"].startswith("height")
+
+    def test_delete_boxes(self, client, box_fixture):
+        results = client.post("/api/detection/boxes/batch/delete", json=[box_fixture.id, box_fixture.id, 9999]).json()
+        assert [result["status"] for result in results] == ["deleted", "error", "error"]
+        box = client.get(f"/api/detection/boxes/{box_fixture.id}").json()
+        assert box["deleted_at"] is not None
+        assert not box["is_head"]
+        assert client.get("/api/detection/boxes", params={"sample_id": box_fixture.sample_id}).json() == []
+
+
+def test_coalesce_box_edits(client, test_session, box_fixture, monkeypatch):
+    monkeypatch.setattr("yapml.server.api.boundingbox_routes.box_edit_coalesce_window", 60)
+
+    # The creation of a box is kept, the edits of one annotator within the window become a single version.
+    first = client.put(f"/api/detection/boxes/{box_fixture.id}", json={"center_x": 0.2, "annotator_name": "a"}).json()
+    assert first["version"] == 2
+    for center_x in (0.3, 0.4):
+        edit = client.put(f"/api/detection/boxes/{first['id']}", json={"center_x": center_x, "annotator_name": "a"})
+        assert (edit.json()["id"], edit.json()["version"], edit.json()["center_x"]) == (first["id"], 2, center_x)
+        assert edit.json()["created_at"] == first["created_at"]
+
+    # The window counts from when the version was made, not from its latest amendment.
+    version = test_session.get(BoundingBox, first["id"])
+    version.created_at -= timedelta(seconds=50)
+    test_session.add(version)
+    test_session.commit()
+    amended = client.put(f"/api/detection/boxes/{first['id']}", json={"center_x": 0.45, "annotator_name": "a"}).json()
+    assert amended["id"] == first["id"]
+    version.created_at -= timedelta(seconds=20)
+    test_session.add(version)
+    test_session.commit()
+    late = client.put(f"/api/detection/boxes/{first['id']}", json={"center_x": 0.4, "annotator_name": "a"}).json()
+    assert (late["version"], late["previous_box_id"]) == (3, first["id"])
+    first = late
+
+    # Another annotator, or an edit after the window, adds a version.
+    other = client.put(f"/api/detection/boxes/{first['id']}", json={"center_x": 0.5, "annotator_name": "b"}).json()
+    assert (other["version"], other["previous_box_id"]) == (4, first["id"])
+    monkeypatch.setattr("yapml.server.api.boundingbox_routes.box_edit_coalesce_window", 0)
+    latest = client.put(f"/api/detection/boxes/{other['id']}", json={"center_x": 0.6, "annotator_name": "b"}).json()
+    assert latest["version"] == 5
+    history = client.get(f"/api/detection/samples/{box_fixture.sample_id}/history").json()
+    assert len(history["changes"]) == 5
@@ -0,0 +1,137 @@
+import io
+import zipfile
+
+import pytest
+from sqlalchemy import update
+from sqlmodel import Session, select
+
+from yapml.datamodel import (
+    BoundingBox,
+    FunctionType,
+    ImportItem,
+    ImportRun,
+    Job,
+    Label,
+    ObjectDetectionSample,
+    YapFunction,
+)
+from yapml.deletion import DELETERS, delete_label_rows
+
+
+def create_function(test_session, name: str, boxes: int) -> YapFunction:
+    """A function with a label, a sample with `boxes` boxes, and an import"""
+    function = YapFunction(name=name, description="", function_type=FunctionType.OBJECT_DETECTION)
+    test_session.add(function)
+    test_session.commit()
+    label = Label(name=f"{name}_label", color="#FF0000", function_id=function.id)
+    sample = ObjectDetectionSample(function_id=function.id, url="/images/a", width=10, height=10)
+    run = ImportRun(function_id=function.id, source_format="coco", source_path="/a.json")
+    test_session.add_all([label, sample, run])
+    test_session.commit()
+    test_session.add(ImportItem(import_run_id=run.id, source="a.png", key="a.png"))
+    fields = dict(function_id=function.id, sample_id=sample.id, label_id=label.id, annotator_name="a")
+    test_session.add_all(
+        [BoundingBox(**fields, center_x=0.5, center_y=0.5, width=0.1, height=0.1) for _ in range(boxes)]
+    )
+    test_session.commit()
+    return function
+
+
+def row_counts(test_session) -> dict[str, int]:
+    models = [YapFunction, Label, ObjectDetectionSample, BoundingBox, ImportRun, ImportItem]
+    test_session.expire_all()
+    return {model.__name__: len(test_session.exec(select(model)).all()) for model in models}
+
+
+def test_delete_function(client, test_session):
+    function_id = create_function(test_session, "deleted", boxes=3).id
+    create_function(test_session, "kept", boxes=2)
+
+    response = client.delete(f"/api/detection/functions/{function_id}")
+    assert response.status_code == 204
+    assert row_counts(test_session) == {
+        "YapFunction": 1,
+        "Label": 1,
+        "ObjectDetectionSample": 1,
+        "BoundingBox": 2,
+        "ImportRun": 1,
+        "ImportItem": 1,
+    }
+    assert client.delete(f"/api/detection/functions/{function_id}").status_code == 404
+
+
+def test_delete_function_in_a_job(client, run_jobs, test_session, monkeypatch):
+    monkeypatch.setattr("yapml.server.api.job_routes.max_inline_delete_rows", 5)
+    function_id = create_function(test_session, "large", boxes=10).id
+
+    response = client.delete(f"/api/detection/functions/{function_id}")
+    assert response.status_code == 202
+    assert response.json()["kind"] == "delete"
+    # Deleting it again while the job is queued returns the same job.
+    assert client.delete(f"/api/detection/functions/{function_id}").json()["id"] == response.json()["id"]
+
+    assert run_jobs() == 1
+    job = client.get(response.headers["location"]).json()
+    assert job["status"] == "completed"
+    assert job["progress"] == job["total"] == 15
+    assert set(row_counts(test_session).values()) == {0}
+    assert client.get(f"/api/detection/functions/{function_id}").status_code == 404
+
+
+@pytest.mark.parametrize("chunk_size, chunks", [(2, [2, 2, 1, 1]), (10, [5, 1])])
+def test_delete_label_in_chunks(test_session, chunk_size, chunks):
+    function = create_function(test_session, "chunked", boxes=5)
+    label = test_session.exec(select(Label).where(Label.function_id == function.id)).one()
+
+    deleted = []
+    assert delete_label_rows(test_session, label.id, chunk_size=chunk_size, on_chunk=deleted.append) == 6
+    assert deleted == chunks
+    test_session.expire_all()
+    assert label.deleted_at is not None
+    boxes = test_session.exec(select(BoundingBox)).all()
+    assert all(not box.is_head and box.deleted_at == label.deleted_at for box in boxes)
+
+
+def test_cancel_label_deletion(client, run_jobs, test_engine, test_session, monkeypatch):
+    monkeypatch.setattr("yapml.server.api.job_routes.max_inline_delete_rows", 5)
+    function = create_function(test_session, "cancelled", boxes=10)
+    label = test_session.exec(select(Label).where(Label.function_id == function.id)).one()
+    sample = test_session.exec(select(ObjectDetectionSample)).one()
+
+    response = client.delete(f"/api/detection/labels/{label.id}")
+    assert response.status_code == 202
+    job_id = response.json()["id"]
+
+    # The label takes no new boxes while it is being deleted.
+    box = dict(function_id=function.id, sample_id=sample.id, label_id=label.id, annotator_name="a")
+    box |= dict(center_x=0.5, center_y=0.5, width=0.1, height=0.1)
+    assert client.post("/api/detection/boxes", json=box).status_code == 409
+    results = client.post("/api/detection/boxes/batch", json=[box]).json()
+    assert results[0]["detail"] == "Label is being deleted"
+
+    # The job is cancelled after its first chunk of boxes.
+    def delete_and_cancel(session, label_id, on_chunk):
+        def cancel_first(count: int) -> None:
+            with Session(test_engine) as other:
+                other.execute(update(Job).where(Job.id == job_id).values(cancel_requested=True))  # type: ignore
+                other.commit()
+            on_chunk(count)
+
+        return delete_label_rows(session, label_id, chunk_size=4, on_chunk=cancel_first)
+
+    monkeypatch.setitem(DELETERS, "label", delete_and_cancel)
+    assert run_jobs() == 1
+    test_session.expire_all()
+    assert client.get(f"/api/detection/jobs/{job_id}").json()["status"] == "cancelled"
+    assert test_session.get(Label, label.id).deleted_at is None
+    head_boxes = test_session.exec(select(BoundingBox).where(BoundingBox.is_head)).all()
+    assert len(head_boxes) == 6
+
+    # What is left is consistent, so exports still work, and the label takes boxes again.
+    coco = client.get(f"/api/detection/functions/{function.id}/export").json()
+    assert len(coco["annotations"]) == 6
+    for export_format in ("yolo", "voc"):
+        response = client.get(f"/api/detection/functions/{function.id}/export", params={"format": export_format})
+        assert response.status_code == 200
+        assert zipfile.ZipFile(io.BytesIO(response.content)).testzip() is None
+    assert client.post("/api/detection/boxes", json=box).status_code == 200
@@ -0,0 +1,92 @@
+import pytest
+
+from yapml.datamodel import FunctionType, Label, ObjectDetectionSample, YapFunction
+
+
+@pytest.fixture
+def functions(test_session) -> list[tuple[int, int, int]]:
+    """Two functions, with a label and a sample each, as (function id, label id, sample id)"""
+    ids = []
+    for name in ("first", "second"):
+        function = YapFunction(name=name, description="", function_type=FunctionType.OBJECT_DETECTION)
+        test_session.add(function)
+        test_session.commit()
+        label = Label(name=f"{name}_label", color="#FF0000", function_id=function.id)
+        sample = ObjectDetectionSample(function_id=function.id, url=f"/images/{name}", width=10, height=10)
+        test_session.add_all([label, sample])
+        test_session.commit()
+        ids.append((function.id, label.id, sample.id))
+    return ids
+
+
+def box(function_id: int, label_id: int, sample_id: int) -> dict:
+    geometry = dict(center_x=0.5, center_y=0.5, width=0.1, height=0.1)
+    return dict(function_id=function_id, sample_id=sample_id, label_id=label_id, annotator_name="a", **geometry)
+
+
+def test_not_modified(client, functions):
+    (function_id, label_id, sample_id), _ = functions
+    url = f"/api/detection/boxes?function_id={function_id}"
+    response = client.get(url)
+    etag = response.headers["etag"]
+    assert response.headers["cache-control"] == "no-cache"
+
+    response = client.get(url, headers={"If-None-Match": etag})
+    assert response.status_code == 304
+    assert response.content == b""
+    assert response.headers["etag"] == etag
+    assert etag.startswith('W/"')  # The same for gzipped and plain responses.
+    assert client.get(url, headers={"If-None-Match": f'"other", {etag.removeprefix("W/")}'}).status_code == 304
+    assert client.get(url, headers={"If-None-Match": '"other"'}).status_code == 200
+
+    # Boxes listed by sample use the generation of the sample's function.
+    by_sample = client.get(f"/api/detection/boxes?sample_id={sample_id}")
+    assert by_sample.headers["etag"] == etag
+
+
+def test_writes_change_the_etag(client, functions):
+    (function_id, label_id, sample_id), (other_function_id, _, _) = functions
+    urls = [
+        f"/api/detection/boxes?function_id={function_id}",
+        f"/api/detection/samples?function_id={function_id}",
+        f"/api/detection/labels?function_id={function_id}",
+        "/api/detection/labels",
+        f"/functions/{function_id}/labels",
+        f"/functions/{function_id}/samples/{sample_id}",
+    ]
+    other_url = f"/api/detection/boxes?function_id={other_function_id}"
+    other_etag = client.get(other_url).headers["etag"]
+
+    def etags() -> list[str]:
+        return [client.get(url).headers["etag"] for url in urls]
+
+    writes = [
+        lambda: client.post("/api/detection/boxes", json=box(function_id, label_id, sample_id)),
+        lambda: client.post("/api/detection/boxes/batch", json=[box(function_id, label_id, sample_id)]),
+        lambda: client.post("/api/detection/boxes/batch/delete", json=[client.get(urls[0]).json()[0]["id"]]),
+        lambda: client.put(f"/api/detection/labels/{label_id}", json={"color": "#00FF00"}),
+        lambda: client.delete(f"/api/detection/labels/{label_id}"),
+    ]
+    seen = [etags()]
+    for write in writes:
+        assert write().status_code in (200, 204)
+        current = etags()
+        assert all(etag not in previous for previous in seen for etag in current)
+        for url, etag in zip(urls, current):
+            assert client.get(url, headers={"If-None-Match": etag}).status_code == 304, url
+        seen.append(current)
+
+    assert client.get(other_url).headers["etag"] == other_etag
+
+
+def test_pages_change_with_the_version(client, functions, monkeypatch):
+    (function_id, _, _), _ = functions
+    url = f"/functions/{function_id}/labels"
+    etag = client.get(url).headers["etag"]
+    assert etag != client.get(f"/api/detection/labels?function_id={function_id}").headers["etag"]
+
+    # A deploy that changes the assets or the package version makes cached pages stale.
+    monkeypatch.setattr("yapml.server.etags.page_version", lambda: "new")
+    response = client.get(url, headers={"If-None-Match": etag})
+    assert response.status_code == 200
+    assert response.headers["etag"] != etag
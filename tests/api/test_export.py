@@ -0,0 +1,174 @@
+import io
+import json
+import zipfile
+from datetime import datetime
+from xml.etree import ElementTree
+
+import pytest
+from PIL import Image as PILImage
+from sqlmodel import Session, SQLModel
+
+from yapml.datamodel import BoundingBox, FunctionType, Label, ObjectDetectionSample, YapFunction
+from yapml.db import create_sqlite_engine, read_snapshot
+from yapml.export import coco_chunks
+
+
+@pytest.fixture
+def dataset(test_session, tmp_path, monkeypatch):
+    """A function with two labels and three samples, one of them with a stored PNG image and no boxes"""
+    monkeypatch.setattr("yapml.export.image_dir", str(tmp_path))
+    PILImage.new("RGB", (200, 100)).save(tmp_path / "abc", format="PNG")
+
+    function = YapFunction(name="my function", description="", function_type=FunctionType.OBJECT_DETECTION)
+    test_session.add(function)
+    test_session.commit()
+    cat = Label(name="cat", color="#FF0000", function_id=function.id)
+    dog = Label(name="dog", color="#00FF00", function_id=function.id)
+    samples = [
+        ObjectDetectionSample(function_id=function.id, url="https://x/a.jpg", key="a.jpg", width=200, height=100),
+        ObjectDetectionSample(function_id=function.id, url="https://x/b.jpg", width=200, height=100),
+        ObjectDetectionSample(function_id=function.id, url="/images/abc", image_hash="abc", width=200, height=100),
+    ]
+    test_session.add_all([cat, dog, *samples])
+    test_session.commit()
+
+    fields = dict(sample_id=samples[0].id, function_id=function.id, annotator_name="a", width=0.5, height=0.2)
+    box = BoundingBox(**fields, label_id=cat.id, center_x=0.5, center_y=0.5)
+    deleted = BoundingBox(**fields, label_id=dog.id, center_x=0.5, center_y=0.5, deleted_at=datetime.now())
+    test_session.add_all([box, deleted])
+    test_session.commit()
+    moved = BoundingBox(**fields, label_id=cat.id, center_x=0.25, center_y=0.5, previous_box_id=box.id)
+    other = BoundingBox(**fields | {"sample_id": samples[1].id}, label_id=dog.id, center_x=0.75, center_y=0.5)
+    test_session.add_all([moved, other])
+    test_session.commit()
+    return function, [cat, dog], samples, [moved, other]
+
+
+def open_zip(response) -> zipfile.ZipFile:
+    assert response.headers["content-type"] == "application/zip"
+    return zipfile.ZipFile(io.BytesIO(response.content))
+
+
+def test_export_coco(client, dataset):
+    function, labels, samples, boxes = dataset
+    response = client.get(f"/api/detection/functions/{function.id}/export")
+    assert response.status_code == 200
+    assert response.headers["content-disposition"] == 'attachment; filename="my_function-coco.json"'
+
+    coco = response.json()
+    assert coco["categories"] == [{"id": label.id, "name": label.name} for label in labels]
+    assert [image["file_name"] for image in coco["images"]] == [
+        f"{samples[0].id}.jpg",
+        f"{samples[1].id}.jpg",
+        f"{samples[2].id}.png",
+    ]
+    assert [annotation["id"] for annotation in coco["annotations"]] == [box.id for box in boxes]
+    assert coco["annotations"][0]["image_id"] == samples[0].id
+    assert coco["annotations"][0]["category_id"] == labels[0].id
+    assert coco["annotations"][0]["bbox"] == [0.0, 40.0, 100.0, 20.0]
+    assert coco["annotations"][0]["area"] == 2000.0
+
+
+def test_export_coco_with_images(client, dataset):
+    function, _, samples, _ = dataset
+    response = client.get(f"/api/detection/functions/{function.id}/export", params={"images": True})
+    archive = open_zip(response)
+    assert archive.namelist() == ["annotations.json", f"images/{samples[2].id}.png"]
+    assert len(json.loads(archive.read("annotations.json"))["annotations"]) == 2
+    assert archive.getinfo(f"images/{samples[2].id}.png").compress_type == zipfile.ZIP_STORED
+    assert PILImage.open(archive.open(f"images/{samples[2].id}.png")).size == (200, 100)
+
+
+def test_export_yolo(client, dataset):
+    function, labels, samples, _ = dataset
+    response = client.get(f"/api/detection/functions/{function.id}/export", params={"format": "yolo"})
+    assert response.headers["content-disposition"] == 'attachment; filename="my_function-yolo.zip"'
+    archive = open_zip(response)
+    assert archive.read("classes.txt") == b"cat\ndog\n"
+    assert archive.read(f"labels/{samples[0].id}.txt") == b"0 0.250000 0.500000 0.500000 0.200000\n"
+    assert archive.read(f"labels/{samples[1].id}.txt") == b"1 0.750000 0.500000 0.500000 0.200000\n"
+    assert archive.read(f"labels/{samples[2].id}.txt") == b""
+
+
+def test_export_voc_with_images(client, dataset):
+    function, _, samples, _ = dataset
+    response = client.get(f"/api/detection/functions/{function.id}/export", params={"format": "voc", "images": True})
+    archive = open_zip(response)
+    assert f"JPEGImages/{samples[2].id}.png" in archive.namelist()
+    annotation = ElementTree.fromstring(archive.read(f"Annotations/{samples[1].id}.xml"))
+    assert annotation.findtext("filename") == f"{samples[1].id}.jpg"
+    assert annotation.findtext("object/name") == "dog"
+    assert [annotation.findtext(f"object/bndbox/{name}") for name in ("xmin", "ymin", "xmax", "ymax")] == [
+        "100",
+        "40",
+        "200",
+        "60",
+    ]
+
+
+def test_export_skips_boxes_of_deleted_labels(client, test_session, dataset):
+    function, labels, samples, boxes = dataset
+    # The dog label is deleted, but its box is still current, as if its deletion stopped halfway.
+    labels[1].deleted_at = datetime.now()
+    test_session.add(labels[1])
+    test_session.commit()
+
+    coco = client.get(f"/api/detection/functions/{function.id}/export").json()
+    assert coco["categories"] == [{"id": labels[0].id, "name": "cat"}]
+    assert [annotation["id"] for annotation in coco["annotations"]] == [boxes[0].id]
+    yolo = open_zip(client.get(f"/api/detection/functions/{function.id}/export", params={"format": "yolo"}))
+    assert yolo.read("classes.txt") == b"cat\n"
+    assert yolo.read(f"labels/{samples[1].id}.txt") == b""
+    voc = open_zip(client.get(f"/api/detection/functions/{function.id}/export", params={"format": "voc"}))
+    assert ElementTree.fromstring(voc.read(f"Annotations/{samples[1].id}.xml")).find("object") is None
+
+
+def test_export_errors(client, dataset):
+    function, *_ = dataset
+    assert client.get("/api/detection/functions/9999/export").status_code == 404
+    assert client.get(f"/api/detection/functions/{function.id}/export", params={"format": "csv"}).status_code == 422
+
+
+def test_export_non_ascii_name(client, test_session, dataset):
+    function, *_ = dataset
+    function.name = "Küchen Geräte"
+    test_session.add(function)
+    test_session.commit()
+    response = client.get(f"/api/detection/functions/{function.id}/export")
+    assert response.status_code == 200
+    assert response.headers["content-disposition"] == (
+        "attachment; filename=\"K_chen_Ger_te-coco.json\"; filename*=UTF-8''K%C3%BCchen_Ger%C3%A4te-coco.json"
+    )
+
+
+def test_export_coco_reads_one_snapshot(tmp_path):
+    url = f"sqlite:///{tmp_path}/test.db"
+    writer = create_sqlite_engine(url)
+    SQLModel.metadata.create_all(writer)
+    with Session(writer) as session:
+        function = YapFunction(name="f", description="", function_type=FunctionType.OBJECT_DETECTION)
+        session.add(function)
+        session.commit()
+        label = Label(name="cat", color="#FF0000", function_id=function.id)
+        session.add_all([label, ObjectDetectionSample(function_id=function.id, url="https://x/a.jpg")])
+        session.commit()
+        session.refresh(function)
+        session.refresh(label)
+
+    with Session(create_sqlite_engine(url, read_only=True)) as export_session, read_snapshot(export_session):
+        chunks = coco_chunks(export_session, function, [label])
+        data = b""
+        while b'"annotations"' not in data:
+            data += next(chunks)
+        # A sample with a box is added after the images array is written.
+        with Session(writer) as session:
+            sample = ObjectDetectionSample(function_id=function.id, url="https://x/b.jpg")
+            session.add(sample)
+            session.commit()
+            fields = dict(center_x=0.5, center_y=0.5, width=0.1, height=0.1, annotator_name="a")
+            session.add(BoundingBox(**fields, sample_id=sample.id, function_id=function.id, label_id=label.id))
+            session.commit()
+        coco = json.loads(data + b"".join(chunks))
+
+    assert len(coco["images"]) == 1
+    assert coco["annotations"] == []
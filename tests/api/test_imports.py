@@ -0,0 +1,299 @@
+import io
+import json
+import os
+import zipfile
+
+import anyio
+import pytest
+from PIL import Image as PILImage
+from sqlmodel import Session, select
+
+from yapml import importer, ingestion
+from yapml.datamodel import BoundingBox, FunctionType, ImportRun, Job, Label, ObjectDetectionSample, YapFunction
+from yapml.deletion import delete_label_rows, deletion_key
+from yapml.importer import find_dataset, read_yolo, run_import
+
+
+@pytest.fixture
+def function_id(test_session) -> int:
+    function = YapFunction(name="imports", description="", function_type=FunctionType.OBJECT_DETECTION)
+    test_session.add(function)
+    test_session.commit()
+    assert function.id is not None
+    return function.id
+
+
+def write_image(path, color: tuple[int, int, int], size=(200, 100)) -> None:
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    PILImage.new("RGB", size, color).save(path, format="PNG")
+
+
+@pytest.fixture
+def coco_dataset(tmp_path) -> str:
+    """Three images, one of them a copy of another, and a box that sticks out of its image"""
+    write_image(tmp_path / "images" / "a.png", (255, 0, 0))
+    write_image(tmp_path / "images" / "b.png", (0, 255, 0))
+    write_image(tmp_path / "images" / "c.png", (255, 0, 0))
+    coco = {
+        "categories": [{"id": 7, "name": "traffic light"}, {"id": 8, "name": "car"}],
+        "images": [
+            {"id": 1, "file_name": "a.png", "width": 200, "height": 100},
+            {"id": 2, "file_name": "b.png", "width": 200, "height": 100},
+            {"id": 3, "file_name": "c.png", "width": 200, "height": 100},
+        ],
+        "annotations": [
+            {"id": 1, "image_id": 1, "category_id": 7, "bbox": [0, 40, 100, 20]},
+            {"id": 2, "image_id": 2, "category_id": 8, "bbox": [150, 50, 100, 100]},
+            {"id": 3, "image_id": 3, "category_id": 8, "bbox": [10, 10, 10, 10]},
+        ],
+    }
+    path = tmp_path / "annotations.json"
+    path.write_text(json.dumps(coco))
+    return str(path)
+
+
+@pytest.fixture
+def yolo_dataset(tmp_path) -> str:
+    root = tmp_path / "yolo"
+    write_image(root / "images" / "train" / "x.png", (0, 0, 255))
+    write_image(root / "images" / "val" / "y.png", (0, 255, 255))
+    os.makedirs(root / "labels" / "train")
+    (root / "labels" / "train" / "x.txt").write_text("1 0.5 0.5 0.2 0.4\n0 0.25 0.25 0.1 0.1\n")
+    (root / "classes.txt").write_text("person\nbicycle\n")
+    return str(root)
+
+
+def test_import_coco(client, run_jobs, test_session, function_id, coco_dataset):
+    response = client.post(
+        f"/api/detection/functions/{function_id}/imports", json={"source_format": "coco", "path": coco_dataset}
+    )
+    assert response.status_code == 202
+    assert response.json()["status"] == "pending"
+    assert client.get(f"/api/detection/jobs/{response.json()['job_id']}").json()["status"] == "queued"
+    assert run_jobs() == 1
+    progress = client.get(f"/api/detection/imports/{response.json()['id']}").json()
+    assert progress["status"] == "completed"
+    assert progress["total_images"] == progress["processed_images"] == 3
+    assert progress["created_samples"] == 2
+    assert progress["duplicate_images"] == 1
+    assert progress["created_boxes"] == 2
+    assert progress["images_per_second"] > 0
+
+    labels = {label.name: label for label in test_session.exec(select(Label)).all()}
+    assert set(labels) == {"traffic_light", "car"}
+    samples = test_session.exec(select(ObjectDetectionSample).order_by(ObjectDetectionSample.id)).all()
+    assert [sample.key for sample in samples] == ["a.png", "b.png"]
+    boxes = test_session.exec(select(BoundingBox).order_by(BoundingBox.id)).all()
+    assert [(box.sample_id, box.label_id) for box in boxes] == [
+        (samples[0].id, labels["traffic_light"].id),
+        (samples[1].id, labels["car"].id),
+    ]
+    assert (boxes[0].center_x, boxes[0].center_y, boxes[0].width, boxes[0].height) == (0.25, 0.5, 0.5, 0.2)
+    # Clipped to the image.
+    assert (boxes[1].center_x, boxes[1].center_y, boxes[1].width, boxes[1].height) == (0.875, 0.75, 0.25, 0.5)
+    assert boxes[0].lineage_id == boxes[0].id
+    assert boxes[0].is_head
+
+    listed = client.get(f"/api/detection/functions/{function_id}/imports").json()
+    assert [run["id"] for run in listed] == [progress["id"]]
+
+
+def test_read_yolo(yolo_dataset):
+    classes, images = read_yolo(yolo_dataset)
+    assert classes == ["person", "bicycle"]
+    images = list(images)
+    assert [image.key for image in images] == ["train/x.png", "val/y.png"]
+    assert images[0].boxes == [("bicycle", 0.5, 0.5, 0.2, 0.4), ("person", 0.25, 0.25, 0.1, 0.1)]
+    assert images[1].boxes == []
+
+
+def test_find_dataset_annotations(tmp_path):
+    (tmp_path / "dataset").mkdir()
+    (tmp_path / "dataset" / "coco.json").write_text("{}")
+    (tmp_path / "secret.json").write_text("{}")
+    directory = str(tmp_path / "dataset")
+    assert find_dataset(directory, "coco", "coco.json") == str(tmp_path / "dataset" / "coco.json")
+    for outside in ("../secret.json", str(tmp_path / "secret.json"), "missing.json"):
+        with pytest.raises(ValueError, match="is not in the archive"):
+            find_dataset(directory, "coco", outside)
+
+
+def test_upload_yolo_archive(client, run_jobs, test_session, function_id, yolo_dataset):
+    archive = io.BytesIO()
+    with zipfile.ZipFile(archive, "w") as zip_file:
+        for directory, _, files in os.walk(yolo_dataset):
+            for name in files:
+                path = os.path.join(directory, name)
+                zip_file.write(path, os.path.join("dataset", os.path.relpath(path, yolo_dataset)))
+    response = client.post(
+        f"/api/detection/functions/{function_id}/imports/upload",
+        data={"source_format": "yolo"},
+        files={"archive": ("dataset.zip", archive.getvalue(), "application/zip")},
+    )
+    assert response.status_code == 202
+    run_jobs()
+    run = test_session.get(ImportRun, response.json()["id"])
+    assert run.status == "completed"
+    assert run.created_samples == 2
+    assert run.created_boxes == 2
+    assert not os.path.exists(run.upload_dir)
+
+
+def test_upload_invalid_archive(client, function_id):
+    response = client.post(
+        f"/api/detection/functions/{function_id}/imports/upload",
+        data={"source_format": "yolo"},
+        files={"archive": ("dataset.zip", b"not a zip", "application/zip")},
+    )
+    assert response.status_code == 422
+
+
+def test_import_errors(client, run_jobs, function_id, test_session, tmp_path):
+    response = client.post(
+        "/api/detection/functions/9999/imports", json={"source_format": "coco", "path": str(tmp_path)}
+    )
+    assert response.status_code == 404
+    response = client.post(
+        f"/api/detection/functions/{function_id}/imports",
+        json={"source_format": "coco", "path": str(tmp_path / "missing.json")},
+    )
+    assert response.status_code == 422
+
+    # A label name that another function uses fails the import.
+    other = YapFunction(name="other", description="", function_type=FunctionType.OBJECT_DETECTION)
+    test_session.add(other)
+    test_session.commit()
+    test_session.add(Label(name="person", color="#FF0000", function_id=other.id))
+    test_session.commit()
+    (tmp_path / "classes.txt").write_text("person\n")
+    response = client.post(
+        f"/api/detection/functions/{function_id}/imports", json={"source_format": "yolo", "path": str(tmp_path)}
+    )
+    run_jobs()
+    progress = client.get(f"/api/detection/imports/{response.json()['id']}").json()
+    assert progress["status"] == "failed"
+    assert progress["error"] == "Label name person is used by another function"
+    # The job waits to be retried, resuming the import runs it right away.
+    job = client.get(f"/api/detection/jobs/{response.json()['job_id']}").json()
+    assert (job["status"], job["attempts"], job["error"]) == ("queued", 1, progress["error"])
+    assert run_jobs() == 0
+    resumed = client.post(f"/api/detection/imports/{progress['id']}/resume").json()
+    assert resumed["job_id"] == job["id"]
+    assert run_jobs() == 1
+    assert client.get(f"/api/detection/jobs/{job['id']}").json()["attempts"] == 2
+
+
+def test_resume_import(client, run_jobs, test_engine, test_session, function_id, coco_dataset, monkeypatch):
+    """An import that fails halfway continues with the images it did not ingest yet"""
+    run = ImportRun(function_id=function_id, source_format="coco", source_path=coco_dataset)
+    test_session.add(run)
+    test_session.commit()
+
+    ingest_samples = importer.ingest_samples
+    calls = []
+
+    def interrupted_ingest_samples(*args, **kwargs):
+        calls.append(args)
+        if len(calls) == 2:
+            raise RuntimeError("Interrupted")
+        return ingest_samples(*args, **kwargs)
+
+    monkeypatch.setattr(importer, "ingest_samples", interrupted_ingest_samples)
+    with pytest.raises(RuntimeError):
+        anyio.run(lambda: run_import(lambda: Session(test_engine), run.id, batch_size=1))
+    test_session.refresh(run)
+    assert run.status == "failed"
+    assert run.error == "Interrupted"
+    assert run.processed_images == 1
+
+    response = client.post(f"/api/detection/imports/{run.id}/resume")
+    assert response.status_code == 202
+    run_jobs()
+    test_session.refresh(run)
+    assert run.status == "completed"
+    assert (run.processed_images, run.created_samples, run.duplicate_images) == (3, 2, 1)
+    assert len(test_session.exec(select(BoundingBox)).all()) == 2
+    assert client.post(f"/api/detection/imports/{run.id}/resume").status_code == 409
+
+
+def test_import_label_being_deleted(test_engine, test_session, function_id, coco_dataset):
+    """An import does not restore or add boxes to a label that a job is deleting"""
+    car = Label(name="car", color="#FF0000", function_id=function_id)
+    test_session.add(car)
+    test_session.commit()
+    job = Job(kind="delete", key=deletion_key("label", car.id), status="running")
+    test_session.add(job)
+    test_session.commit()
+
+    run = ImportRun(function_id=function_id, source_format="coco", source_path=coco_dataset)
+    test_session.add(run)
+    test_session.commit()
+    with pytest.raises(ValueError, match="Label car is being deleted"):
+        anyio.run(lambda: run_import(lambda: Session(test_engine), run.id))
+    test_session.refresh(run)
+    assert (run.status, run.planned) == ("failed", False)
+
+    # A deletion that starts after the import was planned fails it before the boxes of the label are added.
+    job.status = "completed"
+    test_session.add(job)
+    test_session.commit()
+
+    def start_deletion(run: ImportRun) -> None:
+        if run.processed_images == 1:
+            with Session(test_engine) as session:
+                session.add(Job(kind="delete", key=deletion_key("label", car.id), status="running"))
+                session.commit()
+
+    with pytest.raises(ValueError, match="Label car is being deleted"):
+        anyio.run(lambda: run_import(lambda: Session(test_engine), run.id, batch_size=1, on_batch=start_deletion))
+    test_session.refresh(run)
+    assert (run.status, run.processed_images, run.created_boxes) == ("failed", 1, 1)
+
+    # Once the label is deleted, the import resumes without its boxes.
+    with Session(test_engine) as session:
+        session.exec(select(Job).where(Job.status == "running")).one().status = "completed"
+        delete_label_rows(session, car.id)
+    anyio.run(lambda: run_import(lambda: Session(test_engine), run.id))
+    test_session.expire_all()
+    assert (run.status, run.processed_images, run.created_samples, run.created_boxes) == ("completed", 3, 2, 1)
+    assert [box.label_id for box in test_session.exec(select(BoundingBox)).all()] == [
+        test_session.exec(select(Label.id).where(Label.name == "traffic_light")).one()
+    ]
+    assert test_session.get(Label, car.id).deleted_at is not None
+
+
+def test_resume_import_after_insert_race(test_engine, test_session, function_id, coco_dataset, tmp_path, monkeypatch):
+    """An import that stops while it inserts samples one at a time after a race keeps the boxes of those it inserted"""
+    monkeypatch.setattr("yapml.ingestion.image_dir", str(tmp_path))
+    run = ImportRun(function_id=function_id, source_format="coco", source_path=coco_dataset)
+    test_session.add(run)
+    test_session.commit()
+
+    store_image = ingestion.store_image
+
+    def racing_store_image(decoded):
+        store_image(decoded)
+        if decoded.sample.key == "b.png":
+            # Another request inserts the same image before the chunk is flushed.
+            with Session(test_engine) as session:
+                session.add(ObjectDetectionSample(function_id=function_id, url="x", image_hash=decoded.image_hash))
+                session.commit()
+
+    record_results = importer.record_results
+
+    def interrupted_record_results(session, results, run, items):
+        if any(result.index == 1 for result in results):
+            raise RuntimeError("Interrupted")
+        record_results(session, results, run, items)
+
+    monkeypatch.setattr(ingestion, "store_image", racing_store_image)
+    monkeypatch.setattr(importer, "record_results", interrupted_record_results)
+    with pytest.raises(RuntimeError):
+        anyio.run(lambda: run_import(lambda: Session(test_engine), run.id))
+
+    monkeypatch.setattr(importer, "record_results", record_results)
+    anyio.run(lambda: run_import(lambda: Session(test_engine), run.id))
+    test_session.refresh(run)
+    assert (run.processed_images, run.created_samples, run.duplicate_images, run.created_boxes) == (3, 1, 2, 1)
+    sample = test_session.exec(select(ObjectDetectionSample).where(ObjectDetectionSample.key == "a.png")).one()
+    assert [box.sample_id for box in test_session.exec(select(BoundingBox)).all()] == [sample.id]
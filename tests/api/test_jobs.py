@@ -0,0 +1,107 @@
+import pytest
+from sqlmodel import Session, select
+
+from yapml import jobs
+from yapml.datamodel import Job
+from yapml.jobs import JOB_HANDLERS, JobContext, enqueue_job, requeue_interrupted_jobs, schedule_jobs
+
+
+@pytest.fixture
+def steps(monkeypatch) -> list[int]:
+    """A job kind that reports three steps, and fails its first attempt if asked to"""
+    done = []
+
+    def handler(context: JobContext) -> None:
+        for step in range(3):
+            done.append(step)
+            context.report(step + 1, 3)
+            if context.params.get("fail") and step == 1 and len(done) == 2:
+                raise RuntimeError("Step failed")
+
+    monkeypatch.setitem(JOB_HANDLERS, "steps", handler)
+    return done
+
+
+def test_job_progress(client, run_jobs, test_session, steps):
+    job = enqueue_job(test_session, "steps", {}, key="a")
+    assert enqueue_job(test_session, "steps", {}, key="a").id == job.id
+    assert enqueue_job(test_session, "steps", {}, key="b").id != job.id
+
+    assert run_jobs() == 2
+    test_session.expire_all()  # The jobs ran in sessions of their own.
+    status = client.get(f"/api/detection/jobs/{job.id}").json()
+    assert (status["status"], status["progress"], status["total"], status["attempts"]) == ("completed", 3, 3, 1)
+    assert [job["key"] for job in client.get("/api/detection/jobs").json()] == ["b", "a"]
+    assert client.get("/api/detection/jobs", params={"status": "queued"}).json() == []
+    assert client.post(f"/api/detection/jobs/{job.id}/cancel").status_code == 409
+    assert client.get("/api/detection/jobs/9999").status_code == 404
+
+
+def test_job_retry(client, run_jobs, test_session, steps):
+    job = enqueue_job(test_session, "steps", {"fail": True}, key="a", max_attempts=2)
+    assert run_jobs() == 1
+    test_session.refresh(job)
+    assert (job.status, job.attempts, job.error) == ("queued", 1, "Step failed")
+    assert job.run_after > job.started_at
+
+    # Queueing it again makes the retry due right away.
+    enqueue_job(test_session, "steps", {"fail": True}, key="a")
+    assert run_jobs() == 1
+    test_session.refresh(job)
+    assert (job.status, job.attempts) == ("completed", 2)
+    assert steps == [0, 1, 0, 1, 2]
+
+
+def test_job_cancel(client, run_jobs, test_engine, test_session, steps):
+    queued = enqueue_job(test_session, "steps", {})
+    assert client.post(f"/api/detection/jobs/{queued.id}/cancel").json()["status"] == "cancelled"
+    assert run_jobs() == 0
+
+    # A running job stops at its next progress report.
+    running = enqueue_job(test_session, "steps", {})
+    running.status = "running"
+    test_session.add(running)
+    test_session.commit()
+    assert client.post(f"/api/detection/jobs/{running.id}/cancel").json()["cancel_requested"]
+    requeue_interrupted_jobs(lambda: Session(test_engine))
+    assert run_jobs() == 1
+    test_session.refresh(running)
+    assert (running.status, running.progress) == ("cancelled", 1)
+    assert steps == [0]
+
+
+def test_scheduled_jobs(client, run_jobs, test_engine, steps):
+    def schedule(interval: float) -> None:
+        schedule_jobs(lambda: Session(test_engine), {"steps": interval})
+
+    # Queued once, and again only when the previous run finished longer ago than the interval.
+    schedule(3600)
+    schedule(3600)
+    assert run_jobs() == 1
+    schedule(3600)
+    assert run_jobs() == 0
+    schedule(0)
+    assert run_jobs() == 1
+    assert steps == [0, 1, 2] * 2
+
+
+def test_enqueue_race(test_engine, test_session, steps, monkeypatch):
+    """Two processes that look for the active job at the same time queue it once"""
+    first = enqueue_job(test_session, "steps", {}, key="a")
+    find_active_job = jobs.find_active_job
+    lookups = []
+
+    def late_find_active_job(*args):
+        lookups.append(args)
+        return None if len(lookups) == 1 else find_active_job(*args)
+
+    monkeypatch.setattr(jobs, "find_active_job", late_find_active_job)
+    with Session(test_engine) as session:
+        assert enqueue_job(session, "steps", {}, key="a").id == first.id
+    assert len(test_session.exec(select(Job)).all()) == 1
+
+
+def test_unknown_job_kind(test_session):
+    with pytest.raises(ValueError):
+        enqueue_job(test_session, "unknown", {})
+    assert test_session.get(Job, 1) is None
@@ -1,4 +1,7 @@
+from datetime import datetime
+
 import pytest
+from sqlalchemy import event
 from sqlmodel import select
 
 from yapml.datamodel import BoundingBox, Label
@@ -41,6 +44,47 @@ def test_list_labels(client):
     assert data[1]["color"] == "#00FF10"
 
 
+def test_list_label_statistics(client, test_engine, test_session):
+    """Labels are listed with counts of their current boxes, in a number of queries that does not grow with them"""
+    cat = Label(name="cat", color="#FF0000", function_id=1)
+    dog = Label(name="dog", color="#00FF00", function_id=1)
+    test_session.add_all([cat, dog])
+    test_session.commit()
+    fields = dict(function_id=1, center_x=0.5, center_y=0.5, width=0.1, height=0.1)
+    boxes = [
+        BoundingBox(**fields, label_id=cat.id, sample_id=1, annotator_name="ann"),
+        BoundingBox(**fields, label_id=cat.id, sample_id=1, annotator_name="bob"),
+        BoundingBox(**fields, label_id=cat.id, sample_id=2, annotator_name="ann"),
+        BoundingBox(**fields, label_id=cat.id, sample_id=3, annotator_name="ann", deleted_at=datetime.now()),
+    ]
+    test_session.add_all(boxes)
+    test_session.commit()
+    # A newer version replaces the box it was made from in the counts.
+    test_session.add(
+        BoundingBox(**fields, label_id=cat.id, sample_id=2, annotator_name="bob", previous_box_id=boxes[2].id)
+    )
+    test_session.commit()
+
+    statements = []
+
+    def count_statements(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    event.listen(test_engine, "before_cursor_execute", count_statements)
+    try:
+        response = client.get("/api/detection/labels", params={"function_id": 1})
+    finally:
+        event.remove(test_engine, "before_cursor_execute", count_statements)
+
+    assert response.status_code == 200
+    assert [(label["name"], label["box_count"], label["sample_count"]) for label in response.json()] == [
+        ("cat", 3, 2),
+        ("dog", 0, 0),
+    ]
+    assert response.json()[0]["annotator_box_counts"] == {"ann": 1, "bob": 2}
+    assert len(statements) == 4  # generation, labels, box and sample counts, annotator counts
+
+
 def test_create_label_json(client):
     """Test creating a label via JSON"""
     label_data = {"name": "new_label", "color": "#00FF00", "function_id": 1}
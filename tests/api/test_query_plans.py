@@ -0,0 +1,100 @@
+"""
+Every query the endpoints run should find its rows through an index.
+
+The endpoints are called against a small database while their SQL is recorded, and EXPLAIN QUERY PLAN of each SELECT
+must not contain a full scan of a table. Queries over a whole table, like listing all functions, are expected to
+scan and are not exercised here.
+"""
+
+import re
+
+import pytest
+from sqlalchemy import event
+from sqlmodel import SQLModel
+
+from yapml.datamodel import BoundingBox, FunctionType, Label, ObjectDetectionSample, YapFunction
+
+TABLES = {table.name for table in SQLModel.metadata.sorted_tables}
+
+
+@pytest.fixture
+def annotated_function(test_session) -> YapFunction:
+    function = YapFunction(name="test", description="test", function_type=FunctionType.OBJECT_DETECTION)
+    test_session.add(function)
+    test_session.commit()
+    label = Label(name="cat", color="#FF0000", function_id=function.id)
+    samples = [
+        ObjectDetectionSample(function_id=function.id, url=f"/images/{i}", perceptual_hash=f"{i:016x}")
+        for i in range(3)
+    ]
+    test_session.add_all([label, *samples])
+    test_session.commit()
+    for sample in samples:
+        fields = dict(sample_id=sample.id, function_id=function.id, label_id=label.id, annotator_name="a")
+        box = BoundingBox(**fields, center_x=0.5, center_y=0.5, width=0.1, height=0.1)
+        test_session.add(box)
+        test_session.commit()
+        test_session.add(
+            BoundingBox(**fields, center_x=0.6, center_y=0.5, width=0.1, height=0.1, previous_box_id=box.id)
+        )
+        test_session.commit()
+    return function
+
+
+def full_scans(connection, statement: str, parameters) -> list[str]:
+    plan = connection.exec_driver_sql(f"EXPLAIN QUERY PLAN {statement}", parameters).all()
+    return [row.detail for row in plan if (match := re.match(r"SCAN (\w+)", row.detail)) and match.group(1) in TABLES]
+
+
+def test_endpoint_queries_use_indexes(client, test_engine, test_session, annotated_function):
+    function_id = annotated_function.id
+    sample_id = (
+        test_session.exec(
+            ObjectDetectionSample.__table__.select().where(ObjectDetectionSample.function_id == function_id)
+        )
+        .first()
+        .id
+    )
+    box_id = test_session.exec(BoundingBox.__table__.select().where(BoundingBox.is_head)).first().id
+    label_id = test_session.exec(Label.__table__.select()).first().id
+
+    statements = []
+
+    def record(connection, cursor, statement, parameters, context, executemany):
+        if statement.lstrip().upper().startswith("SELECT"):
+            statements.append((statement, parameters))
+
+    event.listen(test_engine, "before_cursor_execute", record)
+    try:
+        requests = [
+            f"/api/detection/samples?function_id={function_id}&limit=2",
+            f"/api/detection/samples?function_id={function_id}&limit=2&cursor={sample_id}",
+            f"/api/detection/samples/{sample_id}",
+            f"/api/detection/boxes?sample_id={sample_id}",
+            f"/api/detection/boxes?function_id={function_id}",
+            f"/api/detection/boxes?function_id={function_id}&include_stale=true",
+            f"/api/detection/boxes?function_id={function_id}&include_deleted=true",
+            f"/api/detection/labels?function_id={function_id}",
+            f"/api/detection/samples/{sample_id}/history",
+            f"/api/detection/samples/{sample_id}/history?lineage_id={box_id}",
+            f"/api/detection/samples/{sample_id}/near-duplicates",
+            f"/api/detection/functions/{function_id}/near-duplicates",
+            f"/functions/{function_id}/samples",
+            f"/functions/{function_id}/labels",
+            f"/functions/{function_id}/samples/{sample_id}",
+            f"/api/detection/functions/{function_id}/export",
+            f"/api/detection/functions/{function_id}/export?format=yolo",
+            f"/api/detection/functions/{function_id}/imports",
+            "/api/detection/jobs?status=queued",
+        ]
+        for url in requests:
+            assert client.get(url).status_code == 200, url
+        assert client.put(f"/api/detection/boxes/{box_id}", json={"center_x": 0.6}).status_code == 200
+        assert client.delete(f"/api/detection/labels/{label_id}").status_code == 204
+    finally:
+        event.remove(test_engine, "before_cursor_execute", record)
+
+    assert len(statements) > len(requests)
+    with test_engine.connect() as connection:
+        scans = {statement: full_scans(connection, statement, parameters) for statement, parameters in statements}
+    assert {statement: scan for statement, scan in scans.items() if scan} == {}
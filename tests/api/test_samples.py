@@ -1,11 +1,19 @@
+import hashlib
+import json
+import os
 from base64 import b64encode
 from io import BytesIO
 
+import anyio
 import numpy as np
 import pytest
 from PIL import Image
+from sqlalchemy import event
+from sqlmodel import Session
 
-from yapml.datamodel import FunctionType, ObjectDetectionSample, YapFunction
+from yapml.datamodel import BoundingBox, FunctionType, Label, ObjectDetectionSample, YapFunction
+from yapml.ingestion import IngestResult, ingest_samples
+from yapml.server.api import fetch_sample_page
 
 
 @pytest.fixture
@@ -55,6 +63,109 @@ def test_list_samples(client, sample_fixture):
     assert "height" in samples[0]
 
 
+def test_list_samples_paginated(client, test_session, function_fixture):
+    """Test walking through the samples with cursor and limit"""
+    samples = [
+        ObjectDetectionSample(key=f"{i}.jpg", url=f"https://x/{i}.jpg", function_id=function_fixture.id)
+        for i in range(5)
+    ]
+    test_session.add_all(samples)
+    test_session.commit()
+
+    response = client.get("/api/detection/samples", params={"function_id": function_fixture.id, "limit": 2})
+    assert response.status_code == 200
+    assert [s["key"] for s in response.json()] == ["0.jpg", "1.jpg"]
+    cursor = response.headers["X-Next-Cursor"]
+    assert 'rel="next"' in response.headers["Link"]
+
+    response = client.get(
+        "/api/detection/samples", params={"function_id": function_fixture.id, "limit": 2, "cursor": cursor}
+    )
+    assert [s["key"] for s in response.json()] == ["2.jpg", "3.jpg"]
+    cursor = response.headers["X-Next-Cursor"]
+
+    response = client.get(
+        "/api/detection/samples", params={"function_id": function_fixture.id, "limit": 2, "cursor": cursor}
+    )
+    assert [s["key"] for s in response.json()] == ["4.jpg"]
+    assert "X-Next-Cursor" not in response.headers
+
+
+def test_sample_cards_fragment(client, test_session, function_fixture, monkeypatch):
+    """The samples grid loads further pages of cards through its sentinel, until the last page"""
+    monkeypatch.setattr("yapml.server.ui_routes.samples_grid_page_size", 2)
+    samples = [
+        ObjectDetectionSample(key=f"{i}.jpg", url=f"https://x/{i}.jpg", function_id=function_fixture.id)
+        for i in range(3)
+    ]
+    test_session.add_all(samples)
+    test_session.commit()
+
+    page = client.get(f"/functions/{function_fixture.id}/samples").text
+    assert page.count('class="sample-cell"') == 2
+    next_url = f"/functions/{function_fixture.id}/sample-cards?cursor={samples[1].id}"
+    assert f'hx-get="{next_url}"' in page
+
+    response = client.get(next_url)
+    assert response.status_code == 200
+    assert response.text.count('class="sample-cell"') == 1
+    assert f"/functions/{function_fixture.id}/samples/{samples[2].id}" in response.text
+    assert "sample-grid-sentinel" not in response.text
+
+    # A full page that is followed by more ends with a sentinel for the next one.
+    response = client.get(f"/functions/{function_fixture.id}/sample-cards", params={"cursor": 0})
+    assert response.text.count('class="sample-cell"') == 2
+    assert f"sample-cards?cursor={samples[1].id}" in response.text
+    assert "sample-grid-sentinel" in response.text
+
+
+def test_list_samples_limit_too_large(client):
+    response = client.get("/api/detection/samples", params={"limit": 100000})
+    assert response.status_code == 422
+
+
+def test_fetch_sample_page_query_count(test_engine, test_session, function_fixture):
+    """Boxes and labels of a page are loaded in a constant number of queries"""
+    label = Label(name="cat", color="#FF0000", function_id=function_fixture.id)
+    test_session.add(label)
+    samples = [ObjectDetectionSample(url=f"https://x/{i}.jpg", function_id=function_fixture.id) for i in range(20)]
+    test_session.add_all(samples)
+    test_session.commit()
+    boxes = [
+        BoundingBox(
+            sample_id=sample.id,
+            function_id=function_fixture.id,
+            label_id=label.id,
+            center_x=0.5,
+            center_y=0.5,
+            width=0.1,
+            height=0.1,
+            annotator_name="test",
+        )
+        for sample in samples
+    ]
+    test_session.add_all(boxes)
+    test_session.commit()
+    function_id = function_fixture.id
+    test_session.expire_all()
+
+    statements = []
+
+    def count_statements(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    event.listen(test_engine, "before_cursor_execute", count_statements)
+    try:
+        page = fetch_sample_page(test_session, function_id=function_id, limit=10)
+        assert all(box.label.name == "cat" for sample in page.samples for box in sample.boxes)
+    finally:
+        event.remove(test_engine, "before_cursor_execute", count_statements)
+
+    assert len(page.samples) == 10
+    assert page.next_cursor == page.samples[-1].id
+    assert len(statements) == 3  # samples, boxes, labels
+
+
 class TestSamplePost:
     def create_test_image(self, width: int, height: int) -> tuple[bytes, str]:
         """Helper method to create a test image and return both bytes and data URI"""
@@ -164,6 +275,215 @@ class TestSamplePost:
         assert response.status_code == 422
 
 
+class TestSampleBatch:
+    def data_uri(self, width: int = 20, height: int = 20) -> str:
+        img_array = np.random.randint(0, 255, (height, width, 3), dtype=np.uint8)
+        img_byte_arr = BytesIO()
+        Image.fromarray(img_array).save(img_byte_arr, format="PNG")
+        return f"data:image/png;base64,{b64encode(img_byte_arr.getvalue()).decode('utf-8')}"
+
+    def test_create_samples_batch(self, client, test_session, function_fixture):
+        existing_uri = self.data_uri()
+        response = client.post("/api/detection/samples", json={"url": existing_uri, "function_id": function_fixture.id})
+        assert response.status_code == 200
+        existing_id = response.json()["id"]
+
+        repeated_uri = self.data_uri()
+        batch = [
+            {"url": self.data_uri(), "function_id": function_fixture.id},
+            {"url": repeated_uri, "function_id": function_fixture.id},
+            {"url": "not_a_valid_url", "function_id": function_fixture.id},
+            {"url": repeated_uri, "function_id": function_fixture.id},
+            {"url": existing_uri, "function_id": function_fixture.id},
+            {"url": self.data_uri(30, 30), "width": 20, "function_id": function_fixture.id},
+        ]
+        response = client.post("/api/detection/samples/batch", json=batch)
+        assert response.status_code == 200
+        assert response.headers["content-type"] == "application/x-ndjson"
+        results = [json.loads(line) for line in response.text.splitlines()]
+
+        assert [r["index"] for r in results] == list(range(len(batch)))
+        assert [r["status"] for r in results] == ["created", "created", "error", "duplicate", "duplicate", "error"]
+        assert results[4]["sample_id"] == existing_id
+        assert "width" in results[5]["detail"]
+
+        for result in results[:2]:
+            sample = test_session.get(ObjectDetectionSample, result["sample_id"])
+            assert sample.image_hash == result["image_hash"]
+            assert sample.width == 20
+
+    def test_ingest_samples_in_chunks(self, test_engine, function_fixture):
+        samples = [ObjectDetectionSample(url=self.data_uri(), function_id=function_fixture.id) for _ in range(5)]
+
+        async def run() -> list[IngestResult]:
+            return [r async for r in ingest_samples(lambda: Session(test_engine), samples, chunk_size=2)]
+
+        results = anyio.run(run)
+        assert [r.status for r in results] == ["created"] * 5
+        assert len({r.sample_id for r in results}) == 5
+
+
+class TestSampleUpload:
+    def image_bytes(self, width: int = 20, height: int = 20) -> bytes:
+        img_array = np.random.randint(0, 255, (height, width, 3), dtype=np.uint8)
+        img_byte_arr = BytesIO()
+        Image.fromarray(img_array).save(img_byte_arr, format="PNG")
+        return img_byte_arr.getvalue()
+
+    def test_upload_raw(self, client, function_fixture):
+        content = self.image_bytes(30, 20)
+        response = client.post(
+            "/api/detection/samples/upload",
+            params={"function_id": function_fixture.id, "key": "raw.png"},
+            content=content,
+            headers={"Content-Type": "image/png"},
+        )
+        assert response.status_code == 200
+        data = response.json()
+        assert (data["width"], data["height"]) == (30, 20)
+        assert data["key"] == "raw.png"
+        assert data["url"] == f"/images/{data['image_hash']}"
+        with open(f"/data/images/{data['image_hash']}", "rb") as file:
+            assert file.read() == content
+
+        # Uploading the same image again is rejected and leaves no temporary file behind.
+        response = client.post(
+            "/api/detection/samples/upload",
+            params={"function_id": function_fixture.id},
+            content=content,
+            headers={"Content-Type": "image/png"},
+        )
+        assert response.status_code == 409
+        assert not [name for name in os.listdir("/data/images") if name.endswith(".upload")]
+
+    def test_upload_hash_matches_create_sample(self, client, test_session, function_fixture):
+        """The incremental hash of an upload de-duplicates against samples created from data URIs"""
+        content = self.image_bytes()
+        data_uri = f"data:image/png;base64,{b64encode(content).decode('utf-8')}"
+        response = client.post("/api/detection/samples", json={"url": data_uri, "function_id": function_fixture.id})
+        assert response.status_code == 200
+        assert response.json()["image_hash"] == hashlib.blake2b(content, digest_size=16).hexdigest()
+
+        response = client.post(
+            "/api/detection/samples/upload",
+            params={"function_id": function_fixture.id},
+            content=content,
+            headers={"Content-Type": "image/png"},
+        )
+        assert response.status_code == 409
+
+    def test_serve_image(self, client, function_fixture):
+        content = self.image_bytes()
+        response = client.post(
+            "/api/detection/samples/upload",
+            params={"function_id": function_fixture.id},
+            content=content,
+            headers={"Content-Type": "image/png"},
+        )
+        data = response.json()
+        assert data["mime_type"] == "image/png"
+
+        response = client.get(data["url"])
+        assert response.content == content
+        assert response.headers["content-type"] == "image/png"
+        assert "immutable" in response.headers["cache-control"]
+        etag = response.headers["etag"]
+        assert etag == f'"{data["image_hash"]}"'
+
+        assert client.get(data["url"], headers={"If-None-Match": etag}).status_code == 304
+        response = client.get(data["url"], headers={"Range": "bytes=0-9"})
+        assert response.status_code == 206
+        assert response.content == content[:10]
+        assert client.get("/images/unknown").status_code == 404
+
+    def test_upload_multipart(self, client, function_fixture):
+        response = client.post(
+            "/api/detection/samples/upload",
+            params={"function_id": function_fixture.id},
+            files={"file": ("test.png", self.image_bytes(), "image/png")},
+        )
+        assert response.status_code == 200
+        assert response.json()["width"] == 20
+
+    def test_upload_invalid(self, client, function_fixture, monkeypatch):
+        params = {"function_id": function_fixture.id}
+        response = client.post("/api/detection/samples/upload", params=params, content=b"{}")
+        assert response.status_code == 415
+
+        response = client.post(
+            "/api/detection/samples/upload", params=params, content=b"garbage", headers={"Content-Type": "image/png"}
+        )
+        assert response.status_code == 422
+
+        monkeypatch.setattr("yapml.server.api.sample_routes.max_image_bytes", 100)
+        response = client.post(
+            "/api/detection/samples/upload",
+            params=params,
+            content=self.image_bytes(),
+            headers={"Content-Type": "image/png"},
+        )
+        assert response.status_code == 422
+        assert "larger than 100 bytes" in response.json()["detail"]
+        assert not [name for name in os.listdir("/data/images") if name.endswith(".upload")]
+
+
+class TestNearDuplicates:
+    def data_uri(self, seed: int, size: int = 64, image_format: str = "PNG") -> str:
+        """A smooth random image, so that resized and re-encoded copies keep their perceptual hash."""
+        small = np.random.default_rng(seed).integers(0, 255, (8, 8, 3), dtype=np.uint8)
+        image = Image.fromarray(small).resize((size, size), Image.Resampling.BICUBIC)
+        img_byte_arr = BytesIO()
+        image.save(img_byte_arr, format=image_format)
+        return f"data:image/{image_format.lower()};base64,{b64encode(img_byte_arr.getvalue()).decode('utf-8')}"
+
+    def create(self, client, function_id: int, url: str, **params):
+        return client.post("/api/detection/samples", params=params, json={"url": url, "function_id": function_id})
+
+    def test_near_duplicate_search(self, client, function_fixture):
+        original = self.create(client, function_fixture.id, self.data_uri(0)).json()
+        assert original["perceptual_hash"] is not None
+        copy = self.create(client, function_fixture.id, self.data_uri(0, size=80, image_format="JPEG")).json()
+        other = self.create(client, function_fixture.id, self.data_uri(1)).json()
+
+        response = client.get(f"/api/detection/samples/{original['id']}/near-duplicates")
+        assert response.status_code == 200
+        assert [match["sample_id"] for match in response.json()] == [copy["id"]]
+
+        response = client.get(f"/api/detection/functions/{function_fixture.id}/near-duplicates")
+        assert response.status_code == 200
+        assert response.json() == [{"sample_ids": [original["id"], copy["id"]]}]
+
+        # Deleting a sample drops it from the index.
+        client.delete(f"/api/detection/samples/{copy['id']}")
+        response = client.get(f"/api/detection/functions/{function_fixture.id}/near-duplicates")
+        assert response.json() == []
+        assert other["id"] not in [
+            m["sample_id"] for m in client.get(f"/api/detection/samples/{original['id']}/near-duplicates").json()
+        ]
+
+    def test_reject_near_duplicates(self, client, function_fixture):
+        original = self.create(client, function_fixture.id, self.data_uri(0)).json()
+        copy_uri = self.data_uri(0, size=80, image_format="JPEG")
+
+        response = self.create(client, function_fixture.id, copy_uri, near_duplicate_radius=4)
+        assert response.status_code == 409
+        assert f"near-duplicate of sample {original['id']}" in response.json()["detail"]
+
+        batch = [
+            {"url": self.data_uri(2), "function_id": function_fixture.id},
+            {"url": copy_uri, "function_id": function_fixture.id},
+            {"url": self.data_uri(2, size=80, image_format="JPEG"), "function_id": function_fixture.id},
+        ]
+        response = client.post("/api/detection/samples/batch", params={"near_duplicate_radius": 4}, json=batch)
+        results = [json.loads(line) for line in response.text.splitlines()]
+        assert [r["status"] for r in results] == ["created", "duplicate", "duplicate"]
+        assert "near-duplicate of item 0" in results[2]["detail"]
+
+        # Without a radius only exact duplicates are rejected.
+        response = self.create(client, function_fixture.id, copy_uri)
+        assert response.status_code == 200
+
+
 def test_delete_sample(client, sample_fixture):
     """Test deleting a sample"""
     response = client.delete(f"/api/detection/samples/{sample_fixture.id}")
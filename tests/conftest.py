@@ -1,3 +1,5 @@
+from typing import Callable
+
 import pytest
 from fastapi import Request
 from fastapi.testclient import TestClient
@@ -5,6 +7,8 @@ from sqlalchemy.pool import StaticPool
 from sqlmodel import Session, SQLModel, create_engine
 
 from yapml.db import get_session
+from yapml.jobs import job_runner
+from yapml.near_duplicates import near_duplicate_registry
 from yapml.server.webapp import web_app
 
 
@@ -28,14 +32,16 @@ def test_session(test_engine):
 
 
 @pytest.fixture
-def client(test_session):
-    """Create a test client with the test database session"""
+def client(test_engine, test_session, monkeypatch):
+    """Create a test client with the test database session. Jobs are not run by workers, but by `run_jobs`."""
 
     def override_get_session(request: Request):  # FastAPI Request here
         request.state.session = test_session
         yield test_session
 
     web_app.dependency_overrides[get_session] = override_get_session
+    monkeypatch.setattr(job_runner, "session_factory", lambda: Session(test_engine))
+    monkeypatch.setattr(job_runner, "worker_count", 0)
 
     with TestClient(web_app) as client:
         yield client
@@ -43,8 +49,15 @@ def client(test_session):
     web_app.dependency_overrides.clear()
 
 
+@pytest.fixture
+def run_jobs(client) -> Callable[[], int]:
+    """Run the due jobs, in the test"""
+    return job_runner.run_pending
+
+
 @pytest.fixture(autouse=True, scope="function")
 def clear_db(test_engine):
     """Clear the database before each test"""
     SQLModel.metadata.drop_all(test_engine)
     SQLModel.metadata.create_all(test_engine)
+    near_duplicate_registry.invalidate()
@@ -0,0 +1,89 @@
+import threading
+import time
+
+import pytest
+from fastapi import Depends, FastAPI, Request
+from fastapi.testclient import TestClient
+from sqlalchemy import text
+from sqlalchemy.exc import OperationalError
+from sqlmodel import Session, SQLModel, select
+
+from yapml.datamodel import FunctionType, YapFunction
+from yapml.db import create_sqlite_engine, get_session
+from yapml.server.webapp import web_app
+
+
+def test_engine_profile(tmp_path):
+    url = f"sqlite:///{tmp_path}/test.db"
+    writer = create_sqlite_engine(url)
+    reader = create_sqlite_engine(url, read_only=True, pool_size=2)
+    SQLModel.metadata.create_all(writer)
+
+    with writer.connect() as connection:
+        assert connection.execute(text("PRAGMA journal_mode")).scalar() == "wal"
+        assert connection.execute(text("PRAGMA synchronous")).scalar() == 1  # NORMAL
+
+    with reader.connect() as connection:
+        assert connection.execute(text("SELECT count(*) FROM label")).scalar() == 0
+        with pytest.raises(OperationalError, match="readonly"):
+            connection.execute(text("DELETE FROM label"))
+
+
+def add_function(session: Session, name: str) -> None:
+    session.add(YapFunction(name=name, description="", function_type=FunctionType.OBJECT_DETECTION))
+    session.commit()
+
+
+def test_concurrent_writers(tmp_path):
+    writer = create_sqlite_engine(f"sqlite:///{tmp_path}/test.db")
+    SQLModel.metadata.create_all(writer)
+
+    with Session(writer) as session:
+        add_function(session, "a")
+
+    # A writer waits for the session of another one to end, instead of failing.
+    with Session(writer) as first:
+        first.add(YapFunction(name="b", description="", function_type=FunctionType.OBJECT_DETECTION))
+        first.flush()
+
+        def add_second() -> None:
+            with Session(writer) as session:
+                add_function(session, "c")
+
+        second = threading.Thread(target=add_second)
+        second.start()
+        time.sleep(0.2)
+        assert second.is_alive()
+        first.commit()
+    second.join(5)
+    assert not second.is_alive()
+    with Session(writer) as session:
+        assert [f.name for f in session.exec(select(YapFunction).order_by(YapFunction.id)).all()] == ["a", "b", "c"]
+
+
+def test_get_session_routes_by_method(tmp_path, monkeypatch):
+    url = f"sqlite:///{tmp_path}/test.db"
+    writer = create_sqlite_engine(url)
+    SQLModel.metadata.create_all(writer)
+    monkeypatch.setattr("yapml.db.engine", writer)
+    monkeypatch.setattr("yapml.db.read_engine", create_sqlite_engine(url, read_only=True, pool_size=2))
+
+    # A GET handler that writes fails, as its session is read-only.
+    app = FastAPI()
+
+    @app.get("/write")
+    def write(request: Request, session: Session = Depends(get_session)) -> None:
+        add_function(session, "get")
+
+    with pytest.raises(OperationalError, match="readonly"):
+        TestClient(app).get("/write")
+
+    # POST and PUT write through the writer, and GET reads what they wrote. The app's lifespan, which starts the job
+    # workers on the configured database, is not run.
+    with Session(writer) as session:
+        add_function(session, "f")
+    client = TestClient(web_app)
+    body = {"name": "cat", "color": "#FF0000", "function_id": 1}
+    label_id = client.post("/api/detection/labels", json=body).json()["id"]
+    assert client.put(f"/api/detection/labels/{label_id}", json={"name": "dog"}).status_code == 200
+    assert client.get(f"/api/detection/labels/{label_id}").json()["name"] == "dog"
@@ -0,0 +1,48 @@
+import hashlib
+from io import BytesIO
+
+import numpy as np
+import pytest
+from PIL import Image
+
+from yapml.hashing import ImageHasher
+
+
+def encode(pixels: np.ndarray, image_format: str) -> BytesIO:
+    stream = BytesIO()
+    Image.fromarray(pixels).save(stream, format=image_format)
+    return stream
+
+
+@pytest.fixture
+def pixels():
+    return np.random.randint(0, 255, (16, 16, 3), dtype=np.uint8)
+
+
+def test_blake2b_hashes_encoded_bytes(pixels):
+    png, bmp = encode(pixels, "PNG"), encode(pixels, "BMP")
+    hasher = ImageHasher("blake2b")
+    assert hasher.hash(png) == hashlib.blake2b(png.getvalue(), digest_size=16).hexdigest()
+    assert hasher.hash(png) != hasher.hash(bmp)
+
+
+def test_incremental_matches_full_hash(pixels):
+    png = encode(pixels, "PNG")
+    hasher = ImageHasher("blake2b")
+    incremental = hasher.new_incremental()
+    data = png.getvalue()
+    for start in range(0, len(data), 7):
+        incremental.update(data[start : start + 7])
+    assert incremental.hexdigest() == hasher.hash(png)
+
+
+def test_pixel_md5_ignores_encoding(pixels):
+    hasher = ImageHasher("pixel-md5")
+    assert hasher.new_incremental() is None
+    assert hasher.hash(encode(pixels, "PNG")) == hasher.hash(encode(pixels, "BMP"))
+    assert hasher.hash(encode(pixels, "PNG")) == hashlib.md5(pixels.tobytes()).hexdigest()
+
+
+def test_unknown_strategy():
+    with pytest.raises(ValueError):
+        ImageHasher("sha1")
@@ -0,0 +1,56 @@
+import anyio
+import httpx
+import pytest
+
+from yapml.image_processing import ImageDecoder, RemoteImageFetcher
+
+
+def handler(request: httpx.Request) -> httpx.Response:
+    if request.url.path == "/image.png":
+        return httpx.Response(200, content=b"x" * 100)
+    if request.url.path == "/large.png":
+        return httpx.Response(200, content=b"x" * 2000)
+    return httpx.Response(404)
+
+
+def fetch(url: str, max_bytes: int = 1000) -> bytes:
+    async def run() -> bytes:
+        fetcher = RemoteImageFetcher(max_bytes=max_bytes, transport=httpx.MockTransport(handler))
+        async with fetcher.client:
+            return (await fetcher.fetch(url)).getvalue()
+
+    return anyio.run(run)
+
+
+def test_fetch():
+    assert fetch("https://example.com/image.png") == b"x" * 100
+
+
+def test_fetch_too_large():
+    with pytest.raises(ValueError, match="larger than 1000 bytes"):
+        fetch("https://example.com/large.png")
+
+
+def test_fetch_not_found():
+    with pytest.raises(ValueError, match="Unable to fetch"):
+        fetch("https://example.com/missing.png")
+
+
+def test_fetch_drops_idle_hosts():
+    async def run() -> int:
+        fetcher = RemoteImageFetcher(transport=httpx.MockTransport(handler))
+        async with fetcher.client:
+            for host in ("a.example.com", "b.example.com"):
+                await fetcher.fetch(f"https://{host}/image.png")
+            with pytest.raises(ValueError):
+                await fetcher.fetch("https://c.example.com/missing.png")
+        return len(fetcher._hosts)
+
+    assert anyio.run(run) == 0
+
+
+def test_to_stream_async_data_uri():
+    async def run() -> bytes:
+        return (await ImageDecoder().to_stream_async("data:image/png;base64,aGVsbG8=")).getvalue()
+
+    assert anyio.run(run) == b"hello"
@@ -0,0 +1,104 @@
+from datetime import datetime
+
+from sqlalchemy import text
+from sqlmodel import Session, create_engine, select
+
+from yapml.datamodel import BoundingBox
+from yapml.migrations import MIGRATIONS, migrate
+
+# The schema before migrations were introduced, as created by SQLModel.metadata.create_all at the time.
+BASELINE_SCHEMA = [
+    """CREATE TABLE yapfunction (
+        id INTEGER NOT NULL, name VARCHAR NOT NULL, description VARCHAR NOT NULL, created_at DATETIME NOT NULL,
+        function_type VARCHAR(16) NOT NULL, PRIMARY KEY (id))""",
+    """CREATE TABLE label (
+        id INTEGER NOT NULL, function_id INTEGER NOT NULL, name VARCHAR NOT NULL, color VARCHAR NOT NULL,
+        deleted_at DATETIME, PRIMARY KEY (id), FOREIGN KEY(function_id) REFERENCES yapfunction (id), UNIQUE (name))""",
+    """CREATE TABLE objectdetectionsample (
+        id INTEGER NOT NULL, function_id INTEGER NOT NULL, url VARCHAR NOT NULL, "key" VARCHAR, image_hash VARCHAR,
+        width INTEGER, height INTEGER, created_at DATETIME NOT NULL, deleted_at DATETIME, PRIMARY KEY (id),
+        FOREIGN KEY(function_id) REFERENCES yapfunction (id))""",
+    "CREATE UNIQUE INDEX ix_objectdetectionsample_image_hash ON objectdetectionsample (image_hash)",
+    """CREATE TABLE boundingbox (
+        id INTEGER NOT NULL, sample_id INTEGER NOT NULL, function_id INTEGER NOT NULL, label_id INTEGER NOT NULL,
+        center_x FLOAT NOT NULL, center_y FLOAT NOT NULL, width FLOAT NOT NULL, height FLOAT NOT NULL,
+        annotator_name VARCHAR NOT NULL, created_at DATETIME NOT NULL, deleted_at DATETIME, previous_box_id INTEGER,
+        PRIMARY KEY (id), FOREIGN KEY(sample_id) REFERENCES objectdetectionsample (id),
+        FOREIGN KEY(function_id) REFERENCES yapfunction (id), FOREIGN KEY(label_id) REFERENCES label (id),
+        UNIQUE (previous_box_id), FOREIGN KEY(previous_box_id) REFERENCES boundingbox (id))""",
+    "CREATE INDEX ix_boundingbox_stray ON boundingbox (annotator_name)",
+]
+
+
+def index_names(connection, table: str) -> set[str]:
+    return {row[1] for row in connection.exec_driver_sql(f"PRAGMA index_list({table})") if row[3] == "c"}
+
+
+def test_migrate_baseline_database(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path}/test.db")
+    now = datetime.now().isoformat(sep=" ")
+    with engine.begin() as connection:
+        for statement in BASELINE_SCHEMA:
+            connection.exec_driver_sql(statement)
+        connection.execute(text("INSERT INTO yapfunction VALUES (1, 'f', '', :now, 'OBJECT_DETECTION')"), {"now": now})
+        connection.exec_driver_sql("INSERT INTO label VALUES (1, 1, 'cat', '#FF0000', NULL)")
+        connection.execute(
+            text("INSERT INTO objectdetectionsample VALUES (1, 1, 'u', NULL, 'h', 1, 1, :now, NULL)"), {"now": now}
+        )
+        # Box 1 was updated twice, box 4 was created and deleted.
+        for box_id, previous_box_id, deleted_at in [(1, None, None), (2, 1, None), (3, 2, None), (4, None, now)]:
+            connection.execute(
+                text(
+                    "INSERT INTO boundingbox VALUES (:id, 1, 1, 1, .5, .5, .1, .1, 'a', :now, :deleted_at, :previous)"
+                ),
+                {"id": box_id, "now": now, "deleted_at": deleted_at, "previous": previous_box_id},
+            )
+
+    assert migrate(engine) == len(MIGRATIONS)
+    assert migrate(engine) == len(MIGRATIONS)  # Migrating an up to date database does nothing.
+
+    with Session(engine) as session:
+        boxes = session.exec(select(BoundingBox).order_by(BoundingBox.id)).all()  # type: ignore
+        assert [(box.lineage_id, box.version, box.is_head) for box in boxes] == [
+            (1, 1, False),
+            (1, 2, False),
+            (1, 3, True),
+            (4, 1, False),
+        ]
+    with engine.connect() as connection:
+        assert connection.exec_driver_sql("PRAGMA user_version").scalar() == len(MIGRATIONS)
+        indexes = index_names(connection, "boundingbox")
+        assert "ix_boundingbox_sample_id_is_head" in indexes
+        assert "ix_boundingbox_stray" not in indexes
+        assert "ix_objectdetectionsample_image_hash" in index_names(connection, "objectdetectionsample")
+
+
+def test_migrate_new_database(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path}/test.db")
+    migrate(engine)
+    with engine.connect() as connection:
+        assert connection.exec_driver_sql("PRAGMA user_version").scalar() == len(MIGRATIONS)
+        assert "ix_label_function_id_deleted_at" in index_names(connection, "label")
+
+
+def test_migrate_duplicate_active_jobs(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path}/test.db")
+    migrate(engine)
+    with engine.begin() as connection:
+        connection.exec_driver_sql("DROP INDEX ix_job_kind_key_active")
+        connection.exec_driver_sql(f"PRAGMA user_version = {len(MIGRATIONS) - 1}")
+        now = datetime.now().isoformat(sep=" ")
+        for status, key in [("running", "a"), ("queued", "a"), ("queued", "b"), ("completed", "b"), ("queued", "b")]:
+            connection.execute(
+                text(
+                    "INSERT INTO job (kind, key, params, status, progress, attempts, max_attempts, cancel_requested,"
+                    " created_at, run_after) VALUES ('delete', :key, '{}', :status, 0, 0, 1, 0, :now, :now)"
+                ),
+                {"key": key, "status": status, "now": now},
+            )
+
+    migrate(engine)
+    with engine.connect() as connection:
+        statuses = connection.exec_driver_sql("SELECT status FROM job ORDER BY id").scalars().all()
+        assert statuses == ["running", "cancelled", "queued", "completed", "cancelled"]
+        assert "ix_job_kind_key_active" in index_names(connection, "job")
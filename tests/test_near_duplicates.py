@@ -0,0 +1,75 @@
+import numpy as np
+import pytest
+from PIL import Image, ImageFilter
+
+from yapml.hashing import perceptual_hash
+from yapml.near_duplicates import NearDuplicateIndex
+
+
+def flip_bits(value: int, bits: list[int]) -> int:
+    for bit in bits:
+        value ^= 1 << bit
+    return value
+
+
+@pytest.fixture
+def rng():
+    return np.random.default_rng(0)
+
+
+@pytest.fixture
+def random_hashes(rng):
+    hashes = [int(h) for h in rng.integers(0, 2**63, size=2000, dtype=np.int64)]
+    # Plant near-duplicates of the first 50 hashes.
+    for i in range(50):
+        hashes.append(flip_bits(hashes[i], rng.choice(64, size=i % 7, replace=False).tolist()))
+    return [f"{h:016x}" for h in hashes]
+
+
+def brute_force(hashes: list[str], target: str, radius: int) -> set[int]:
+    return {i for i, h in enumerate(hashes) if bin(int(h, 16) ^ int(target, 16)).count("1") <= radius}
+
+
+@pytest.mark.parametrize("radius", [0, 3, 4, 6, 10])
+def test_query_matches_brute_force(random_hashes, radius):
+    index = NearDuplicateIndex(blocks=5)
+    index.add_many(list(range(1000)), random_hashes[:1000])
+    for i, h in enumerate(random_hashes[1000:], start=1000):
+        index.add(i, h)  # Partly buffered, partly rebuilt.
+    for target in random_hashes[:60] + random_hashes[-50:]:
+        matches = index.query(target, radius)
+        assert {m.sample_id for m in matches} == brute_force(random_hashes, target, radius)
+        assert [m.distance for m in matches] == sorted(m.distance for m in matches)
+
+
+@pytest.mark.parametrize("radius", [3, 6])
+def test_clusters(random_hashes, radius):
+    index = NearDuplicateIndex(blocks=5)
+    index.add_many(list(range(len(random_hashes))), random_hashes)
+    index.add(len(random_hashes), random_hashes[0])  # An exact duplicate.
+    clusters = index.clusters(radius)
+
+    cluster_of = {sample_id: i for i, cluster in enumerate(clusters) for sample_id in cluster.sample_ids}
+    values = np.array([int(h, 16) for h in random_hashes + [random_hashes[0]]], dtype=np.uint64)
+    pairs_a, pairs_b = np.nonzero(np.bitwise_count(values[:, None] ^ values[None, :]) <= radius)
+    for i, j in zip(pairs_a.tolist(), pairs_b.tolist()):
+        if i != j:
+            assert cluster_of[i] == cluster_of[j]
+    assert cluster_of[0] == cluster_of[len(random_hashes)]
+    assert all(len(cluster.sample_ids) > 1 for cluster in clusters)
+
+
+def test_perceptual_hash_is_robust(rng):
+    pixels = rng.integers(0, 255, (64, 64, 3), dtype=np.uint8)
+    image = Image.fromarray(pixels).resize((512, 512), Image.Resampling.BILINEAR)
+    resized = image.resize((300, 300), Image.Resampling.LANCZOS)
+    blurred = image.filter(ImageFilter.GaussianBlur(1))
+    other = Image.fromarray(rng.integers(0, 255, (64, 64, 3), dtype=np.uint8)).resize((512, 512))
+
+    def distance(a: Image.Image, b: Image.Image) -> int:
+        return bin(int(perceptual_hash(a), 16) ^ int(perceptual_hash(b), 16)).count("1")
+
+    assert len(perceptual_hash(image)) == 16
+    assert distance(image, resized) <= 4
+    assert distance(image, blurred) <= 4
+    assert distance(image, other) > 10
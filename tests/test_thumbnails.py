@@ -0,0 +1,90 @@
+import os
+
+import numpy as np
+import pytest
+from PIL import Image
+
+from yapml.datamodel import ObjectDetectionSample
+from yapml.thumbnails import ThumbnailCache, pick_thumbnail_size, thumbnail_url
+
+
+def write_image(directory, name: str, width: int, height: int) -> None:
+    img_array = np.random.randint(0, 255, (height, width, 3), dtype=np.uint8)
+    Image.fromarray(img_array).save(os.path.join(directory, name), format="JPEG")
+
+
+@pytest.fixture
+def cache_dirs(tmp_path):
+    source_dir = tmp_path / "images"
+    cache_dir = tmp_path / "thumbnails"
+    source_dir.mkdir()
+    return str(source_dir), str(cache_dir)
+
+
+def test_get_creates_variant(cache_dirs):
+    source_dir, cache_dir = cache_dirs
+    write_image(source_dir, "abc123", 1200, 600)
+    cache = ThumbnailCache(cache_dir, source_dir, max_bytes=10**9)
+
+    path = cache.get("abc123", 256)
+    with Image.open(path) as img:
+        assert img.format == "WEBP"
+        assert img.size == (256, 128)
+    assert cache.total_bytes == os.path.getsize(path)
+
+    # Second request is served from the cache.
+    assert cache.get("abc123", 256) == path
+
+
+def test_variant_is_upright(cache_dirs):
+    """A JPEG that is stored sideways, with an EXIF orientation to rotate it, gets an upright variant"""
+    source_dir, cache_dir = cache_dirs
+    exif = Image.Exif()
+    exif[0x0112] = 6  # Orientation: rotate 90 degrees clockwise to display.
+    Image.new("RGB", (600, 300)).save(os.path.join(source_dir, "abc123"), format="JPEG", exif=exif)
+    cache = ThumbnailCache(cache_dir, source_dir, max_bytes=10**9)
+
+    with Image.open(cache.get("abc123", 256)) as img:
+        assert img.size == (128, 256)
+
+
+def test_get_invalid_requests(cache_dirs):
+    source_dir, cache_dir = cache_dirs
+    cache = ThumbnailCache(cache_dir, source_dir, max_bytes=10**9)
+    with pytest.raises(ValueError):
+        cache.get("abc123", 300)
+    with pytest.raises(ValueError):
+        cache.get("../etc/passwd", 256)
+    with pytest.raises(FileNotFoundError):
+        cache.get("abc123", 256)
+
+
+def test_lru_eviction(cache_dirs):
+    source_dir, cache_dir = cache_dirs
+    for name in ["aa", "bb", "cc"]:
+        write_image(source_dir, name, 600, 600)
+    cache = ThumbnailCache(cache_dir, source_dir, max_bytes=10**9)
+    path_a = cache.get("aa", 256)
+    cache.max_bytes = 2 * os.path.getsize(path_a) + 1000
+    path_b = cache.get("bb", 256)
+    cache.get("aa", 256)  # Touch aa so that bb becomes the least recently used.
+    path_c = cache.get("cc", 256)
+
+    assert os.path.exists(path_a)
+    assert not os.path.exists(path_b)
+    assert os.path.exists(path_c)
+    assert cache.total_bytes <= cache.max_bytes
+
+    # A new cache instance picks up what is on disk.
+    reloaded = ThumbnailCache(cache_dir, source_dir, max_bytes=cache.max_bytes)
+    assert reloaded.total_bytes == cache.total_bytes
+
+
+def test_thumbnail_url():
+    assert pick_thumbnail_size(500) == 512
+    assert pick_thumbnail_size(2000) is None
+    sample = ObjectDetectionSample(url="/images/abc", image_hash="abc", function_id=1)
+    assert thumbnail_url(sample, 500) == "/thumbnails/512/abc"
+    assert thumbnail_url(sample, 4000) == "/images/abc"
+    remote = ObjectDetectionSample(url="https://example.com/x.jpg", function_id=1)
+    assert thumbnail_url(remote, 500) == "https://example.com/x.jpg"